@@ -0,0 +1,42 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# threads for the blocking read path (dataset loads, pandas, encoding); kept
+# apart from Starlette's own pool so a burst of data requests can't starve /ping
+API_WORKERS = 4
+
+EXECUTOR = ThreadPoolExecutor(max_workers=API_WORKERS, thread_name_prefix="api-data")
+
+# key -> future of the call computing it; only touched from the event loop
+_inflight = {}
+
+
+async def run_blocking(fn, *args, key=None, **kwargs):
+    """
+    Runs fn(*args, **kwargs) on EXECUTOR. While a call with the same key is
+    in flight, later callers wait for its result instead of starting their
+    own (single-flight), so N identical dashboard requests cost one read.
+    """
+    loop = asyncio.get_running_loop()
+    call = partial(fn, *args, **kwargs)
+    if key is None:
+        return await loop.run_in_executor(EXECUTOR, call)
+
+    future = _inflight.get(key)
+    if future is None:
+        future = loop.run_in_executor(EXECUTOR, call)
+        _inflight[key] = future
+
+        def done(f, key=key):
+            if _inflight.get(key) is f:
+                del _inflight[key]
+
+        future.add_done_callback(done)
+    # a caller that disconnects must not cancel the call the others share
+    return await asyncio.shield(future)
+
+
+def request_key(request, *extra):
+    """Single-flight key for a GET: path, query string and anything extra (e.g. the format)."""
+    return (request.url.path, request.url.query, *extra)
@@ -1,23 +1,61 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from pathlib import Path
 from datetime import datetime, timedelta
 import pandas as pd
+import asyncio
 import json
+import time
 import requests
 
-from app.features.build_features import build_windows
+from app.features.build_features import build_windows, WINDOWS
 from app.models.detector import detect
 from app.ingest.adguard_ingest import adguard_ingest_from_file
 from app.ingest.retrieve_logs import pull_logs
 from app.celery_app import celery_app
-from app.tasks import run_refresh
+from app.tasks import start_refresh
+from app.storage.parquet_store import FEATURES, ALERTS, ANOMALY_HISTORY
+from app.storage.query_cache import cached
+from app.api.responses import negotiate, frame_response
+from app.api.concurrency import run_blocking, request_key
+from app.storage.summary import load_summary, summarize_datasets
+from app.storage.events import read_events, end_offset
+from app.storage.rollups import RESOLUTIONS, pick_resolution, device_rollup
+from app.metrics import prometheus_text
 
 app = FastAPI()
 
-def load_file(file):
-    if not file.exists():
-        return pd.DataFrame()
-    return pd.read_csv(file)
+# rows per page on /features and /alerts when no ?limit= is given
+PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10_000
+
+# /devices/{ip}/history picks the finest rollup that stays under this many points
+HISTORY_MAX_POINTS = 600
+
+# how often /events checks the event log for new lines, and how long it may
+# go quiet before sending a comment so proxies keep the connection open
+EVENTS_POLL_SECONDS = 0.25
+EVENTS_HEARTBEAT_SECONDS = 15
+
+def load_page(path, key, since, until, client_ip, fields, offset, limit, fmt="records"):
+    """
+    One page of a cached dataset, filtered and projected before it is
+    serialized in fmt. next_offset is None on the last page.
+    """
+    dataset = cached(path)
+    columns = None
+    if fields:
+        columns = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = [c for c in columns if c not in dataset.df.columns]
+        if unknown and not dataset.df.empty:
+            raise HTTPException(status_code=400, detail=f"unknown fields: {', '.join(unknown)}")
+
+    rows, total = dataset.query(
+        since=since, until=until, client_ip=client_ip,
+        columns=columns, offset=offset, limit=limit,
+    )
+    end = offset + len(rows)
+    return frame_response(fmt, key, rows, total=total, next_offset=end if end < total else None)
 
 def parse_since(s: str):
     if s.endswith("m"):
@@ -46,65 +84,108 @@ def hello(name: str):
 
 
 @app.get("/alerts")
-def get_alerts():
-    path = Path("data/alerts.csv")
-    # if not path.exists():
-    #     return {"alerts": []}
-    # alerts_csv = pd.read_csv(path)
-    alerts_df = load_file(path)
-    # Iterative method
-    # rows = []
-    # for idx, row in alerts_csv.iterrows():
-    #     rows.append({"client_ip": row["client_ip"],
-    #                  "minute": row["minute"],
-    #                  "qpm": row["qpm"],
-    #                  "uniq": row["uniq"],
-    #                  "avg_len": row["avg_len"],
-    #                  "score": row["score"]})
-    
-    # Pandas built in conversion
-    rows = alerts_df.to_dict(orient="records")
-    return {"alerts": rows}
+async def get_alerts(
+    request: Request,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    client_ip: list[str] | None = Query(None),
+    fields: str | None = None,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    format: str | None = None,
+):
+    fmt = negotiate(request, format)
+    return await run_blocking(
+        load_page, ALERTS, "alerts", since, until, client_ip, fields, offset, limit, fmt,
+        key=request_key(request, fmt),
+    )
+
+def device_list():
+    devices = cached(FEATURES).devices()
+    return JSONResponse({"devices": devices})
 
 @app.get("/devices")
-def get_devices():
-    path = Path("data/features.csv")
-    features_df = load_file(path)
-    rows = features_df.to_dict(orient="records")
-    devices = sorted(set([row["client_ip"] for row in rows]))
-    return {"devices": devices}
-    
-@app.get("/devices/{ip}/history")
-def get_device_history(ip: str, since: str | None = None):
-    path = Path("data/anomaly_history.csv")
-    if not path.exists():
-        return {"ip": ip, "history": []}
+async def get_devices(request: Request):
+    return await run_blocking(device_list, key=request_key(request))
+
+def device_history(ip: str, since: str | None, fmt: str, resolution: str | None = None, max_points: int = HISTORY_MAX_POINTS):
+    history = cached(ANOMALY_HISTORY)
+    if history.df.empty:
+        return frame_response(fmt, "history", history.df, ip=ip, resolution=RESOLUTIONS[0])
     
-    features_df = load_file(path)
-    features_df["minute"] = pd.to_datetime(features_df["minute"]).dt.tz_localize(None)
-    ip_data = features_df[features_df["client_ip"] == ip].sort_values("minute")
+    cutoff = None
+    latest = history.latest(ip)
     if since:
         delta = parse_since(since)
-        if delta:
-            latest = ip_data["minute"].max()
+        if delta and latest is not None:
             #cutoff = datetime.utcnow() - delta
             cutoff = latest - delta
-            ip_data = ip_data[ip_data["minute"] >= cutoff]
-    ip_data = ip_data.to_dict(orient="records")
-    return{"ip": ip, "history": ip_data}
+
+    if resolution is None:
+        span = pd.Timedelta(0)
+        if latest is not None:
+            first = cutoff if cutoff is not None else history.device(ip)["minute"].iloc[0]
+            span = latest - first
+        resolution = pick_resolution(span, max_points)
+
+    ip_data = device_rollup(ip, resolution, since=cutoff)
+    if ip_data.empty:
+        return frame_response(fmt, "history", ip_data, ip=ip, resolution=resolution)
+    ip_data = ip_data.assign(minute=ip_data["minute"].dt.tz_localize(None))
+    return frame_response(fmt, "history", ip_data, ip=ip, resolution=resolution)
+    
+@app.get("/devices/{ip}/history")
+async def get_device_history(
+    request: Request,
+    ip: str,
+    since: str | None = None,
+    resolution: str | None = None,
+    max_points: int = Query(HISTORY_MAX_POINTS, ge=1),
+    format: str | None = None,
+):
+    """
+    The device's anomaly history, at a fixed ?resolution= (1min, 5min, 1h,
+    1d) or else the finest one that covers the range in max_points buckets.
+    Rolled-up rows carry count, each column's mean under its own name and
+    its max as <col>_max.
+    """
+    if resolution is not None and resolution not in RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"resolution must be one of {', '.join(RESOLUTIONS)}")
+    fmt = negotiate(request, format)
+    return await run_blocking(
+        device_history, ip, since, fmt, resolution, max_points,
+        key=request_key(request, fmt),
+    )
     
 @app.get("/features")
-def get_features():
-    path = Path("data/features.csv")
-    if not path.exists():
-        return {"features": []}
-    features_df = load_file(path)
-    features = features_df.to_dict(orient="records")
-    return {"features": features}
+async def get_features(
+    request: Request,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    client_ip: list[str] | None = Query(None),
+    fields: str | None = None,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    format: str | None = None,
+    window: str | None = None,
+):
+    # ?window= pages one of the build_features.WINDOW_SPECS datasets instead
+    path = FEATURES
+    if window is not None:
+        if window not in WINDOWS:
+            raise HTTPException(status_code=400, detail=f"window must be one of {', '.join(WINDOWS)}")
+        path = WINDOWS[window]
+    fmt = negotiate(request, format)
+    return await run_blocking(
+        load_page, path, "features", since, until, client_ip, fields, offset, limit, fmt,
+        key=request_key(request, fmt),
+    )
 
-@app.post("/refresh")
-def refresh():
-    job = run_refresh.delay()
+def request_refresh():
+    # the id of the refresh already running if there is one
+    task_id = start_refresh()
+    if task_id is None:
+        raise HTTPException(status_code=409, detail="busy: the stream or retention holds the refresh lock")
     
     # Make dir and text file to record last refresh timestamp
     path = Path("data")
@@ -113,57 +194,109 @@ def refresh():
     with open(last_refresh, "w") as f:
         f.write(datetime.utcnow().isoformat() + "\n")
     
-    return {"task_id": job.id}
+    return {"task_id": task_id}
 
-@app.get("/task-status/{task_id}")
-def get_task_status(task_id: str):
+@app.post("/refresh")
+async def refresh():
+    return await run_blocking(request_refresh)
+
+def task_status(task_id: str):
     result = celery_app.AsyncResult(task_id)
     return {
         "state": result.state,
         "result": result.result
     }
 
-@app.get("/status")
-def get_status():
-    alerts_csv = Path("data/alerts.csv")
-    features_csv = Path("data/features.csv")
+@app.get("/task-status/{task_id}")
+async def get_task_status(request: Request, task_id: str):
+    # the result backend is a network round trip
+    return await run_blocking(task_status, task_id, key=request_key(request))
+
+def status_summary():
     last_refresh_txt = Path("data/last_refresh.txt")
-    
-    num_devices = 0
-    num_feature_rows = 0
-    num_alert_rows = 0
-    last_feature_time = None
-    last_alert_time = None
     last_refresh_timestamp = None
-    highest_anomaly_score = 0.0
 
-    
-    if features_csv.exists():
-        feats = pd.read_csv(features_csv, parse_dates=["minute"])
-        if not feats.empty:
-            num_feature_rows = len(feats)
-            num_devices = feats["client_ip"].nunique()
-            last_feature_time = feats["minute"].max().isoformat()
-    if alerts_csv.exists():
-        alerts = pd.read_csv(alerts_csv, parse_dates=["minute"])
-        if not alerts.empty:
-            num_alert_rows = len(alerts)
-            last_alert_time = alerts["minute"].max().isoformat()
-            highest_anomaly_score = alerts["combined_score"].max()
+    # kept current by write_csv, build_windows and detect
+    summary = load_summary()
+    if not summary:
+        # nothing published yet (data from before the summary existed)
+        summary = summarize_datasets()
     
     if last_refresh_txt.exists():
         with open(last_refresh_txt, "r") as f:
             last_refresh_timestamp = f.readlines()[-1]
     
     return {
-        "num_devices": num_devices,
-        "num_feature_rows": num_feature_rows,
-        "num_alert_rows": num_alert_rows,
-        "last_feature_time": last_feature_time,
-        "last_alert_time": last_alert_time,
+        "num_devices": summary.get("num_devices", 0),
+        "num_feature_rows": summary.get("num_feature_rows", 0),
+        "num_alert_rows": summary.get("num_alert_rows", 0),
+        "last_feature_time": summary.get("last_feature_time"),
+        "last_alert_time": summary.get("last_alert_time"),
         "last_refresh_timestamp": last_refresh_timestamp,
-        "highest_anomaly_score": highest_anomaly_score
+        "highest_anomaly_score": summary.get("highest_anomaly_score", 0.0),
+        "stages": summary.get("stages", {}),
     }
+
+@app.get("/status")
+async def get_status(request: Request):
+    return await run_blocking(status_summary, key=request_key(request))
+
+def metrics_text():
+    return PlainTextResponse(prometheus_text(load_summary()), media_type="text/plain; version=0.0.4")
+
+@app.get("/metrics")
+async def get_metrics():
+    """Per-stage timings, rows, memory and I/O of the pipeline for Prometheus."""
+    return await run_blocking(metrics_text, key=("/metrics",))
+
+def sse(offset, event):
+    return f"id: {offset}\nevent: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+@app.get("/events")
+async def get_events(
+    request: Request,
+    types: str | None = None,
+    min_score: float | None = None,
+    since: int | None = Query(None, ge=0),
+    heartbeat: float = Query(EVENTS_HEARTBEAT_SECONDS, gt=0),
+):
+    """
+    Server-sent events: "progress" from each pipeline stage and "alert" for
+    each newly scored window above the alert threshold. Starts at the end of
+    the event log, or after the Last-Event-ID the browser reconnects with
+    (?since= does the same for clients that can't set headers).
+    """
+    wanted = {t.strip() for t in types.split(",")} if types else None
+    last_id = request.headers.get("last-event-id")
+    if since is None and last_id and last_id.isdigit():
+        since = int(last_id)
+
+    async def stream():
+        offset = end_offset() if since is None else since
+        last_sent = time.monotonic()
+        yield "retry: 1000\n\n"
+        while not await request.is_disconnected():
+            events, offset = await run_blocking(read_events, offset)
+            for event_offset, event in events:
+                if wanted and event["type"] not in wanted:
+                    continue
+                if (
+                    min_score is not None and event["type"] == "alert"
+                    and event["data"].get("combined_score", 0) < min_score
+                ):
+                    continue
+                yield sse(event_offset, event)
+                last_sent = time.monotonic()
+            if time.monotonic() - last_sent > heartbeat:
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+            await asyncio.sleep(EVENTS_POLL_SECONDS)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
         
 
 # @app.post("/control/login")
@@ -0,0 +1,65 @@
+import orjson
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from fastapi import HTTPException, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+# records: [{col: value}, ...] through FastAPI's encoder, as before
+# columns: {col: [values]} encoded by orjson
+# arrow:   an Arrow IPC stream of the frame, other fields as X- headers
+FORMATS = ("records", "columns", "arrow")
+
+
+def negotiate(request: Request, format: str | None = None):
+    """
+    Response format from ?format=, else from the Accept header.
+    """
+    if format is not None:
+        if format not in FORMATS:
+            raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(FORMATS)}")
+        return format
+    if ARROW_MEDIA_TYPE in request.headers.get("accept", ""):
+        return "arrow"
+    return "records"
+
+
+def _column(s: pd.Series):
+    if isinstance(s.dtype, pd.DatetimeTZDtype):
+        return s.array.to_pydatetime().tolist()
+    if s.dtype.kind in "biufM" and not s.hasnans:
+        return np.ascontiguousarray(s.to_numpy())
+    return s.astype(object).where(s.notna(), None).tolist()
+
+
+def to_arrow(df: pd.DataFrame):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def frame_response(fmt: str, key: str, df: pd.DataFrame, **fields):
+    """
+    {key: df, **fields} in the negotiated format, fully encoded so the
+    caller's thread does the work rather than the event loop.
+    """
+    if fmt == "arrow":
+        headers = {
+            "X-" + name.replace("_", "-").title(): "" if value is None else str(value)
+            for name, value in fields.items()
+        }
+        return Response(to_arrow(df).to_pybytes(), media_type=ARROW_MEDIA_TYPE, headers=headers)
+
+    if fmt == "columns":
+        body = {key: {col: _column(df[col]) for col in df.columns}, **fields}
+        return Response(
+            orjson.dumps(body, option=orjson.OPT_SERIALIZE_NUMPY),
+            media_type="application/json",
+        )
+
+    return JSONResponse(jsonable_encoder({key: df.to_dict(orient="records"), **fields}))
@@ -7,8 +7,23 @@ celery_app = Celery(
     include=["app.tasks"],  
 )
 
+# seconds between scheduled refreshes (celery -A app.celery_app beat)
+REFRESH_EVERY = 300.0
+# and between retention/compaction runs, see app.retention
+RETENTION_EVERY = 86400.0
+
 celery_app.conf.update(
     task_track_started=True,
     task_time_limit=600,
     result_expires=3600,
+    beat_schedule={
+        "refresh": {
+            "task": "app.tasks.run_refresh",
+            "schedule": REFRESH_EVERY,
+        },
+        "retention": {
+            "task": "app.tasks.retention_task",
+            "schedule": RETENTION_EVERY,
+        },
+    },
 )
\ No newline at end of file
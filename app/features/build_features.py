@@ -1,11 +1,60 @@
+import time
 import pandas as pd
 import numpy as np
-from pathlib import Path
 from app.ingest.parse_querylog import parse_querylog
-from app.ingest.state_manager import load_state, save_state
+from app.ingest.state_manager import (
+    load_state,
+    to_epoch_ns,
+    Commit,
+    load_first_seen,
+    append_first_seen,
+    reset_first_seen,
+    load_baseline_counts,
+    save_baseline_counts,
+    load_window_carry,
+    save_window_carry,
+)
+from app.storage.parquet_store import DNS, FEATURES, read_dataset, write_dataset, dataset_exists
+from app.storage.interning import interner, pair_key, split_key
+from app.storage.summary import load_summary, publish, running_count
+from app.metrics import stage, step
+
+SRC = DNS
+OUT = FEATURES
+
+# Baseline decay half-life in minutes; None keeps every query at full weight.
+BASELINE_HALF_LIFE = None
+# Per-device cap on baseline domains; the lowest-weight ones are evicted past it.
+BASELINE_MAX_DOMAINS = 5000
+
+NS_PER_MINUTE = 60_000_000_000
+
+# bump when a feature's definition changes; OUT written under another
+# version is rebuilt from the queries, see needs_rebuild
+# 2: KL_divergence against the device's real baseline, not epsilon
+FEATURES_VERSION = 2
+
+FEAT_COLS = [
+    "qpm",
+    "uniq",
+    "avg_len",
+    "len_std",
+    "top_domain_ratio",
+    "shannon_entropy",
+    "new_domain_ratio",
+    "KL_divergence",
+]
+
+# extra windows computed next to the freq ones OUT holds (which the
+# detector scores): name -> (size, hop); size == hop is tumbling, a smaller
+# hop slides. Both must be whole multiples of freq, size of hop.
+WINDOW_SPECS = {
+    "5min": ("5min", "1min"),
+    "1h": ("1h", "1h"),
+}
+# written next to OUT, e.g. data/features_5min
+WINDOWS = {name: OUT.with_name(f"{OUT.name}_{name}") for name in WINDOW_SPECS}
 
-SRC = Path("data/sample_dns.csv")
-OUT = Path("data/features.csv")
 
 def top_domain_ratio_calc(domains: pd.Series):
     counts = domains.value_counts()
@@ -33,183 +82,543 @@ def shannon_entropy_calc(domains: pd.Series):
 #         device_baseline[device] = P_base.to_dict()
 #     return device_baseline
 
-def compute_baseline_probs(df: pd.DataFrame):
+def intern_queries(df: pd.DataFrame, devices=None, domains=None):
     """
-    Computes P(domain | device) using all historical data.
-    Returns a Series indexed by (client_ip, domain).
+    The queries in df reduced to the integer keys every groupby of this
+    stage runs on: device_id and domain_id (codes from the persisted
+    dictionaries, see app.storage.interning), minute_id (window start in
+    epoch minutes) and domain_len, plus time. The strings are only looked
+    up again for the output rows.
     """
-    base = (
-        df.groupby(["client_ip", "domain"])
-          .size()
-          .groupby(level=0)
-          .apply(lambda s: s / s.sum())
-    )
-    return base
+    if devices is None:
+        devices = interner("client_ip")
+    if domains is None:
+        domains = interner("domain")
+    domain_id = domains.codes(df["domain"])
+    return pd.DataFrame({
+        "time": df["time"],
+        "device_id": devices.codes(df["client_ip"]),
+        "domain_id": domain_id,
+        "minute_id": to_epoch_ns(df["minute"]).to_numpy() // NS_PER_MINUTE,
+        "domain_len": domains.lengths(domain_id),
+    }, index=df.index)
+
+
+def decode_windows(g: pd.DataFrame, tz=None, devices=None):
+    """
+    Feature rows keyed by device_id/minute_id back to client_ip/minute (in
+    tz), the shape FEATURES stores.
+    """
+    if devices is None:
+        devices = interner("client_ip")
+    minute = pd.to_datetime(g["minute_id"].to_numpy() * NS_PER_MINUTE)
+    minute = minute.tz_localize("UTC").tz_convert(tz) if tz is not None else minute
+    out = pd.DataFrame({"client_ip": devices.values(g["device_id"]), "minute": minute})
+    return pd.concat([out, g[FEAT_COLS].reset_index(drop=True)], axis=1)
 
 
-def compute_window_probs(df: pd.DataFrame):
+def compute_baseline_counts(df: pd.DataFrame, as_of=None, half_life=None):
     """
-    Computes P(domain | device, minute) for each time window.
-    Returns a Series indexed by (client_ip, minute, domain).
+    Query counts per (device, domain), indexed by pair_key(device_id,
+    domain_id). With a half_life (minutes) each query is weighted by
+    0.5 ** (age / half_life), age measured back from as_of.
     """
-    counts = (
-        df.groupby(["client_ip", "minute", "domain"])
-          .size()
-          .rename("count")
-    )
-    probs = counts.groupby(level=[0, 1]).apply(lambda s: s / s.sum())
-    return probs
+    key = pair_key(df["device_id"], df["domain_id"])
+    if half_life is None:
+        keys, counts = np.unique(key, return_counts=True)
+        return pd.Series(counts.astype(float), index=pd.Index(keys, name="key"), name="count")
 
+    as_of = to_epoch_ns(pd.Series([as_of])).iloc[0] // NS_PER_MINUTE
+    age = as_of - df["minute_id"].to_numpy()
+    weights = pd.Series(np.power(0.5, age / half_life))
+    counts = weights.groupby(key).sum().rename("count")
+    counts.index.name = "key"
+    return counts
 
-def compute_KL_vectorized(window_probs, baseline_probs, epsilon=1e-7):
+
+def baseline_probs_from_counts(counts: pd.Series):
     """
-    Fully vectorized KL divergence:
-    KL(P_t || P_base) = sum P_t * log(P_t / P_base)
+    Normalizes per-device counts into P(domain | device).
     """
-    # Align baselines so they match the window index structure
-    baseline_aligned = baseline_probs.reindex(window_probs.index, fill_value=0)
+    device = split_key(counts.index.to_numpy())[0]
+    return counts / counts.groupby(device).transform("sum").to_numpy()
 
-    p_t = window_probs + epsilon
-    p_b = baseline_aligned + epsilon
 
-    KL_vals = (p_t * np.log(p_t / p_b))
+def update_baseline_counts(counts, df_new, last_minute, new_minute,
+                           half_life=None, max_domains=None):
+    """
+    Decays the stored counts up to new_minute, adds df_new, and evicts each
+    device's lowest-weight domains beyond max_domains.
+    """
+    added = compute_baseline_counts(df_new, as_of=new_minute, half_life=half_life)
+    if counts is None or counts.empty:
+        counts = added
+    else:
+        if half_life is not None and last_minute is not None:
+            elapsed = (new_minute - last_minute).total_seconds() / 60
+            counts = counts * 0.5 ** (elapsed / half_life)
+        counts = pd.concat([counts, added]).groupby(level=0).sum()
 
-    # Collapse domain index → per (device, minute)
-    KL_per_window = KL_vals.groupby(level=[0, 1]).sum()
+    if max_domains is not None:
+        device = split_key(counts.index.to_numpy())[0]
+        rank = counts.groupby(device).rank(method="first", ascending=False).to_numpy()
+        counts = counts[rank <= max_domains]
 
-    return KL_per_window
+    return counts
+
+
+def compute_baseline_probs(df: pd.DataFrame):
+    """
+    Computes P(domain | device) using all historical data.
+    Returns a Series indexed by pair_key(device_id, domain_id).
+    """
+    return baseline_probs_from_counts(compute_baseline_counts(df))
+
+
+def minute_accumulators(df: pd.DataFrame):
+    """
+    The one pass over interned queries (see intern_queries) every window is
+    built from. Returns (minutes, cells):
+      minutes: per (device_id, minute_id) the query count n, the sum of
+               domain lengths, their squared deviations from the minute's
+               mean (len_m2) and how many were new domains; ordered by
+               device then minute
+      cells:   query count per (minute row, domain_id), ordered by row
+               then domain
+    (device, minute) pairs are factorized once and the (row, domain) cells
+    counted by sorting their packed keys. Row-sized temporaries are reused
+    in place where it is easy, they are what sets the stage's peak memory.
+    """
+    minute_id = df["minute_id"].to_numpy()
+    first_minute = minute_id.min()
+
+    with step("counts"):
+        row, keys = pd.factorize(pair_key(df["device_id"], minute_id - first_minute), sort=True)
+        cells = pair_key(row, df["domain_id"])
+        cells.sort()
+        is_first = np.empty(len(cells), dtype=bool)
+        is_first[:1] = True
+        np.not_equal(cells[1:], cells[:-1], out=is_first[1:])
+        cell_start = np.flatnonzero(is_first)
+        del is_first
+        cell_count = np.diff(cell_start, append=len(cells))
+        cells = cells[cell_start]
+        del cell_start
+        cell_row, cell_domain = split_key(cells)
+        del cells
+    n = len(keys)
+    device_id, minute = split_key(keys)
+
+    with step("agg"):
+        dlen = df["domain_len"].to_numpy().astype(float)
+        count = np.bincount(row, minlength=n)
+        len_sum = np.bincount(row, weights=dlen, minlength=n)
+        dev = (len_sum / count)[row]
+        np.subtract(dlen, dev, out=dev)
+        dev **= 2
+        len_m2 = np.bincount(row, weights=dev, minlength=n)
+        del dev, dlen
+        new = np.bincount(row, weights=df["is_new_domain"].to_numpy(float), minlength=n)
+
+    minutes = pd.DataFrame({
+        "device_id": device_id.astype(np.int32),
+        "minute_id": minute + first_minute,
+        "n": count,
+        "len_sum": len_sum,
+        "len_m2": len_m2,
+        "new": new,
+    })
+    cells = pd.DataFrame({"row": cell_row, "domain_id": cell_domain.astype(np.int32), "count": cell_count})
+    return minutes, cells
+
+
+def window_features(minutes: pd.DataFrame, cells: pd.DataFrame, baseline_probs,
+                    size=1, hop=1, epsilon=1e-7):
+    """
+    FEAT_COLS for windows of `size` minutes starting every `hop` minutes
+    (aligned to the epoch), from minute_accumulators output; size == hop
+    is a tumbling window, size > hop a sliding one. Each minute's
+    accumulators are folded into the size // hop windows covering it:
+    counts and domain counts add up, the squared deviations merge pairwise
+    as in detector.merge_moments. qpm is queries per minute, the window's
+    query count over its size.
+    Returns device_id, minute_id (window start) and FEAT_COLS, ordered by
+    device then window.
+    """
+    row_n = minutes["n"].to_numpy()
+    if size == 1 and hop == 1:
+        # a window per minute: the accumulators already are the windows
+        device_id, window_start = minutes["device_id"].to_numpy(), minutes["minute_id"].to_numpy()
+        count = row_n
+        len_sum, len_m2, new = (minutes[c].to_numpy() for c in ("len_sum", "len_m2", "new"))
+        cell_window, cell_domain = cells["row"].to_numpy(), cells["domain_id"].to_numpy()
+        cell_count = cells["count"].to_numpy()
+    else:
+        k = size // hop
+        # row r lies in the windows starting at start[r] - j * hop for j < k,
+        # expanded row-major so row r's windows are slot[r * k:(r + 1) * k]
+        start = minutes["minute_id"].to_numpy() // hop * hop
+        starts = (start[:, None] - hop * np.arange(k)).ravel()
+        first = starts.min()
+        slot, keys = pd.factorize(pair_key(np.repeat(minutes["device_id"].to_numpy(), k), starts - first), sort=True)
+        del starts
+        device_id, window_start = split_key(keys)
+        window_start = window_start + first
+
+        n = len(keys)
+        count = np.bincount(slot, weights=np.repeat(row_n, k), minlength=n).astype(np.int64)
+        len_sum = np.bincount(slot, weights=np.repeat(minutes["len_sum"].to_numpy(), k), minlength=n)
+        row_mean = np.repeat(minutes["len_sum"].to_numpy() / row_n, k)
+        between = np.repeat(row_n, k) * (row_mean - (len_sum / count)[slot]) ** 2
+        len_m2 = np.bincount(slot, weights=np.repeat(minutes["len_m2"].to_numpy(), k) + between, minlength=n)
+        del row_mean, between
+        new = np.bincount(slot, weights=np.repeat(minutes["new"].to_numpy(), k), minlength=n)
+
+        with step("cells"):
+            cell_slot = slot.reshape(-1, k)[cells["row"].to_numpy()].ravel()
+            merged, inverse = np.unique(
+                pair_key(cell_slot, np.repeat(cells["domain_id"].to_numpy(), k)), return_inverse=True,
+            )
+            del cell_slot
+            cell_count = np.bincount(inverse, weights=np.repeat(cells["count"].to_numpy(), k)).astype(np.int64)
+            del inverse
+            cell_window, cell_domain = split_key(merged)
+            del merged
+
+    n = len(device_id)
+    total = np.bincount(cell_window, weights=cell_count, minlength=n)
+    probs = cell_count / total[cell_window]
+
+    with step("kl"):
+        # P(domain | device) for each cell; 0 where the baseline never saw the pair
+        at = baseline_probs.index.get_indexer(pair_key(device_id[cell_window], cell_domain))
+        del cell_domain
+        p_b = baseline_probs.to_numpy()[at]
+        p_b[at < 0] = 0.0
+        del at
+        p_b += epsilon
+        p_t = probs + epsilon
+        # p_t * log(p_t / p_b), in p_b's buffer
+        np.divide(p_t, p_b, out=p_b)
+        np.log(p_b, out=p_b)
+        p_b *= p_t
+        del p_t
+        kl = np.bincount(cell_window, weights=p_b, minlength=n)
+        del p_b
+
+    # cells are sorted by window, so each window's cells are one run
+    starts = np.searchsorted(cell_window, np.arange(n))
+    top = np.maximum.reduceat(cell_count, starts)
+    plogp = np.log2(probs)
+    plogp *= probs
+    entropy = -np.bincount(cell_window, weights=plogp, minlength=n)
+    del plogp, probs
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        len_std = np.sqrt(len_m2 / (count - 1))
+
+    g = pd.DataFrame({
+        "device_id": device_id.astype(np.int32),
+        "minute_id": window_start,
+        # per-minute windows keep the integer count
+        "qpm": count if size == 1 else count / size,
+        "uniq": np.bincount(cell_window, minlength=n),
+        "avg_len": len_sum / count,
+        "len_std": len_std,
+        "top_domain_ratio": top / total,
+        "shannon_entropy": entropy,
+        "new_domain_ratio": new / count,
+        "KL_divergence": kl,
+    })
+    return g.fillna(0)
+
+
+def compute_window_features(df: pd.DataFrame, baseline_probs, epsilon=1e-7):
+    """
+    All FEAT_COLS for each (device_id, minute_id) window of interned
+    queries (see intern_queries).
+    Returns device_id, minute_id and FEAT_COLS, ordered by device then minute.
+    """
+    minutes, cells = minute_accumulators(df)
+    return window_features(minutes, cells, baseline_probs, epsilon=epsilon)
+
+
+def spec_minutes(spec, freq="1min"):
+    """(size, hop) of a WINDOW_SPECS entry in minutes, checked against freq."""
+    unit = pd.Timedelta(freq) // pd.Timedelta("1min")
+    size, hop = (pd.Timedelta(x) // pd.Timedelta("1min") for x in spec)
+    if unit < 1 or hop < unit or hop % unit or size % hop:
+        raise ValueError(f"window {spec} must be a multiple of its hop, and the hop of {freq}")
+    return size, hop
+
+
+def update_spec_windows(minutes, cells, baseline_probs, state, tz=None, freq="1min", batch_mode=False,
+                        commit=None):
+    """
+    Folds one batch of minute accumulators into every WINDOW_SPECS window
+    and appends the windows it completes to WINDOWS[name]. The minutes a
+    still-open window needs are carried over to the next batch
+    (save_window_carry), so a batch only ever adds its own minutes; each
+    spec keeps its own watermark, the start of its newest written window,
+    in state["window_watermarks"]. Batch mode starts every spec over.
+    With a commit (state_manager.Commit) the windows and carry are written
+    through it, to land together with the state.
+    Returns {name: rows written}.
+    """
+    write = commit.write if commit is not None else write_dataset
+    unit = pd.Timedelta(freq) // pd.Timedelta("1min")
+    watermarks = state.setdefault("window_watermarks", {})
+    last = minutes["minute_id"].max()
+    written = {}
+
+    for name, spec in WINDOW_SPECS.items():
+        size, hop = spec_minutes(spec, freq)
+        carry_minutes, carry_cells = (None, None) if batch_mode else load_window_carry(name)
+        if carry_minutes is not None and len(carry_minutes):
+            all_minutes = pd.concat([carry_minutes, minutes], ignore_index=True)
+            all_cells = pd.concat(
+                [carry_cells, cells.assign(row=cells["row"] + len(carry_minutes))], ignore_index=True,
+            )
+        else:
+            all_minutes, all_cells = minutes, cells
+
+        watermark = None if batch_mode else watermarks.get(name)
+        if watermark is not None:
+            after = to_epoch_ns(pd.Series([watermark])).iloc[0] // NS_PER_MINUTE
+        else:
+            # first windows of the spec: start at one the data fills from
+            # its beginning
+            after = all_minutes["minute_id"].min() - 1
+
+        # newest window start whose last minute is in
+        done = (last - size + unit) // hop * hop
+        with step("windows"):
+            g = window_features(all_minutes, all_cells, baseline_probs, size, hop)
+            start = g["minute_id"]
+            g = g[(start <= done) & (start > after)]
+            write(WINDOWS[name], decode_windows(g, tz), mode="overwrite" if batch_mode else "append")
+        written[name] = len(g)
+
+        # a minute is kept while the newest window it falls into is still open
+        keep = all_minutes["minute_id"].to_numpy() // hop * hop > done
+        rows = np.cumsum(keep) - 1
+        cell_keep = keep[all_cells["row"].to_numpy()]
+        save_window_carry(
+            name,
+            all_minutes[keep].reset_index(drop=True),
+            all_cells[cell_keep].assign(row=rows[all_cells["row"].to_numpy()[cell_keep]]).reset_index(drop=True),
+            commit,
+        )
+        if done > after:
+            watermarks[name] = pd.Timestamp(done * NS_PER_MINUTE, tz="UTC").tz_convert(tz)
+
+    return written
 
 
 def get_last_window_minute(state, features_path):
-    if not features_path.exists():
+    if not dataset_exists(features_path):
         return None
     last_ts = state.get("last_window_minute")
     if last_ts is not None:
         return pd.to_datetime(last_ts)
     else:
-        df = pd.read_csv(features_path, parse_dates=["minute"])
+        df = read_dataset(features_path, columns=["minute"])
         if df.empty:
             return None
         return df["minute"].max()
     
-def update_domain_first_seen(state, df_new):
-    if "domain_first_seen" not in state or state["domain_first_seen"] is None:
-        state["domain_first_seen"] = {}
-    domain_first_seen = state.get("domain_first_seen")
-    for idx, row in df_new.iterrows():
-        device, domain, time = row["client_ip"], row["domain"], row["time"]
-        if device not in domain_first_seen:
-            state["domain_first_seen"][device] = {}
-        if domain not in domain_first_seen[device]:
-            state["domain_first_seen"][device][domain] = time    
-    
-    
-def build_windows(src_path=SRC, freq="1min"):
-    df = pd.read_csv(src_path, parse_dates=["time"]).sort_values("time")
-    if df.empty:
-        return pd.DataFrame()
+def build_first_seen(df: pd.DataFrame):
+    """
+    Earliest time each (device, domain) pair appears in interned df, as
+    int64 epoch ns. Returns a Series indexed by pair_key(device_id, domain_id).
+    """
+    first_seen = (
+        pd.Series(to_epoch_ns(df["time"]).to_numpy(), name="first_seen")
+          .groupby(pair_key(df["device_id"], df["domain_id"]), sort=False)
+          .min()
+    )
+    first_seen.index.name = "key"
+    return first_seen
 
+
+def merge_first_seen(first_seen, df_new: pd.DataFrame):
+    """
+    Folds the pairs seen in df_new into an existing first-seen index.
+    Pairs already in the index keep their earlier timestamp.
+    """
+    new = build_first_seen(df_new)
+    if first_seen is None or first_seen.empty:
+        return new
+    return pd.concat([first_seen, new]).groupby(level=0, sort=False).min()
+
+
+def flag_new_domains(df: pd.DataFrame, first_seen):
+    """
+    True for rows whose time is the first time that device queried the domain.
+    """
+    at = first_seen.index.get_indexer(pair_key(df["device_id"], df["domain_id"]))
+    seen = np.where(at >= 0, first_seen.to_numpy()[at], -1)
+    return to_epoch_ns(df["time"]).to_numpy() == seen
+
+
+def read_queries(src_path=SRC, freq="1min", after=None):
+    """
+    Reads the parsed query dataset and adds the window column. When `after`
+    is given only rows in later windows are read; the time filter is pushed
+    down to Parquet so older partitions are never loaded.
+    """
+    since = None
+    if after is not None:
+        since = after + pd.Timedelta(freq)
+    df = read_dataset(src_path, since=since)
+    if df.empty:
+        return pd.DataFrame(columns=["time", "client_ip", "domain", "qtype", "minute"])
     df["minute"] = df["time"].dt.floor(freq)
+    return df
 
-    state = load_state()
+
+@stage("features")
+def update_windows(df_new: pd.DataFrame, state: dict, src_path=SRC, freq="1min"):
+    """
+    Builds the feature rows for df_new, whose windows must all be later than
+    state["last_window_minute"], and folds it into the first-seen index, the
+    baseline counts and OUT. With no watermark (batch mode) all three are
+    rebuilt from df_new.
+    Everything in between runs on interned integer keys (intern_queries);
+    client_ip and minute are decoded again for the rows written to OUT.
+    The same per-minute accumulators also feed the WINDOW_SPECS windows,
+    see update_spec_windows.
+    All of it is written through one Commit with the new watermark, so a
+    run that fails partway can simply be run again.
+    """
+    started = time.perf_counter()
+    commit = Commit()
     last_window_minute = state.get("last_window_minute")
+    tz = df_new["minute"].dt.tz
+    new_minute = df_new["minute"].max()
+    with step("intern"):
+        df_new = intern_queries(df_new)
 
     # BATCH MODE
     if last_window_minute is None:
-        state["domain_first_seen"] = {}
-
-        # initialize domain_first_seen
-        for _, row in df.iterrows():
-            device = row["client_ip"]
-            domain = row["domain"]
-            time = row["time"]
-
-            state["domain_first_seen"].setdefault(device, {})
-            state["domain_first_seen"][device].setdefault(domain, time)
-
-        df["first_seen"] = df.groupby(["client_ip", "domain"])["time"].transform("min")
-        df["is_new_domain"] = df["time"] == df["first_seen"]
-
-        baseline_probs = compute_baseline_probs(df)
-        window_probs = compute_window_probs(df)
-        KL_series = compute_KL_vectorized(window_probs, baseline_probs)
-
-        g = (
-            df.groupby(["client_ip", "minute"])
-              .agg(
-                  qpm=("domain", "count"),
-                  uniq=("domain", "nunique"),
-                  avg_len=("domain", lambda s: s.str.len().mean()),
-                  len_std=("domain", lambda s: s.str.len().std()),
-                  top_domain_ratio=("domain", top_domain_ratio_calc),
-                  shannon_entropy=("domain", shannon_entropy_calc),
-                  new_domain_ratio=("is_new_domain", "mean"),
-              )
-              .reset_index()
-              .fillna(0)
+        first_seen = build_first_seen(df_new)
+        reset_first_seen(first_seen, commit)
+        baseline_counts = None
+
+    # INCREMENTAL MODE
+    else:
+        # only the devices in this batch are read back from the first-seen store
+        known = load_first_seen(devices=df_new["device_id"].unique())
+        first_seen = merge_first_seen(known, df_new)
+        append_first_seen(first_seen[~first_seen.index.isin(known.index)], commit)
+
+        baseline_counts = load_baseline_counts()
+        if baseline_counts is None:
+            # one-time seed for state written before the counts table existed
+            history = read_queries(src_path, freq)
+            history = intern_queries(history[history["minute"] <= last_window_minute])
+            baseline_counts = update_baseline_counts(
+                None, history, None, last_window_minute,
+                half_life=BASELINE_HALF_LIFE, max_domains=BASELINE_MAX_DOMAINS,
+            )
+
+    df_new["is_new_domain"] = flag_new_domains(df_new, first_seen)
+
+    with step("baseline"):
+        baseline_counts = update_baseline_counts(
+            baseline_counts, df_new, last_window_minute, new_minute,
+            half_life=BASELINE_HALF_LIFE, max_domains=BASELINE_MAX_DOMAINS,
         )
+        save_baseline_counts(baseline_counts, commit)
+        baseline_probs = baseline_probs_from_counts(baseline_counts)
 
-        g = g.merge(
-            KL_series.rename("KL_divergence"),
-            on=["client_ip", "minute"],
-            how="left"
-        ).fillna({"KL_divergence": 0})
+    minutes, cells = minute_accumulators(df_new)
+    g_new = window_features(minutes, cells, baseline_probs)
 
-        g.to_csv(OUT, index=False)
+    batch_mode = last_window_minute is None
+    with step("write"):
+        g_new = decode_windows(g_new, tz)
+        commit.write(OUT, g_new, mode="overwrite" if batch_mode else "append")
 
-        state["last_window_minute"] = g["minute"].max()
-        save_state(state)
+    update_spec_windows(minutes, cells, baseline_probs, state, tz, freq, batch_mode, commit)
+    del minutes, cells
 
-        return g
-    
-    # INCREMENTAL MODE
-    df_new = df[df["minute"] > last_window_minute].copy()
-    if df_new.empty:
-        return pd.DataFrame()
+    state["last_window_minute"] = g_new["minute"].max()
+    state["features_version"] = FEATURES_VERSION
+    commit.apply(state)
+
+    devices = set(g_new["client_ip"].astype(str))
+    if not batch_mode:
+        devices.update(load_summary().get("devices") or read_dataset(OUT, columns=["client_ip"])["client_ip"].astype(str))
+    publish(
+        "features", started, rows_in=len(df_new), rows_out=len(g_new),
+        num_feature_rows=running_count("num_feature_rows", OUT, len(g_new), batch_mode),
+        num_devices=len(devices),
+        devices=sorted(devices),
+        last_feature_time=g_new["minute"].max(),
+    )
 
-    state.setdefault("domain_first_seen", {})
-    update_domain_first_seen(state, df_new)
+    return g_new
 
-    df_new["is_new_domain"] = df_new.apply(
-        lambda r: r["time"]
-        == state["domain_first_seen"][r["client_ip"]][r["domain"]],
-        axis=1,
-    )
 
-    baseline_probs = compute_baseline_probs(df)
-    window_probs_new = compute_window_probs(df_new)
-    KL_series_new = compute_KL_vectorized(window_probs_new, baseline_probs)
-
-    g_new = (
-        df_new.groupby(["client_ip", "minute"])
-              .agg(
-                  qpm=("domain", "count"),
-                  uniq=("domain", "nunique"),
-                  avg_len=("domain", lambda s: s.str.len().mean()),
-                  len_std=("domain", lambda s: s.str.len().std()),
-                  top_domain_ratio=("domain", top_domain_ratio_calc),
-                  shannon_entropy=("domain", shannon_entropy_calc),
-                  new_domain_ratio=("is_new_domain", "mean"),
-              )
-              .reset_index()
-              .fillna(0)
-    )
+def needs_rebuild(state: dict):
+    """Whether OUT holds windows built under another FEATURES_VERSION."""
+    return state.get("last_window_minute") is not None and state.get("features_version") != FEATURES_VERSION
 
-    g_new = g_new.merge(
-        KL_series_new.rename("KL_divergence"),
-        on=["client_ip", "minute"],
-        how="left"
-    ).fillna({"KL_divergence": 0})
 
-    g_new.to_csv(OUT, mode="a", header=not OUT.exists(), index=False)
+@stage("features")
+def build_windows(src_path=SRC, freq="1min"):
+    state = load_state()
+    if needs_rebuild(state):
+        # batch mode: everything is rebuilt from the queries still kept
+        state["last_window_minute"] = None
+    last_window_minute = state.get("last_window_minute")
 
-    state["last_window_minute"] = g_new["minute"].max()
-    save_state(state)
+    with step("read"):
+        df = read_queries(src_path, freq, after=last_window_minute)
+    if df.empty:
+        return pd.DataFrame()
 
-    return g_new
+    return update_windows(df, state, src_path, freq)
+
+
+def build_windows_from_batches(batches, freq="1min"):
+    """
+    Same as build_windows but fed from an iterable of query DataFrames (e.g.
+    iter_querylog_batches) so the raw log is never held in memory at once.
+    The newest window of each batch is held back until a later batch shows
+    it is complete. The baseline used for KL grows batch by batch.
+    """
+    state = load_state()
+    if needs_rebuild(state):
+        state["last_window_minute"] = None
+    pending = None
+    outputs = []
+
+    for batch in batches:
+        batch = batch.assign(minute=batch["time"].dt.floor(freq))
+        last_window_minute = state.get("last_window_minute")
+        if last_window_minute is not None:
+            batch = batch[batch["minute"] > last_window_minute]
+        if pending is not None:
+            batch = pd.concat([pending, batch], ignore_index=True)
+        if batch.empty:
+            continue
+
+        batch = batch.sort_values("time")
+        open_minute = batch["minute"].max()
+        pending = batch[batch["minute"] == open_minute]
+        ready = batch[batch["minute"] < open_minute]
+        if not ready.empty:
+            outputs.append(update_windows(ready, state, freq=freq))
+
+    if pending is not None and not pending.empty:
+        outputs.append(update_windows(pending, state, freq=freq))
+
+    if not outputs:
+        return pd.DataFrame()
+    return pd.concat(outputs, ignore_index=True)
 
-        
-    
 
 if __name__ == "__main__":
     print(build_windows().tail())
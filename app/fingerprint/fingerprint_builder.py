@@ -1,8 +1,8 @@
-# input: features.csv, using client_ip, minute, FEAT_COLS columns
-import pandas as pd
+# input: features dataset, using client_ip, minute, FEAT_COLS columns
 import numpy as np
+from app.storage.parquet_store import FEATURES, read_dataset
 
-FEAT = ("data/features.csv")
+FEAT = FEATURES
 
 client_ip = ["client_ip"]
 minute = ["minute"]
@@ -18,4 +18,4 @@ FEAT_COLS = [
     "KL_divergence",
 ]
 
-df = pd.read_csv(FEAT)
\ No newline at end of file
+df = read_dataset(FEAT)
\ No newline at end of file
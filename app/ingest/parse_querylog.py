@@ -1,50 +1,180 @@
+import io
 import json
+import time
+from itertools import islice
 import pandas as pd
+import pyarrow as pa
+import pyarrow.json as pj
+from pandas.api.types import union_categoricals
 from pathlib import Path
-from .state_manager import load_state, save_state
+from .state_manager import load_state, Commit
+from app.storage.parquet_store import DNS, dataset_exists
+from app.storage.summary import load_summary, publish, running_count
+from app.metrics import stage, step
 
-def parse_querylog(path=Path("data/querylog.json")):
-    rows = []
+QUERYLOG = Path("data/querylog.json")
+BATCH_SIZE = 100_000
 
-    with open(path, "r", encoding="utf-8") as f:
-        for line in f:
+# AdGuard querylog key -> our column; every other key is dropped by the reader
+QUERYLOG_FIELDS = {"T": "time", "IP": "client_ip", "QH": "domain", "QT": "qtype"}
+QUERYLOG_SCHEMA = pa.schema([(key, pa.string()) for key in QUERYLOG_FIELDS])
+COLUMNS = list(QUERYLOG_FIELDS.values())
+
+
+def _parse_lines(lines):
+    """
+    Parses a block of querylog lines with pyarrow's JSON reader. A block with
+    a malformed line falls back to json.loads line by line, skipping the bad ones.
+    """
+    data = b"".join(line if line.endswith(b"\n") else line + b"\n" for line in lines)
+    try:
+        table = pj.read_json(
+            io.BytesIO(data),
+            read_options=pj.ReadOptions(block_size=max(len(data), 1 << 20)),
+            parse_options=pj.ParseOptions(
+                explicit_schema=QUERYLOG_SCHEMA,
+                unexpected_field_behavior="ignore",
+            ),
+        )
+    except pa.ArrowInvalid:
+        rows = []
+        for line in lines:
             try:
                 obj = json.loads(line)
             except:
                 continue
+            rows.append({key: obj.get(key) for key in QUERYLOG_FIELDS})
+        table = pa.Table.from_pylist(rows, schema=QUERYLOG_SCHEMA)
+    return table
+
+
+def _parse_times(strings):
+    """
+    ISO timestamps -> datetimes, cast by Arrow and shifted back to the
+    router's UTC offset so the result matches pd.to_datetime. Anything
+    Arrow can't cast goes through pd.to_datetime with errors="coerce".
+    """
+    try:
+        utc = strings.cast(pa.timestamp("ns", tz="UTC"))
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return pd.to_datetime(strings.to_pandas(), errors="coerce")
+
+    times = utc.to_pandas()
+    first = strings.drop_null()
+    offset = pd.Timestamp(first[0].as_py()).tzinfo if len(first) else None
+    if offset is None:
+        return times.dt.tz_localize(None)
+    return times.dt.tz_convert(offset)
+
+
+def _to_frame(table: pa.Table):
+    df = pd.DataFrame({
+        "time": _parse_times(table["T"]),
+        "client_ip": table["IP"].dictionary_encode().to_pandas(),
+        "domain": table["QH"].dictionary_encode().to_pandas(),
+        "qtype": table["QT"].dictionary_encode().to_pandas(),
+    })
+    return df.dropna(subset=["time", "client_ip", "domain"]).reset_index(drop=True)
+
+
+def iter_querylog_batches(path=QUERYLOG, batch_size=BATCH_SIZE, offset=0):
+    """
+    Yields the querylog from byte `offset` on as DataFrames of at most
+    batch_size rows with only time/client_ip/domain/qtype.
+    client_ip, domain and qtype are categoricals.
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while True:
+            chunk = list(islice(f, batch_size))
+            if not chunk:
+                break
+            lines = [line for line in chunk if line.strip()]
+            if not lines:
+                continue
+            with step("parse"):
+                batch = _to_frame(_parse_lines(lines))
+            if not batch.empty:
+                yield batch
 
-            rows.append({
-                "time": obj.get("T"),
-                "client_ip": obj.get("IP"),
-                "domain": obj.get("QH"),
-                "qtype": obj.get("QT")
-            })
 
-    df = pd.DataFrame(rows)
-    df["time"] = pd.to_datetime(df["time"], errors="coerce")
-    df = df.dropna(subset=["time", "client_ip", "domain"])
+def parse_querylog(path=QUERYLOG):
+    batches = list(iter_querylog_batches(path))
+    if not batches:
+        return pd.DataFrame(columns=COLUMNS).astype({"time": "datetime64[ns]"})
+    df = pd.concat(batches, ignore_index=True)
+    # keep the per-batch dictionaries as one categorical instead of decaying to object
+    for col in ("client_ip", "domain", "qtype"):
+        df[col] = union_categoricals([b[col] for b in batches])
     return df
 
-def write_csv(in_path=Path("data/querylog.json"), out_path=Path("data/sample_dns.csv")):
-
-    df_new = parse_querylog(in_path).sort_values("time")
-    state = load_state()
-    last_timestamp = state.get("last_ingested_time")
-    if last_timestamp is not None:
-        last_timestamp = pd.to_datetime(last_timestamp)
-    if not out_path.exists() or last_timestamp is None:
-        df_new.to_csv(out_path, index=False)
-        if not df_new.empty:
-            state["last_ingested_time"] = df_new["time"].max()
-            save_state(state)
-        return out_path
-    df_new = df_new[df_new["time"] > last_timestamp]
-
-    if df_new.empty:
-        return out_path
-    df_new.to_csv(out_path, mode="a", header=False, index=False)
-    new_last = df_new["time"].max()
-    state["last_ingested_time"] = new_last
-    save_state(state)
+def ingest_spool(in_path=QUERYLOG, out_path=DNS):
+    """
+    Appends the queries in the spool past spool_offset to the parsed query
+    dataset (Parquet, see app.storage.parquet_store), yielding each batch
+    as it is written. Queries older than last_ingested_time (logged late)
+    are kept and counted in num_late_rows; dropping the ones whose window
+    was already built is up to the consumer. The batches and the state are
+    only committed (state_manager.Commit) once the generator is exhausted.
+    """
+    with stage("ingest"):
+        started = time.perf_counter()
+        state = load_state()
+        last_timestamp = state.get("last_ingested_time")
+        if last_timestamp is not None:
+            last_timestamp = pd.to_datetime(last_timestamp)
+        fresh = not dataset_exists(out_path) or last_timestamp is None
+
+        # in_path is an append-only spool (see pull_logs); only bytes past
+        # spool_offset are new. One shorter than that was replaced behind our
+        # back, so its overlap with what was ingested can only go by time.
+        offset = 0 if fresh else state.get("spool_offset") or 0
+        replaced = in_path.stat().st_size < offset
+        if replaced:
+            offset = 0
+        end = in_path.stat().st_size
+
+        mode = "overwrite" if fresh else "append"
+        commit = Commit()
+        new_last = None
+        rows_in = rows_out = late = 0
+        for df_new in iter_querylog_batches(in_path, offset=offset):
+            rows_in += len(df_new)
+            df_new = df_new.sort_values("time")
+            if replaced:
+                df_new = df_new[df_new["time"] > last_timestamp]
+            if df_new.empty:
+                continue
+            if not fresh:
+                late += int((df_new["time"] <= last_timestamp).sum())
+            with step("write"):
+                commit.write(out_path, df_new, mode=mode)
+            mode = "append"
+            rows_out += len(df_new)
+            batch_last = df_new["time"].max()
+            new_last = batch_last if new_last is None else max(new_last, batch_last)
+            yield df_new
+
+        # re-read: a consumer may have saved other keys while the batches were out
+        state = {**load_state(), "spool_offset": end}
+        if new_last is not None and (last_timestamp is None or new_last > last_timestamp):
+            state["last_ingested_time"] = new_last
+        commit.apply(state)
+
+        fields = {
+            "num_dns_rows": running_count("num_dns_rows", out_path, rows_out, fresh),
+            "num_late_rows": (0 if fresh else load_summary().get("num_late_rows") or 0) + late,
+        }
+        if state.get("last_ingested_time") is not None:
+            fields["last_ingested_time"] = pd.Timestamp(state["last_ingested_time"])
+        publish("ingest", started, rows_in=rows_in, rows_out=rows_out, **fields)
+
 
+def write_csv(in_path=QUERYLOG, out_path=DNS):
+    """
+    ingest_spool run to the end. The name is kept from when this stage
+    wrote data/sample_dns.csv.
+    """
+    for _ in ingest_spool(in_path, out_path):
+        pass
     return out_path
@@ -1,28 +1,158 @@
 # app/ingest/pull_from_router.py
+import os
+import shlex
 import subprocess
 from pathlib import Path
 
+from .state_manager import load_state, save_state
+from app.metrics import stage
+
 ROUTER_IP = "192.168.8.1"
 REMOTE = "/etc/AdGuardHome/data/querylog.json"
 LOCAL = Path("data/querylog.json")
 IDENTITY = Path.home() / ".ssh" / "id_ed25519"
 
-TAIL_LINES = 20000
+SSH_PREFIX = ["ssh", "-i", str(IDENTITY), f"root@{ROUTER_IP}"]
+
+# cap on bytes fetched per pull; a backlog larger than this is caught up over later pulls
+MAX_PULL_BYTES = 64 * 1024 * 1024
+
+
+class CommandLogSource:
+    """
+    Reads the querylog through shell commands run as `prefix + [command]`.
+    SSH_PREFIX talks to the router; ["sh", "-c"] with busybox="" runs the
+    same commands against a local file, which stands in for the router.
+    """
+
+    def __init__(self, prefix=SSH_PREFIX, busybox="busybox"):
+        self.prefix = list(prefix)
+        self.busybox = busybox
+
+    def _run(self, command: str):
+        result = subprocess.run(self.prefix + [command], capture_output=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"{command!r} failed: {result.stderr.decode(errors='replace')}")
+        return result.stdout
+
+    def _tool(self, name: str):
+        return f"{self.busybox} {name}".strip()
+
+    def stat(self, path: str):
+        """(inode, size) of path, or None if it does not exist."""
+        try:
+            out = self._run(f"{self._tool('stat')} -c '%i %s' {shlex.quote(path)}")
+        except RuntimeError:
+            return None
+        inode, size = out.split()
+        return int(inode), int(size)
+
+    def read(self, path: str, offset: int, length: int):
+        return self._run(
+            f"{self._tool('tail')} -c +{offset + 1} {shlex.quote(path)}"
+            f" | {self._tool('head')} -c {length}"
+        )
+
+
+class LocalLogSource:
+    """
+    Same interface as CommandLogSource over the local filesystem, for
+    running the pull against a fake router log without SSH.
+    """
+
+    def stat(self, path: str):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_size
+
+    def read(self, path: str, offset: int, length: int):
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read(length)
+
+
+def _read_complete_lines(source, path, offset, size, budget):
+    """
+    Reads from offset up to size (at most budget bytes) and drops any
+    trailing partial line so the next pull starts on a line boundary.
+    """
+    length = min(size - offset, budget)
+    if length <= 0:
+        return b""
+    data = source.read(path, offset, length)
+    return data[: data.rfind(b"\n") + 1]
+
+
+def _append_spool(spool: Path, chunks, size=None):
+    """
+    Appends chunks to the spool and returns its new size. Bytes past
+    `size` (the spool_size last saved) come from a pull that failed before
+    saving its offsets, and are cut off first so a retry doesn't add them twice.
+    """
+    spool.parent.mkdir(parents=True, exist_ok=True)
+    with open(spool, "ab") as f:
+        if size is not None and f.tell() > size:
+            f.truncate(size)
+        for chunk in chunks:
+            f.write(chunk)
+        return f.tell()
+
+
+@stage("pull")
+def pull_logs(source=None, spool: Path = LOCAL, remote: str = REMOTE):
+    """
+    Appends the querylog lines written since the last pull to the local spool.
+    The remote inode and byte offset are kept in state.json; when the inode
+    changes or the file shrinks the log has rotated, so the rest of the old
+    file is read from its rotated name before starting the new one at 0.
+    Once ingest has consumed the whole spool (spool_offset at its end) it is
+    emptied first, so it only ever holds what is still to be ingested.
+    """
+    if source is None:
+        source = CommandLogSource()
+    rotated_path = remote + ".1"
+
+    state = load_state()
+    consumed = state.get("spool_offset")
+    if consumed and spool.exists() and consumed >= spool.stat().st_size:
+        # offsets first: if we stop before the truncate, spool_size 0 makes
+        # the next pull do it
+        state["spool_offset"] = state["spool_size"] = 0
+        save_state(state)
+        _append_spool(spool, [], 0)
+
+    inode = state.get("remote_inode")
+    offset = state.get("remote_offset") or 0
 
-def pull_logs():
-    cmd = [
-        "ssh",
-        "-i", str(IDENTITY),
-        f"root@{ROUTER_IP}",
-        f"busybox tail -n 20000 {REMOTE}"
-    ]
+    current = source.stat(remote)
+    if current is None:
+        raise RuntimeError(f"{remote} not found on the log source")
+    current_inode, size = current
 
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    chunks = []
+    budget = MAX_PULL_BYTES
 
-    if result.returncode != 0:
-        raise RuntimeError(f"SSH tail failed: {result.stderr}")
+    if inode is not None and (current_inode != inode or size < offset):
+        rotated = source.stat(rotated_path)
+        if rotated is not None and rotated[0] == inode:
+            rest = _read_complete_lines(source, rotated_path, offset, rotated[1], budget)
+            if rest and rotated[1] - offset > budget:
+                # still catching up on the old file, stay on it for the next pull
+                state["spool_size"] = _append_spool(spool, [rest], state.get("spool_size"))
+                state["remote_offset"] = offset + len(rest)
+                save_state(state)
+                return spool
+            chunks.append(rest)
+            budget -= len(rest)
+        offset = 0
 
-    LOCAL.parent.mkdir(parents=True, exist_ok=True)
-    LOCAL.write_text(result.stdout)
+    data = _read_complete_lines(source, remote, offset, size, budget)
+    chunks.append(data)
+    state["spool_size"] = _append_spool(spool, chunks, state.get("spool_size"))
+    state["remote_inode"] = current_inode
+    state["remote_offset"] = offset + len(data)
+    save_state(state)
 
-    return LOCAL
+    return spool
@@ -1,16 +1,84 @@
 import json
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
+from app.storage.interning import interner, pair_key, split_key
+from app.storage.parquet_store import write_dataset, truncate_partitions, publish_staged, discard_staged
 
 STATE_PATH = Path("data/state.json")
+FIRST_SEEN_DIR = Path("data/first_seen")
+BASELINE_PATH = Path("data/baseline_counts.parquet")
+# per-minute accumulators of windows still open, one pair of files per window spec
+WINDOW_CARRY_DIR = Path("data/window_carry")
+
+TIMESTAMP_KEYS = ("last_ingested_time", "last_window_minute", "last_detected_minute")
+# byte positions for the resumable log pull, see retrieve_logs.pull_logs
+OFFSET_KEYS = ("remote_inode", "remote_offset", "spool_offset", "spool_size")
+
+# merge the append-only parts back into one file once there are this many
+FIRST_SEEN_MAX_PARTS = 32
+
+# devices and domains as their interned codes (app.storage.interning)
+FIRST_SEEN_SCHEMA = pa.schema([
+    ("device_id", pa.int32()),
+    ("domain_id", pa.int32()),
+    ("first_seen", pa.int64()),
+])
+
+BASELINE_SCHEMA = pa.schema([
+    ("device_id", pa.int32()),
+    ("domain_id", pa.int32()),
+    ("count", pa.float64()),
+])
+
+
+def _keyed(frame: pd.DataFrame, value: str):
+    """frame[value] indexed by pair_key(device_id, domain_id)."""
+    key = pd.Index(pair_key(frame["device_id"], frame["domain_id"]), name="key")
+    return pd.Series(frame[value].to_numpy(), index=key, name=value)
+
+
+def _unkeyed(series: pd.Series, schema: pa.Schema):
+    device_id, domain_id = split_key(series.index.to_numpy())
+    return pa.table({
+        "device_id": device_id.astype("int32"),
+        "domain_id": domain_id.astype("int32"),
+        series.name: series.to_numpy().astype(schema.field(series.name).type.to_pandas_dtype()),
+    }, schema=schema)
+
+
+def _intern_frame(frame: pd.DataFrame):
+    """device_id/domain_id for a frame written before the codes existed."""
+    return frame.assign(
+        device_id=interner("client_ip").codes(frame["client_ip"]),
+        domain_id=interner("domain").codes(frame["domain"]),
+    )
+
+
+def to_epoch_ns(times: pd.Series):
+    """
+    Timestamps as int64 nanoseconds since the epoch (UTC for tz-aware input).
+    """
+    times = pd.to_datetime(times)
+    if times.dt.tz is not None:
+        times = times.dt.tz_convert("UTC").dt.tz_localize(None)
+    return times.astype("int64")
 
 
 def load_state():
     """
     {
         "last_ingested_time": pandas.Timestamp or None
+        "last_window_minute": pandas.Timestamp or None
+        "last_detected_minute": pandas.Timestamp or None
+        "remote_inode", "remote_offset", "spool_offset", "spool_size": int or None
+        "window_watermarks": {window spec name: pandas.Timestamp}
+        "features_version": int or None, build_features.FEATURES_VERSION of data/features
     }
+    domain_first_seen lives in FIRST_SEEN_DIR, see load_first_seen.
     """
     if not STATE_PATH.exists():
         return {}
@@ -20,41 +88,360 @@ def load_state():
     except json.JSONDecodeError:
         return {}
 
+    if raw.get("pending"):
+        # a Commit that got past its commit point but not to the end
+        _finish_pending(raw)
+
+    if raw.get("domain_first_seen"):
+        migrate_json_first_seen(raw)
+
     state = {}
 
-    for key in ("last_ingested_time", "last_window_minute"):
+    for key in TIMESTAMP_KEYS:
         ts = raw.get(key)
         state[key] = pd.to_datetime(ts) if ts else None
 
-    # domain_first_seen
-    dfs = raw.get("domain_first_seen", {})
-    parsed = {}
-    for device, domains in dfs.items():
-        parsed[device] = {
-            domain: pd.to_datetime(t)
-            for domain, t in domains.items()
-        }
+    for key in OFFSET_KEYS:
+        state[key] = raw.get(key)
 
-    state["domain_first_seen"] = parsed
+    state["window_watermarks"] = {
+        name: pd.to_datetime(ts) for name, ts in (raw.get("window_watermarks") or {}).items()
+    }
+    state["features_version"] = raw.get("features_version")
 
     return state
 
-def save_state(state: dict):
+def _write_state(raw: dict):
+    STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp = STATE_PATH.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump(raw, f, indent=2)
+    tmp.replace(STATE_PATH)
+
+
+def save_state(state: dict, pending=None):
     out = {}
 
-    for key in ("last_ingested_time", "last_window_minute"):
+    for key in TIMESTAMP_KEYS:
         ts = state.get(key)
         out[key] = ts.isoformat() if ts is not None else None
 
-    dfs = state.get("domain_first_seen", {})
-    out["domain_first_seen"] = {
-        device: {
-            domain: t.isoformat()
-            for domain, t in domains.items()
-        }
-        for device, domains in dfs.items()
+    for key in OFFSET_KEYS:
+        value = state.get(key)
+        out[key] = int(value) if value is not None else None
+
+    out["window_watermarks"] = {
+        name: ts.isoformat() for name, ts in (state.get("window_watermarks") or {}).items()
     }
+    out["features_version"] = state.get("features_version")
+    if pending is not None:
+        out["pending"] = pending
 
-    STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
-    with open(STATE_PATH, "w") as f:
-        json.dump(out, f, indent=2)
\ No newline at end of file
+    _write_state(out)
+    return out
+
+
+def _pending_path(path: Path):
+    return path.with_name(path.name + ".pending")
+
+
+def _finish_pending(raw: dict):
+    """
+    Moves a committed Commit's writes into place and drops it from
+    state.json. Every step can be repeated, so this also finishes one
+    that was cut short halfway.
+    """
+    pending = raw.pop("pending")
+    for path in pending.get("removed", []):
+        Path(path).unlink(missing_ok=True)
+    for path in pending.get("files", []):
+        staged = _pending_path(Path(path))
+        if staged.exists():
+            staged.replace(path)
+    for path in pending.get("datasets", []):
+        publish_staged(Path(path))
+    _write_state(raw)
+
+
+class Commit:
+    """
+    One stage's writes, held back until apply() saves them together with
+    the stage's new state. Datasets are written staged (see
+    parquet_store.publish_staged) and files next to their target with a
+    .pending suffix. apply() saves state.json listing them (the commit
+    point) and then moves them in; load_state finishes that move if it was
+    cut short. A run that fails before apply() leaves nothing behind that
+    readers or its retry would see, so stages can be retried.
+    """
+
+    def __init__(self):
+        self.datasets = []
+        self.files = []
+        self.removed = []
+
+    def _dataset(self, path: Path):
+        if path not in self.datasets:
+            # whatever a failed run staged there is not ours
+            discard_staged(path)
+            self.datasets.append(path)
+
+    def write(self, path: Path, df: pd.DataFrame, mode="append"):
+        self._dataset(path)
+        return write_dataset(path, df, mode=mode, staged=True)
+
+    def truncate(self, path: Path, since: str):
+        self._dataset(path)
+        return truncate_partitions(path, since, staged=True)
+
+    def file(self, path: Path):
+        """Where to write what becomes path on apply()."""
+        if path in self.removed:
+            self.removed.remove(path)
+        if path not in self.files:
+            self.files.append(path)
+        return _pending_path(path)
+
+    def remove(self, path: Path):
+        if path not in self.files and path not in self.removed:
+            self.removed.append(path)
+
+    def apply(self, state: dict):
+        pending = {
+            "datasets": [str(p) for p in self.datasets],
+            "files": [str(p) for p in self.files],
+            "removed": [str(p) for p in self.removed],
+        }
+        _finish_pending(save_state(state, pending))
+
+
+def _first_seen_parts():
+    if not FIRST_SEEN_DIR.exists():
+        return []
+    return sorted(FIRST_SEEN_DIR.glob("part-*.parquet"))
+
+
+def _write_first_seen_part(first_seen: pd.Series, path: Path, commit=None):
+    table = _unkeyed(first_seen.rename("first_seen"), FIRST_SEEN_SCHEMA)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    pq.write_table(table, tmp)
+    tmp.replace(commit.file(path) if commit is not None else path)
+
+
+def _migrate_first_seen(parts):
+    """Rewrites parts keyed by client_ip/domain strings with their codes."""
+    frame = _intern_frame(pq.read_table(parts).to_pandas())
+    first_seen = _keyed(frame, "first_seen").groupby(level=0, sort=False).min()
+    for part in parts:
+        part.unlink()
+    _write_first_seen_part(first_seen, FIRST_SEEN_DIR / "part-00000.parquet")
+
+
+def load_first_seen(devices=None):
+    """
+    Reads the (device, domain) -> first_seen index, optionally only for
+    the given device codes. Returns a Series of int64 epoch ns indexed by
+    pair_key(device_id, domain_id).
+    """
+    parts = _first_seen_parts()
+    if parts and "client_ip" in pq.read_schema(parts[0]).names:
+        _migrate_first_seen(parts)
+        parts = _first_seen_parts()
+    if not parts:
+        return pd.Series([], index=pd.Index([], dtype="int64", name="key"), dtype="int64", name="first_seen")
+
+    filters = None
+    if devices is not None:
+        filters = [("device_id", "in", [int(d) for d in devices])]
+    table = pq.read_table(parts, filters=filters, schema=FIRST_SEEN_SCHEMA)
+    first_seen = _keyed(table.to_pandas(), "first_seen")
+    if len(parts) > 1:
+        first_seen = first_seen.groupby(level=0, sort=False).min()
+    return first_seen
+
+
+def append_first_seen(first_seen: pd.Series, commit=None):
+    """
+    Appends newly seen pairs as a new part file; existing parts are never rewritten
+    except by compact_first_seen, which runs first once there are too many.
+    """
+    if first_seen.empty:
+        return
+    parts = _first_seen_parts()
+    if len(parts) >= FIRST_SEEN_MAX_PARTS:
+        compact_first_seen()
+        parts = _first_seen_parts()
+    n = int(parts[-1].stem.split("-")[1]) + 1 if parts else 0
+    _write_first_seen_part(first_seen, FIRST_SEEN_DIR / f"part-{n:05d}.parquet", commit)
+
+
+def reset_first_seen(first_seen: pd.Series, commit=None):
+    """
+    Replaces the whole index, used by the batch rebuild.
+    """
+    for part in _first_seen_parts():
+        if commit is not None:
+            commit.remove(part)
+        else:
+            part.unlink()
+    if not first_seen.empty:
+        _write_first_seen_part(first_seen, FIRST_SEEN_DIR / "part-00000.parquet", commit)
+
+
+def compact_first_seen():
+    parts = _first_seen_parts()
+    if len(parts) <= 1:
+        return
+    merged = load_first_seen()
+    _write_first_seen_part(merged, FIRST_SEEN_DIR / "part-00000.parquet")
+    for part in parts[1:]:
+        part.unlink()
+
+
+def migrate_json_first_seen(raw: dict):
+    """
+    One-time move of the nested domain_first_seen dict from state.json into
+    FIRST_SEEN_DIR. state.json is rewritten without it.
+    """
+    rows = [
+        (device, domain, t)
+        for device, domains in raw["domain_first_seen"].items()
+        for domain, t in domains.items()
+    ]
+    pairs = pd.DataFrame(rows, columns=["client_ip", "domain", "first_seen"])
+    pairs["first_seen"] = to_epoch_ns(pd.to_datetime(pairs["first_seen"], utc=True))
+    first_seen = _keyed(_intern_frame(pairs), "first_seen").groupby(level=0, sort=False).min()
+
+    reset_first_seen(first_seen)
+
+    _write_state({k: v for k, v in raw.items() if k != "domain_first_seen"})
+
+
+def load_baseline_counts():
+    """
+    Per-device domain counts behind the KL baseline.
+    Returns a float Series indexed by pair_key(device_id, domain_id), or
+    None if the table has not been written yet.
+    """
+    if not BASELINE_PATH.exists():
+        return None
+    table = pq.read_table(BASELINE_PATH)
+    if "client_ip" in table.column_names:
+        # written before the codes existed
+        counts = _keyed(_intern_frame(table.to_pandas()), "count")
+        save_baseline_counts(counts)
+        return counts
+    return _keyed(table.to_pandas(), "count")
+
+
+def save_baseline_counts(counts: pd.Series, commit=None):
+    table = _unkeyed(counts.rename("count"), BASELINE_SCHEMA)
+    BASELINE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp = BASELINE_PATH.with_suffix(".tmp")
+    pq.write_table(table, tmp)
+    tmp.replace(commit.file(BASELINE_PATH) if commit is not None else BASELINE_PATH)
+
+
+def forget_devices(devices):
+    """
+    Drops the first-seen pairs and baseline counts of the given device
+    codes, for devices retention has expired. One that shows up again
+    starts over as if never seen.
+    """
+    devices = list(devices)
+    if not devices:
+        return
+    first_seen = load_first_seen()
+    gone = np.isin(split_key(first_seen.index.to_numpy())[0], devices)
+    if gone.any():
+        reset_first_seen(first_seen[~gone])
+
+    counts = load_baseline_counts()
+    if counts is not None:
+        gone = np.isin(split_key(counts.index.to_numpy())[0], devices)
+        if gone.any():
+            save_baseline_counts(counts[~gone])
+
+
+def _window_carry_names():
+    """
+    The specs with a window carry saved, leaving out any with only one of
+    its two files (save_window_carry stopped between them), which
+    load_window_carry treats as none.
+    """
+    if not WINDOW_CARRY_DIR.exists():
+        return []
+    return sorted(
+        p.name[:-len(".minutes.parquet")] for p in WINDOW_CARRY_DIR.glob("*.minutes.parquet")
+        if p.with_name(p.name.replace(".minutes.", ".cells.")).exists()
+    )
+
+
+def compact_codes():
+    """
+    Renumbers the client_ip and domain dictionaries (app.storage.interning)
+    down to the codes the first-seen index, the baseline counts and the
+    window carry still hold, and rewrites those with the new codes, all in
+    one Commit. Without it the dictionaries keep every device and domain
+    ever seen, expired ones included.
+    Returns {dictionary name: codes dropped}.
+    """
+    first_seen = load_first_seen()
+    counts = load_baseline_counts()
+    carry = {name: load_window_carry(name) for name in _window_carry_names()}
+
+    keys = [first_seen.index.to_numpy()]
+    if counts is not None:
+        keys.append(counts.index.to_numpy())
+    devices, domains = split_key(np.concatenate(keys))
+    devices = np.concatenate([devices, *(m["device_id"].to_numpy() for m, _ in carry.values())])
+    domains = np.concatenate([domains, *(c["domain_id"].to_numpy() for _, c in carry.values())])
+
+    tables = {"client_ip": (interner("client_ip"), devices), "domain": (interner("domain"), domains)}
+    dropped = {name: len(table) - len(np.unique(used)) for name, (table, used) in tables.items()}
+    if not any(dropped.values()):
+        return dropped
+
+    commit = Commit()
+    device_map = tables["client_ip"][0].compact(devices, commit)
+    domain_map = tables["domain"][0].compact(domains, commit)
+
+    def remap(series):
+        device_id, domain_id = split_key(series.index.to_numpy())
+        key = pd.Index(pair_key(device_map[device_id], domain_map[domain_id]), name="key")
+        return pd.Series(series.to_numpy(), index=key, name=series.name)
+
+    reset_first_seen(remap(first_seen), commit)
+    if counts is not None:
+        save_baseline_counts(remap(counts), commit)
+    for name, (minutes, cells) in carry.items():
+        save_window_carry(
+            name,
+            minutes.assign(device_id=device_map[minutes["device_id"].to_numpy()]),
+            cells.assign(domain_id=domain_map[cells["domain_id"].to_numpy()]),
+            commit,
+        )
+    commit.apply(load_state())
+    for table, _ in tables.values():
+        table.drop_old_epochs()
+    return dropped
+
+
+def load_window_carry(name: str):
+    """
+    The (minutes, cells) accumulators saved for window spec `name` by
+    save_window_carry, or (None, None).
+    """
+    minutes, cells = WINDOW_CARRY_DIR / f"{name}.minutes.parquet", WINDOW_CARRY_DIR / f"{name}.cells.parquet"
+    if not minutes.exists() or not cells.exists():
+        return None, None
+    return pq.read_table(minutes).to_pandas(), pq.read_table(cells).to_pandas()
+
+
+def save_window_carry(name: str, minutes: pd.DataFrame, cells: pd.DataFrame, commit=None):
+    WINDOW_CARRY_DIR.mkdir(parents=True, exist_ok=True)
+    for kind, frame in (("minutes", minutes), ("cells", cells)):
+        path = WINDOW_CARRY_DIR / f"{name}.{kind}.parquet"
+        tmp = path.with_suffix(".tmp")
+        pq.write_table(pa.Table.from_pandas(frame, preserve_index=False), tmp)
+        tmp.replace(commit.file(path) if commit is not None else path)
@@ -0,0 +1,125 @@
+import json
+import os
+import time
+from pathlib import Path
+
+REFRESH_LOCK_KEY = "guardian_aigis:refresh_lock"
+REFRESH_LOCK_PATH = Path("data/refresh.lock")
+
+
+class LockLost(RuntimeError):
+    """The lock expired under its holder and may have been taken since."""
+
+
+class FileLock:
+    """
+    Lock held by whoever created `path`, with an expiry so a crashed holder
+    doesn't keep it forever. Good enough for one machine.
+    """
+
+    def __init__(self, path: Path = REFRESH_LOCK_PATH):
+        self.path = path
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def acquire(self, token: str, ttl: float):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        for _ in range(2):
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                held = self._read()
+                if held is not None and held["expires"] > time.time():
+                    return False
+                # expired (or half written by a crashed holder): take it over
+                self.path.unlink(missing_ok=True)
+                continue
+            with os.fdopen(fd, "w") as f:
+                json.dump({"token": token, "expires": time.time() + ttl}, f)
+            return True
+        return False
+
+    def renew(self, token: str, ttl: float):
+        """
+        Moves the expiry to ttl from now if token still holds the lock.
+        Returns False if it doesn't (anymore), expired included.
+        """
+        held = self._read()
+        if held is None or held["token"] != token or held["expires"] <= time.time():
+            return False
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"token": token, "expires": time.time() + ttl}, f)
+        tmp.replace(self.path)
+        return True
+
+    def holder(self):
+        held = self._read()
+        if held is None or held["expires"] <= time.time():
+            return None
+        return held["token"]
+
+    def release(self, token: str):
+        held = self._read()
+        if held is not None and held["token"] == token:
+            self.path.unlink(missing_ok=True)
+
+
+class RedisLock:
+    """
+    Same interface as FileLock on a Redis key (SET NX EX), for workers on
+    more than one machine.
+    """
+
+    # delete the key only if it still holds our token
+    RELEASE = """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("del", KEYS[1])
+    end
+    return 0
+    """
+
+    # reset the expiry only if the key still holds our token
+    RENEW = """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("expire", KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+
+    def __init__(self, client, key: str = REFRESH_LOCK_KEY):
+        self.client = client
+        self.key = key
+
+    def acquire(self, token: str, ttl: float):
+        return bool(self.client.set(self.key, token, nx=True, ex=int(ttl)))
+
+    def renew(self, token: str, ttl: float):
+        return bool(self.client.eval(self.RENEW, 1, self.key, token, int(ttl)))
+
+    def holder(self):
+        token = self.client.get(self.key)
+        return token.decode() if isinstance(token, bytes) else token
+
+    def release(self, token: str):
+        self.client.eval(self.RELEASE, 1, self.key, token)
+
+
+def refresh_lock(url: str | None = None):
+    """
+    RedisLock on `url` when it is a redis:// URL and redis-py is installed,
+    FileLock otherwise.
+    """
+    if url and url.startswith("redis://"):
+        try:
+            import redis
+        except ImportError:
+            redis = None
+        if redis is not None:
+            return RedisLock(redis.Redis.from_url(url))
+    return FileLock()
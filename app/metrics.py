@@ -0,0 +1,232 @@
+import os
+import time
+import cProfile
+import resource
+import threading
+import pandas as pd
+from pathlib import Path
+from contextlib import contextmanager
+
+from app.storage.summary import load_summary, record_metrics
+
+# set to a directory to dump a cProfile of every stage run there, e.g.
+# GUARDIAN_PROFILE_DIR=data/profiles celery -A app.celery_app worker
+PROFILE_DIR = os.environ.get("GUARDIAN_PROFILE_DIR")
+
+# measurements open in this thread, outermost (the stage) first
+_local = threading.local()
+
+
+def _peak_rss():
+    """Peak RSS of the process in bytes since the last _reset_peak()."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # no /proc: the lifetime peak is the best there is
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _reset_peak():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _io():
+    """
+    Bytes the process has read and written so far, page cache hits and
+    sockets included (rchar/wchar), or None without /proc.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(":") for line in f)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _start():
+    stack = getattr(_local, "stack", [])
+    # the peak reset below would lose what the open measurements reached so far
+    peak = _peak_rss()
+    for m in stack:
+        m["peak"] = max(m["peak"], peak)
+    _reset_peak()
+    return {
+        "wall0": time.perf_counter(),
+        "cpu0": time.process_time(),
+        "io0": _io(),
+        "peak": 0,
+        "steps": {},
+    }
+
+
+def _finish(m):
+    m["peak"] = max(m["peak"], _peak_rss())
+    out = {
+        "wall_s": round(time.perf_counter() - m["wall0"], 4),
+        "cpu_s": round(time.process_time() - m["cpu0"], 4),
+        "peak_rss_bytes": m["peak"],
+    }
+    io = _io()
+    if io is not None and m["io0"] is not None:
+        out["read_bytes"] = io[0] - m["io0"][0]
+        out["written_bytes"] = io[1] - m["io0"][1]
+    return out
+
+
+@contextmanager
+def step(name: str):
+    """
+    Times a sub-step of the stage running in this thread (wall and CPU
+    time, peak RSS, bytes read/written). A step that runs more than once
+    per stage adds up. Does nothing outside a stage.
+    """
+    stack = getattr(_local, "stack", None)
+    if not stack:
+        yield
+        return
+
+    m = _start()
+    stack.append(m)
+    try:
+        yield
+    finally:
+        stack.pop()
+        out = _finish(m)
+        parent = stack[-1]
+        parent["peak"] = max(parent["peak"], out["peak_rss_bytes"])
+        seen = parent["steps"].get(name)
+        if seen is None:
+            parent["steps"][name] = {**out, "calls": 1}
+        else:
+            for key in ("wall_s", "cpu_s", "read_bytes", "written_bytes"):
+                if key in out:
+                    seen[key] = round(seen.get(key, 0) + out[key], 4)
+            seen["peak_rss_bytes"] = max(seen["peak_rss_bytes"], out["peak_rss_bytes"])
+            seen["calls"] += 1
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Measures a pipeline stage and stores the numbers with the stage's
+    summary entry (see summary.record_metrics), where /metrics and the
+    refresh task results pick them up. Inside another stage it is a step
+    of that one, or nothing if it is the same stage entered again (e.g.
+    build_windows -> update_windows). With PROFILE_DIR set, the stage runs
+    under cProfile and the dump's path is stored too.
+    """
+    stack = getattr(_local, "stack", None)
+    if stack:
+        if stack[0]["name"] == name:
+            yield
+        else:
+            with step(name):
+                yield
+        return
+
+    profiler = None
+    if PROFILE_DIR:
+        profiler = cProfile.Profile()
+    m = _start()
+    m["name"] = name
+    _local.stack = [m]
+    ok = False
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+        ok = True
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        _local.stack = []
+        metrics = _finish(m)
+        metrics["steps"] = m["steps"]
+        if profiler is not None:
+            path = Path(PROFILE_DIR)
+            path.mkdir(parents=True, exist_ok=True)
+            path = path / f"{name}-{pd.Timestamp.now('UTC').strftime('%Y%m%dT%H%M%S%f')}.prof"
+            profiler.dump_stats(path)
+            metrics["profile"] = str(path)
+        record_metrics(name, metrics, ok)
+
+
+def stage_metrics(names):
+    """The summary entries of the named stages, for task results."""
+    stages = load_summary().get("stages", {})
+    return {name: stages[name] for name in names if name in stages}
+
+
+# (metric, stage entry key, help); all per stage, from its last run
+STAGE_GAUGES = [
+    ("guardian_stage_duration_seconds", "wall_s", "Wall time of the stage's last run."),
+    ("guardian_stage_cpu_seconds", "cpu_s", "CPU time of the stage's last run."),
+    ("guardian_stage_rows_in", "rows_in", "Rows the stage's last run read."),
+    ("guardian_stage_rows_out", "rows_out", "Rows the stage's last run wrote."),
+    ("guardian_stage_peak_rss_bytes", "peak_rss_bytes", "Peak RSS during the stage's last run."),
+    ("guardian_stage_read_bytes", "read_bytes", "Bytes read during the stage's last run."),
+    ("guardian_stage_written_bytes", "written_bytes", "Bytes written during the stage's last run."),
+]
+STEP_GAUGES = [
+    ("guardian_step_duration_seconds", "wall_s", "Wall time of a sub-step in its stage's last run."),
+    ("guardian_step_cpu_seconds", "cpu_s", "CPU time of a sub-step in its stage's last run."),
+    ("guardian_step_peak_rss_bytes", "peak_rss_bytes", "Peak RSS during a sub-step in its stage's last run."),
+]
+STAGE_COUNTERS = [
+    ("guardian_stage_runs_total", "runs", "Stage runs."),
+    ("guardian_stage_failures_total", "failures", "Stage runs that raised."),
+    ("guardian_stage_seconds_total", "wall_s", "Wall time spent in the stage."),
+    ("guardian_stage_cpu_seconds_total", "cpu_s", "CPU time spent in the stage."),
+]
+# summary fields exported as-is
+SUMMARY_GAUGES = [
+    ("guardian_dns_rows", "num_dns_rows", "Rows in the parsed query dataset."),
+    ("guardian_feature_rows", "num_feature_rows", "Rows in the feature dataset."),
+    ("guardian_history_rows", "num_history_rows", "Rows in the anomaly history."),
+    ("guardian_late_rows", "num_late_rows", "Queries ingested after newer ones already were."),
+    ("guardian_devices", "num_devices", "Devices with feature windows."),
+    ("guardian_highest_anomaly_score", "highest_anomaly_score", "Highest combined score among the latest alerts."),
+]
+
+
+def _family(lines, name, kind, help, samples):
+    samples = [(labels, value) for labels, value in samples if value is not None]
+    if not samples:
+        return
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} {kind}")
+    for labels, value in samples:
+        label = ",".join(f'{k}="{v}"' for k, v in labels.items())
+        lines.append(f"{name}{{{label}}} {value}" if label else f"{name} {value}")
+
+
+def prometheus_text(summary: dict):
+    """The summary in the Prometheus text exposition format."""
+    lines = []
+    stages = summary.get("stages", {})
+    totals = summary.get("stage_totals", {})
+
+    for name, key, help in STAGE_GAUGES:
+        _family(lines, name, "gauge", help, [({"stage": s}, e.get(key)) for s, e in stages.items()])
+    _family(lines, "guardian_stage_last_finished_timestamp_seconds", "gauge", "When the stage last finished.", [
+        ({"stage": s}, pd.Timestamp(e["finished_at"]).timestamp())
+        for s, e in stages.items() if e.get("finished_at")
+    ])
+    for name, key, help in STEP_GAUGES:
+        _family(lines, name, "gauge", help, [
+            ({"stage": s, "step": step}, m.get(key))
+            for s, e in stages.items() for step, m in e.get("steps", {}).items()
+        ])
+    for name, key, help in STAGE_COUNTERS:
+        _family(lines, name, "counter", help, [({"stage": s}, t.get(key)) for s, t in totals.items()])
+    for name, key, help in SUMMARY_GAUGES:
+        _family(lines, name, "gauge", help, [({}, summary.get(key))])
+    return "\n".join(lines) + "\n"
@@ -1,13 +1,43 @@
+import os
+import time
 import pandas as pd
 import numpy as np
+import joblib
+from joblib import Parallel, delayed
 from sklearn.ensemble import IsolationForest
-from sklearn.decomposition import PCA
+from sklearn.decomposition import IncrementalPCA
 from pathlib import Path
+from app.storage.parquet_store import FEATURES, ALERTS, ANOMALY_HISTORY, read_dataset, write_dataset, dataset_exists
+from app.ingest.state_manager import load_state, Commit
+from app.storage.summary import publish, running_count
+from app.storage.events import emit_alerts
+from app.storage.rollups import update_rollups, SCORE_COLS
+from app.metrics import stage, step
 
-FEAT = Path("data/features.csv")
-ALERTS = Path("data/alerts.csv")
+FEAT = FEATURES
 MIN_HISTORY = 2
 
+MODELS_DIR = Path("data/models")
+# score normalization bounds and the PCA projection, shared by all devices
+SHARED_MODEL = MODELS_DIR / "shared.joblib"
+# running Mahalanobis moments of every device, updated on each detect
+MOMENTS = MODELS_DIR / "moments.joblib"
+# bump when FEAT_COLS or the model setup changes; older artifacts get refit
+MODEL_VERSION = 4
+# refit a device once its model is this much older than its newest window
+REFIT_EVERY = pd.Timedelta("1h")
+# ... or when the mean score of its new windows moves this many training stds
+DRIFT_Z = 3.0
+# worker processes for per-device fits (1 fits in-process), see detect_jobs
+DETECT_JOBS_ENV = "GUARDIAN_DETECT_JOBS"
+# devices are packed into tasks of at least this many windows so small
+# devices don't each pay a dispatch to a worker
+CHUNK_ROWS = 5000
+# rows per step in mahalanobis_batch, bounds the gathered inverse covariances
+BATCH_ROWS = 4096
+# rows per partial_fit step when the PCA is fit on the whole history
+PCA_BATCH = 10_000
+
 FEAT_COLS = [
     "qpm",
     "uniq",
@@ -19,71 +49,249 @@ FEAT_COLS = [
     "KL_divergence",
 ]
 
+def mahalanobis_moments(X: np.ndarray):
+    """
+    Count, mean and M2 (sum of outer products of deviations from the mean)
+    of X's rows. Moments of separate batches combine with merge_moments.
+    """
+    X = np.asarray(X, dtype=float)
+    mean = X.mean(axis=0)
+    diff = X - mean
+    return {"n": len(X), "mean": mean, "M2": diff.T @ diff}
+
+
+def merge_moments(a: dict, b: dict):
+    """
+    Pairwise update (Chan et al.) of two sets of moments. Folding new
+    windows into a device's moments costs O(rows) instead of a refit.
+    """
+    n = a["n"] + b["n"]
+    delta = b["mean"] - a["mean"]
+    return {
+        "n": n,
+        "mean": a["mean"] + delta * (b["n"] / n),
+        "M2": a["M2"] + b["M2"] + np.outer(delta, delta) * (a["n"] * b["n"] / n),
+    }
+
+
+def moments_inverse(moments: dict):
+    cov = moments["M2"] / (moments["n"] - 1)
+    cov += np.eye(cov.shape[0]) * 1e-9
+    return moments["mean"], np.linalg.pinv(cov)
+
+
+def mahalanobis_fit(X: np.ndarray):
+    return moments_inverse(mahalanobis_moments(X))
+
+
+def mahalanobis_score(X: np.ndarray, mu, inv_cov):
+    diff = np.asarray(X, dtype=float) - mu
+    d2 = np.einsum("ij,ij->i", diff @ inv_cov, diff)
+    return np.sqrt(np.maximum(d2, 0.0))
+
+
+def mahalanobis_batch(X: np.ndarray, codes: np.ndarray, mus: np.ndarray, inv_covs: np.ndarray):
+    """
+    Mahalanobis distance of every row of X against the device in `codes`,
+    with mus (devices x features) and inv_covs (devices x features x features)
+    stacked, so any number of devices is scored in one pass.
+    """
+    diff = np.asarray(X, dtype=float) - mus[codes]
+    out = np.empty(len(diff))
+    for start in range(0, len(diff), BATCH_ROWS):
+        sl = slice(start, start + BATCH_ROWS)
+        proj = np.einsum("ij,ijk->ik", diff[sl], inv_covs[codes[sl]])
+        out[sl] = np.einsum("ij,ij->i", proj, diff[sl])
+    return np.sqrt(np.maximum(out, 0.0))
+
+
 def Mahalanobis_dist(grp: pd.DataFrame, feat_cols: list[str]):
     X = grp[feat_cols].to_numpy()
     if len(X) < 2:
         return pd.Series(0.0, index=grp.index)
 
-    mu = X.mean(axis=0)
-    cov = np.cov(X, rowvar=False)
-    cov += np.eye(cov.shape[0]) * 1e-9
-    inv_cov = np.linalg.pinv(cov)
+    mu, inv_cov = mahalanobis_fit(X)
+    return pd.Series(mahalanobis_score(X, mu, inv_cov), index=grp.index)
 
-    dists = []
-    for x in X:
-        diff = x - mu
-        d2 = diff.T @ inv_cov @ diff
-        dists.append(float(np.sqrt(max(d2, 0.0))))
 
-    return pd.Series(dists, index=grp.index)
+def _orient(pca, previous=None):
+    """
+    Pins the sign of each component: pointing the same way as `previous`,
+    or for a fresh fit with its largest loading positive.
+    """
+    comps = pca.components_
+    if previous is None:
+        signs = np.sign(comps[np.arange(len(comps)), np.abs(comps).argmax(axis=1)])
+    else:
+        signs = np.sign(np.sum(comps * previous, axis=1))
+    signs[signs == 0] = 1
+    pca.components_ = comps * signs[:, None]
 
 
-def add_pca(history_df: pd.DataFrame, feat_cols: list[str]):
-    pca = PCA(n_components=2, random_state=0)
-    X = history_df[feat_cols].to_numpy()
+def add_pca(history_df: pd.DataFrame, feat_cols: list[str], pca=None, update=False):
+    """
+    Adds pc1/pc2. Fits a new IncrementalPCA on history_df unless one is
+    passed in; update=True first folds history_df into the passed one with
+    partial_fit. Component signs are pinned so pc1/pc2 don't flip between
+    runs. Returns the PCA used.
+    """
+    X = history_df[feat_cols].to_numpy(dtype=float)
     X = np.nan_to_num(X)
-    pcs = pca.fit_transform(X)
+    if pca is None:
+        pca = IncrementalPCA(n_components=2, batch_size=PCA_BATCH).fit(X)
+        _orient(pca)
+    elif update and len(X) >= pca.n_components_:
+        previous = pca.components_.copy()
+        pca.partial_fit(X)
+        _orient(pca, previous)
+    pcs = pca.transform(X)
     history_df["pc1"] = pcs[:, 0]
     history_df["pc2"] = pcs[:, 1]
+    return pca
 
 
-def detect(features_path=FEAT):
-    if not features_path.exists():
-        return pd.DataFrame()
+def _model_path(device):
+    return MODELS_DIR / f"{str(device).replace(':', '_')}.joblib"
 
-    df = pd.read_csv(features_path, parse_dates=["minute"])
-    if df.empty:
-        return pd.DataFrame()
 
-    history_parts = []
+def _dump(obj, path: Path, commit=None):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    joblib.dump(obj, tmp)
+    tmp.replace(commit.file(path) if commit is not None else path)
 
-    for device, grp in df.groupby("client_ip"):
-        if len(grp) < MIN_HISTORY:
-            continue
 
-        grp = grp.sort_values("minute").copy()
-        X = grp[FEAT_COLS].astype(float).to_numpy()
+def load_device_model(device):
+    path = _model_path(device)
+    if not path.exists():
+        return None
+    return joblib.load(path)
 
-        model = IsolationForest(
-            contamination="auto",
-            random_state=0
-        ).fit(X)
 
-        grp["score"] = -model.score_samples(X)
-        grp["Mahalanobis"] = Mahalanobis_dist(grp, FEAT_COLS)
+def save_device_model(device, artifact: dict, commit=None):
+    _dump(artifact, _model_path(device), commit)
 
-        history_parts.append(grp)
 
-    if not history_parts:
-        return pd.DataFrame()
+def fit_device_model(grp: pd.DataFrame, revision=0):
+    """
+    IsolationForest + Mahalanobis moments for one device's windows.
+    The moments are popped off into MOMENTS before the artifact is saved.
+    """
+    X = grp[FEAT_COLS].astype(float).to_numpy()
+    model = IsolationForest(
+        contamination="auto",
+        random_state=0
+    ).fit(X)
+    train_scores = -model.score_samples(X)
+    moments = mahalanobis_moments(X)
+    moments["inv_cov"] = moments_inverse(moments)[1]
+    return {
+        "version": MODEL_VERSION,
+        "revision": revision,
+        "fitted_at": grp["minute"].max(),
+        "n_train": len(X),
+        "model": model,
+        "moments": moments,
+        "score_mean": float(train_scores.mean()),
+        "score_std": float(train_scores.std()),
+    }
 
-    history_df = pd.concat(history_parts, ignore_index=True)
 
+def score_device(artifact: dict, grp: pd.DataFrame):
+    X = grp[FEAT_COLS].astype(float).to_numpy()
+    grp["score"] = -artifact["model"].score_samples(X)
+    moments = artifact["moments"]
+    grp["Mahalanobis"] = mahalanobis_score(X, moments["mean"], moments["inv_cov"])
+    return grp
 
+
+def load_moments():
+    if not MOMENTS.exists():
+        return {}
+    return joblib.load(MOMENTS)
+
+
+def update_moments(moments: dict, X: np.ndarray):
+    moments = merge_moments(moments, mahalanobis_moments(X))
+    moments["inv_cov"] = moments_inverse(moments)[1]
+    return moments
+
+
+def score_mahalanobis(frames, moments: dict):
+    """
+    Adds Mahalanobis to (device, windows) frames against each device's
+    current moments, all devices in one mahalanobis_batch call.
+    Returns the frames concatenated.
+    """
+    df = pd.concat([grp for _, grp in frames], ignore_index=True)
+    codes = np.repeat(np.arange(len(frames)), [len(grp) for _, grp in frames])
+    mus = np.stack([moments[device]["mean"] for device, _ in frames])
+    inv_covs = np.stack([moments[device]["inv_cov"] for device, _ in frames])
+    X = df[FEAT_COLS].astype(float).to_numpy()
+    df["Mahalanobis"] = mahalanobis_batch(X, codes, mus, inv_covs)
+    return df
+
+
+def _fit_chunk(jobs):
+    results = []
+    for device, train, rows, revision in jobs:
+        artifact = fit_device_model(train, revision)
+        results.append((device, artifact, score_device(artifact, rows.copy())))
+    return results
+
+
+def detect_jobs():
+    """
+    Worker count for fit_devices: $GUARDIAN_DETECT_JOBS if set, else one
+    per core.
+    """
+    value = os.environ.get(DETECT_JOBS_ENV)
+    if value:
+        return max(1, int(value))
+    return os.cpu_count() or 1
+
+
+def fit_devices(jobs, n_jobs=None):
+    """
+    Fits (device, train, rows, revision) jobs and scores `rows` with each new
+    model, across n_jobs worker processes. Every model uses random_state=0
+    and results come back in job order, so the output does not depend on
+    the worker count. Returns (device, artifact, scored rows) tuples.
+    """
+    if n_jobs is None:
+        n_jobs = detect_jobs()
+
+    chunks, chunk, size = [], [], 0
+    for job in jobs:
+        chunk.append(job)
+        size += len(job[1])
+        if size >= CHUNK_ROWS:
+            chunks.append(chunk)
+            chunk, size = [], 0
+    if chunk:
+        chunks.append(chunk)
+
+    if n_jobs == 1 or len(chunks) <= 1:
+        results = [_fit_chunk(c) for c in chunks]
+    else:
+        results = Parallel(n_jobs=n_jobs)(delayed(_fit_chunk)(c) for c in chunks)
+    return [r for chunk_results in results for r in chunk_results]
+
+
+def needs_refit(artifact: dict, scored: pd.DataFrame):
+    if artifact.get("version") != MODEL_VERSION:
+        return True
+    if scored["minute"].max() - artifact["fitted_at"] >= REFIT_EVERY:
+        return True
+    shift = abs(scored["score"].mean() - artifact["score_mean"])
+    return shift > DRIFT_Z * max(artifact["score_std"], 1e-9)
+
+
+def normalize_scores(history_df: pd.DataFrame, bounds: dict):
     eps = 1e-9
 
-    s_min, s_max = history_df["score"].min(), history_df["score"].max()
-    m_min, m_max = history_df["Mahalanobis"].min(), history_df["Mahalanobis"].max()
+    s_min, s_max = bounds["s_min"], bounds["s_max"]
+    m_min, m_max = bounds["m_min"], bounds["m_max"]
 
     history_df["norm_score"] = (history_df["score"] - s_min) / (s_max - s_min + eps)
     history_df["norm_Mahalanobis"] = (history_df["Mahalanobis"] - m_min) / (m_max - m_min + eps)
@@ -93,17 +301,300 @@ def detect(features_path=FEAT):
         + 0.5 * history_df["norm_Mahalanobis"]
     )
 
-    add_pca(history_df, FEAT_COLS)
 
-    alerts_df = (
+def latest_alerts(history_df: pd.DataFrame):
+    return (
         history_df
         .sort_values("minute")
-        .groupby("client_ip")
+        .groupby("client_ip", observed=True)
         .tail(1)
         .sort_values("combined_score", ascending=False)
     )
 
-    history_df.to_csv("data/anomaly_history.csv", index=False)
-    alerts_df.to_csv(ALERTS, index=False)
 
-    return alerts_df
+def alert_summary(alerts_df: pd.DataFrame):
+    if alerts_df.empty:
+        return {"num_alert_rows": 0}
+    return {
+        "num_alert_rows": len(alerts_df),
+        "last_alert_time": alerts_df["minute"].max(),
+        "highest_anomaly_score": float(alerts_df["combined_score"].max()),
+    }
+
+
+def drop_device_models(devices):
+    """
+    Deletes the models and moments of devices retention has expired and
+    takes them off the alerts. Returns the alert summary fields if the
+    alerts changed, else {}.
+    """
+    devices = set(devices)
+    if not devices:
+        return {}
+    for device in devices:
+        _model_path(device).unlink(missing_ok=True)
+    moments = load_moments()
+    if devices & moments.keys():
+        _dump({d: m for d, m in moments.items() if d not in devices}, MOMENTS)
+
+    alerts_df = read_dataset(ALERTS)
+    if alerts_df.empty:
+        return {}
+    keep = ~alerts_df["client_ip"].astype(str).isin(devices)
+    if keep.all():
+        return {}
+    alerts_df = alerts_df[keep]
+    write_dataset(ALERTS, alerts_df, mode="overwrite")
+    return alert_summary(alerts_df)
+
+
+def _detect_full(features_path=FEAT, n_jobs=None):
+    started = time.perf_counter()
+    if not dataset_exists(features_path):
+        return pd.DataFrame(), pd.DataFrame()
+
+    with step("read"):
+        df = read_dataset(features_path)
+    if df.empty:
+        return pd.DataFrame(), pd.DataFrame()
+
+    jobs = []
+
+    for device, grp in df.groupby("client_ip", observed=True):
+        if len(grp) < MIN_HISTORY:
+            continue
+
+        grp = grp.sort_values("minute")
+        jobs.append((device, grp, grp, 0))
+
+    history_parts = []
+    moments = {}
+    commit = Commit()
+    with step("fit"):
+        fitted = fit_devices(jobs, n_jobs)
+    for device, artifact, scored in fitted:
+        moments[device] = artifact.pop("moments")
+        save_device_model(device, artifact, commit)
+        history_parts.append(scored)
+
+    if not history_parts:
+        return pd.DataFrame(), pd.DataFrame()
+
+    history_df = pd.concat(history_parts, ignore_index=True)
+
+    bounds = {
+        "s_min": history_df["score"].min(), "s_max": history_df["score"].max(),
+        "m_min": history_df["Mahalanobis"].min(), "m_max": history_df["Mahalanobis"].max(),
+    }
+    normalize_scores(history_df, bounds)
+
+    with step("pca"):
+        pca = add_pca(history_df, FEAT_COLS)
+
+    alerts_df = latest_alerts(history_df)
+
+    with step("write"):
+        commit.write(ANOMALY_HISTORY, history_df, mode="overwrite")
+        update_rollups(history_df, FEAT_COLS + SCORE_COLS, mode="overwrite", commit=commit)
+        commit.write(ALERTS, alerts_df, mode="overwrite")
+    _dump({"version": MODEL_VERSION, "bounds": bounds, "pca": pca}, SHARED_MODEL, commit)
+    _dump(moments, MOMENTS, commit)
+
+    state = load_state()
+    state["last_detected_minute"] = df["minute"].max()
+    commit.apply(state)
+
+    publish(
+        "detect", started, rows_in=len(df), rows_out=len(history_df),
+        num_history_rows=len(history_df), **alert_summary(alerts_df),
+    )
+    # a full refit rescores everything, only each device's latest window is news
+    emit_alerts(alerts_df)
+
+    return history_df, alerts_df
+
+
+def detect_full(features_path=FEAT, n_jobs=None):
+    """
+    Refits every device on its whole history and rewrites the anomaly
+    history, the alerts and all model artifacts.
+    """
+    return _detect_full(features_path, n_jobs)[1]
+
+
+def load_shared(state: dict):
+    """
+    The shared model if incremental detection can pick up from state,
+    otherwise None (detect_full has to run).
+    """
+    if (
+        state.get("last_detected_minute") is None
+        or not SHARED_MODEL.exists()
+        or not MOMENTS.exists()
+        or not dataset_exists(ANOMALY_HISTORY)
+    ):
+        return None
+    shared = joblib.load(SHARED_MODEL)
+    if shared.get("version") != MODEL_VERSION:
+        return None
+    return shared
+
+
+@stage("detect")
+def detect(features_path=FEAT, refit=False, n_jobs=None):
+    """
+    Scores the feature windows newer than the detection watermark against
+    each device's saved model and appends them to the anomaly history.
+    Devices without a model are fit on (and scored over) their whole history;
+    stale or drifting models are refit before scoring. Otherwise only the
+    Mahalanobis moments are updated with the new windows. refit=True, or a
+    missing watermark/history, runs detect_full instead.
+    """
+    started = time.perf_counter()
+    state = load_state()
+    shared = None if refit else load_shared(state)
+    if shared is None:
+        return detect_full(features_path, n_jobs)
+
+    watermark = state["last_detected_minute"]
+    with step("read"):
+        new = read_dataset(features_path, since=watermark)
+    new = new[new["minute"] > watermark]
+    if new.empty:
+        return pd.DataFrame()
+
+    return score_windows(new, state, shared, features_path, n_jobs, started=started)[1]
+
+
+@stage("detect")
+def detect_windows(new: pd.DataFrame, features_path=FEAT, n_jobs=None, models=None):
+    """
+    detect() for feature rows already in memory, e.g. the windows the
+    streaming pipeline just closed, which must also be in features_path.
+    models is an optional {device: artifact} dict kept by the caller
+    between calls so the forests are not reloaded from disk every time.
+    Returns the scored rows.
+    """
+    started = time.perf_counter()
+    state = load_state()
+    shared = load_shared(state)
+    if shared is None:
+        history_df, _ = _detect_full(features_path, n_jobs)
+        if models is not None:
+            models.clear()
+        if history_df.empty:
+            return history_df
+        return history_df[history_df["minute"] >= new["minute"].min()].reset_index(drop=True)
+
+    watermark = state["last_detected_minute"]
+    new = new[new["minute"] > watermark]
+    if new.empty:
+        return pd.DataFrame()
+    return score_windows(new, state, shared, features_path, n_jobs, models, started)[0]
+
+
+def score_windows(new, state, shared, features_path=FEAT, n_jobs=None, models=None, started=None):
+    """
+    The incremental half of detect(): scores `new` (rows past the detection
+    watermark), appends them to the history, updates the alerts, models and
+    watermark, all in one Commit. Returns (scored rows, alerts).
+    """
+    if started is None:
+        started = time.perf_counter()
+    if models is None:
+        models = {}
+
+    moments = load_moments()
+    history_parts = []
+    pending = []
+    jobs = []
+    commit = Commit()
+
+    for device, grp in new.groupby("client_ip", observed=True):
+        grp = grp.sort_values("minute").copy()
+        artifact = models.get(device)
+        if artifact is None:
+            artifact = models[device] = load_device_model(device)
+
+        if artifact is None:
+            # never scored before: fit and score everything we have for it
+            grp = read_dataset(features_path, client_ip=device)
+            grp = grp[grp["minute"] <= new["minute"].max()]
+            if len(grp) >= MIN_HISTORY:
+                jobs.append((device, grp, grp, 0))
+            continue
+
+        X = grp[FEAT_COLS].astype(float).to_numpy()
+        with step("score"):
+            grp["score"] = -artifact["model"].score_samples(X)
+        if device not in moments or needs_refit(artifact, grp):
+            train = read_dataset(features_path, client_ip=device)
+            train = train[train["minute"] <= new["minute"].max()]
+            jobs.append((device, train, grp, artifact.get("revision", 0) + 1))
+        else:
+            # the forest stays as fitted, the moments take in the new windows
+            moments[device] = update_moments(moments[device], X)
+            pending.append((device, grp))
+
+    if pending:
+        with step("score"):
+            history_parts.append(score_mahalanobis(pending, moments))
+
+    with step("fit"):
+        fitted = fit_devices(jobs, n_jobs)
+    refitted = {}
+    for device, artifact, scored in fitted:
+        moments[device] = artifact.pop("moments")
+        save_device_model(device, artifact, commit)
+        refitted[device] = artifact
+        history_parts.append(scored)
+
+    new_history = pd.DataFrame()
+    if history_parts:
+        new_history = pd.concat(history_parts, ignore_index=True)
+
+        bounds = shared["bounds"]
+        bounds = {
+            "s_min": min(bounds["s_min"], new_history["score"].min()),
+            "s_max": max(bounds["s_max"], new_history["score"].max()),
+            "m_min": min(bounds["m_min"], new_history["Mahalanobis"].min()),
+            "m_max": max(bounds["m_max"], new_history["Mahalanobis"].max()),
+        }
+        normalize_scores(new_history, bounds)
+        with step("pca"):
+            add_pca(new_history, FEAT_COLS, pca=shared["pca"], update=True)
+
+        with step("write"):
+            commit.write(ANOMALY_HISTORY, new_history, mode="append")
+            update_rollups(new_history, FEAT_COLS + SCORE_COLS, commit=commit)
+
+        previous = read_dataset(ALERTS)
+        tz = new_history["minute"].dt.tz
+        if not previous.empty and previous["minute"].dt.tz != tz:
+            # in-memory windows (streaming) can carry an equivalent tz object
+            # that differs from the one Parquet hands back
+            previous["minute"] = previous["minute"].dt.tz_convert(tz)
+        alerts_df = latest_alerts(pd.concat([previous, new_history], ignore_index=True))
+        commit.write(ALERTS, alerts_df, mode="overwrite")
+
+        shared["bounds"] = bounds
+        # shared["pca"] was updated in place by add_pca
+        _dump(shared, SHARED_MODEL, commit)
+        _dump(moments, MOMENTS, commit)
+    else:
+        alerts_df = pd.DataFrame()
+
+    state["last_detected_minute"] = new["minute"].max()
+    commit.apply(state)
+    # only now the refits are on disk too
+    models.update(refitted)
+
+    fields = {}
+    if not new_history.empty:
+        fields = alert_summary(alerts_df)
+        fields["num_history_rows"] = running_count("num_history_rows", ANOMALY_HISTORY, len(new_history), False)
+
+    publish("detect", started, rows_in=len(new), rows_out=len(new_history), **fields)
+    emit_alerts(new_history)
+
+    return new_history, alerts_df
@@ -0,0 +1,133 @@
+import json
+import time
+import pandas as pd
+from pathlib import Path
+
+from app.ingest.state_manager import load_state, forget_devices, compact_first_seen, compact_codes
+from app.models.detector import drop_device_models, load_moments
+from app.storage.parquet_store import (
+    DNS,
+    FEATURES,
+    ANOMALY_HISTORY,
+    read_dataset,
+    partition_dates,
+    drop_partitions,
+    compact_partitions,
+)
+from app.features.build_features import WINDOWS
+from app.storage.rollups import ROLLUPS, combine_partials
+from app.storage.interning import interner
+from app.storage.summary import load_summary, publish
+from app.metrics import stage, step
+
+# days of date partitions kept, counting back from each dataset's newest
+# one; None keeps everything
+RETENTION_DAYS = {
+    DNS: 7,
+    FEATURES: 30,
+    ANOMALY_HISTORY: 30,
+    ROLLUPS["5min"]: 90,
+    ROLLUPS["1h"]: 365,
+    ROLLUPS["1d"]: None,
+    **{path: 30 for path in WINDOWS.values()},
+}
+# set to e.g. Path("data/archive") to move expired partitions there
+# (one dataset per directory) instead of deleting them
+ARCHIVE_DIR = None
+# partitions with at least this many files are merged into one
+COMPACT_MIN_FILES = 4
+
+# rows only expire once the next stage has consumed them: queries that
+# aren't windows yet and windows that aren't scored yet stay
+HOLD = {DNS: "last_window_minute", FEATURES: "last_detected_minute"}
+ROW_COUNTS = {DNS: "num_dns_rows", FEATURES: "num_feature_rows", ANOMALY_HISTORY: "num_history_rows"}
+
+
+def keep_from(path: Path, days, state: dict):
+    """
+    The oldest date partition of the dataset at path that retention keeps,
+    or None to keep all of it.
+    """
+    dates = partition_dates(path)
+    if days is None or not dates:
+        return None
+    first = (pd.Timestamp(dates[-1]) - pd.Timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    if path in HOLD:
+        held = state.get(HOLD[path])
+        if held is None:
+            return None
+        first = min(first, pd.Timestamp(held).strftime("%Y-%m-%d"))
+    return first
+
+
+def _combine_rollup(partials: pd.DataFrame):
+    return combine_partials(partials).reset_index()
+
+
+@stage("retention")
+def apply_retention(days=None, archive_dir=None, min_files=None):
+    """
+    Drops (or archives) the date partitions past each dataset's retention,
+    then merges the small files appends leave behind. Devices with no
+    feature window left are forgotten everywhere: models, moments, alerts,
+    first-seen pairs and baseline counts, and the interned codes nothing
+    uses anymore are dropped from the dictionaries (compact_codes; under
+    "dictionaries" in the report, as rows). days overrides RETENTION_DAYS
+    per dataset path; archive_dir and min_files default to ARCHIVE_DIR and
+    COMPACT_MIN_FILES.
+
+    Writers must be stopped meanwhile; the Celery task holds the refresh
+    lock, which refreshes and each streaming step take too.
+    Returns {dataset: {"keep_from", "rows_dropped", "files_compacted"}}.
+    """
+    started = time.perf_counter()
+    days = {**RETENTION_DAYS, **(days or {})}
+    if archive_dir is None:
+        archive_dir = ARCHIVE_DIR
+    if min_files is None:
+        min_files = COMPACT_MIN_FILES
+    state = load_state()
+    summary = load_summary()
+    report = {}
+    fields = {}
+
+    with step("drop"):
+        for path, n in days.items():
+            first = keep_from(path, n, state)
+            dropped = 0
+            if first is not None:
+                archive = archive_dir / path.name if archive_dir is not None else None
+                dropped = drop_partitions(path, first, archive)
+            report[path.name] = {"keep_from": first, "rows_dropped": dropped}
+            key = ROW_COUNTS.get(path)
+            if dropped and key in summary:
+                fields[key] = summary[key] - dropped
+
+    with step("compact"):
+        rollups = set(ROLLUPS.values())
+        for path in days:
+            combine = _combine_rollup if path in rollups else None
+            report[path.name]["files_compacted"] = compact_partitions(path, min_files, combine)
+        compact_first_seen()
+
+    if report[FEATURES.name]["rows_dropped"]:
+        remaining = set(read_dataset(FEATURES, columns=["client_ip"])["client_ip"].astype(str))
+        gone = sorted((set(summary.get("devices") or []) | set(load_moments())) - remaining)
+        if gone:
+            forget_devices(interner("client_ip").codes(pd.Series(gone)))
+            fields.update(drop_device_models(gone))
+            fields["devices"] = sorted(remaining)
+            fields["num_devices"] = len(remaining)
+        report[FEATURES.name]["devices_forgotten"] = len(gone)
+
+    with step("dictionaries"):
+        codes = compact_codes()
+    report["dictionaries"] = {"keep_from": None, "rows_dropped": sum(codes.values()), "files_compacted": 0, **codes}
+
+    rows = sum(r["rows_dropped"] for r in report.values())
+    publish("retention", started, rows_in=rows, retention=report, **fields)
+    return report
+
+
+if __name__ == "__main__":
+    print(json.dumps(apply_retention(), indent=2))
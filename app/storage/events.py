@@ -0,0 +1,88 @@
+import json
+import os
+import pandas as pd
+from pathlib import Path
+
+# append-only log of pipeline events, tailed by the API's /events stream;
+# written by whichever process runs a stage (celery worker, app.stream, ...)
+EVENTS_PATH = Path("data/events.jsonl")
+# rotated to events.jsonl.1 past this size; readers start over on the new file
+EVENTS_MAX_BYTES = 8 * 1024 * 1024
+
+# scored windows at or above this combined_score are pushed as "alert" events
+ALERT_THRESHOLD = 0.5
+
+
+def emit(event_type: str, data: dict):
+    """
+    Appends one event. Each event is a single write to an O_APPEND file, so
+    writers in different processes don't interleave.
+    """
+    EVENTS_PATH.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        if EVENTS_PATH.stat().st_size > EVENTS_MAX_BYTES:
+            EVENTS_PATH.replace(EVENTS_PATH.with_name(EVENTS_PATH.name + ".1"))
+    except FileNotFoundError:
+        pass
+
+    line = json.dumps({
+        "type": event_type,
+        "time": pd.Timestamp.now("UTC").isoformat(),
+        "data": data,
+    }, default=str) + "\n"
+    fd = os.open(EVENTS_PATH, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+
+def emit_alerts(scored: pd.DataFrame, threshold=None):
+    """
+    One "alert" event per row of scored with combined_score >= threshold.
+    """
+    if threshold is None:
+        threshold = ALERT_THRESHOLD
+    if scored.empty or "combined_score" not in scored.columns:
+        return 0
+    alerts = scored[scored["combined_score"] >= threshold]
+    if alerts.empty:
+        return 0
+    for record in json.loads(alerts.to_json(orient="records", date_format="iso")):
+        emit("alert", record)
+    return len(alerts)
+
+
+def end_offset():
+    try:
+        return EVENTS_PATH.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+def read_events(offset: int):
+    """
+    Events written after byte `offset`, as (offset just past each event,
+    event) pairs, plus the offset to read from next time. An offset past
+    the end means the log was rotated; reading starts over from 0.
+    """
+    size = end_offset()
+    if offset > size:
+        offset = 0
+    if offset == size:
+        return [], offset
+
+    with open(EVENTS_PATH, "rb") as f:
+        f.seek(offset)
+        data = f.read(size - offset)
+    # a writer may be mid-line at the end, leave it for the next read
+    data = data[: data.rfind(b"\n") + 1]
+
+    events = []
+    for line in data.splitlines(keepends=True):
+        offset += len(line)
+        try:
+            events.append((offset, json.loads(line)))
+        except json.JSONDecodeError:
+            continue
+    return events, offset
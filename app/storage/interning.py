@@ -0,0 +1,220 @@
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pathlib import Path
+
+# value <-> code tables shared by every run; a code never changes once given
+# out, until compact() renumbers them all in a new epoch
+DICT_DIR = Path("data/dictionaries")
+# in a table's directory: the epoch in use, whose parts are in epoch-<n>/;
+# without it (epoch 0) they are in the directory itself
+EPOCH_FILE = "epoch"
+
+# device and domain codes are packed into one int64 key, see pair_key
+CODE_BITS = 32
+CODE_MASK = (1 << CODE_BITS) - 1
+
+
+class Interner:
+    """
+    Append-only table mapping strings to int32 codes (the row they were
+    added at), kept as Parquet parts under DICT_DIR/name. Each part is named
+    after its first code and created with a hard link, so when two processes
+    add values at once one of them finds the name taken, reloads and tries
+    again instead of handing out the same code twice. path=None keeps the
+    table in memory only (benchmarks).
+    Lookups go through a value -> code dict kept next to the table and
+    extended as values are added, so encoding a batch only hashes the
+    batch's values.
+    """
+
+    def __init__(self, path: Path | None):
+        self.path = path
+        self._epoch = 0
+        self._reset()
+
+    def _reset(self):
+        self._values = pa.array([], pa.string())
+        self._lengths = np.array([], dtype=np.int32)
+        self._parts = []
+        self._index = {}
+
+    def __len__(self):
+        self._refresh()
+        return len(self._values)
+
+    def _read_epoch(self):
+        try:
+            return int((self.path / EPOCH_FILE).read_text())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _parts_dir(self, epoch=None):
+        epoch = self._epoch if epoch is None else epoch
+        return self.path / f"epoch-{epoch}" if epoch else self.path
+
+    def _refresh(self):
+        if self.path is None or not self.path.exists():
+            return
+        epoch = self._read_epoch()
+        if epoch != self._epoch:
+            # compact() renumbered the table: every code we hold is stale
+            self._epoch = epoch
+            self._reset()
+        parts = sorted(self._parts_dir().glob("part-*.parquet"))
+        new = parts[len(self._parts):]
+        if not new:
+            return
+        chunks = [pq.read_table(p)["value"].combine_chunks() for p in new]
+        self._values = pa.concat_arrays([self._values, *chunks])
+        self._lengths = np.concatenate([self._lengths, *(pc.utf8_length(c).to_numpy(zero_copy_only=False) for c in chunks)])
+        self._parts = parts
+
+    def _add(self, values: pa.Array):
+        start = len(self._values)
+        self._values = pa.concat_arrays([self._values, values])
+        self._lengths = np.concatenate([self._lengths, pc.utf8_length(values).to_numpy(zero_copy_only=False)])
+        return start
+
+    def _lookup(self, uniques: list):
+        """Codes of uniques, -1 for the ones not in the table."""
+        index = self._index
+        if len(index) < len(self._values):
+            # values loaded since the last lookup
+            for code, value in enumerate(self._values[len(index):].to_pylist(), start=len(index)):
+                index[value] = code
+        return np.fromiter((index.get(v, -1) for v in uniques), dtype=np.int32, count=len(uniques))
+
+    def _append(self, values: pa.Array):
+        if self.path is None:
+            return True
+        parts_dir = self._parts_dir()
+        parts_dir.mkdir(parents=True, exist_ok=True)
+        part = parts_dir / f"part-{len(self._values):010d}.parquet"
+        tmp = parts_dir / f".{part.name}.{os.getpid()}.tmp"
+        pq.write_table(pa.table({"value": values}), tmp)
+        try:
+            os.link(tmp, part)
+        except FileExistsError:
+            return False
+        finally:
+            tmp.unlink()
+        self._parts.append(part)
+        return True
+
+    def _encode(self, uniques: list):
+        """Codes of distinct values, adding the ones not seen before."""
+        while True:
+            self._refresh()
+            codes = self._lookup(uniques)
+            missing = codes < 0
+            if not missing.any():
+                return codes
+
+            new = pa.array([v for v, m in zip(uniques, missing) if m], pa.string())
+            if not self._append(new):
+                # another process added values first; start over on its table
+                continue
+            start = self._add(new)
+            codes[missing] = np.arange(start, start + len(new), dtype=np.int32)
+            return codes
+
+    def codes(self, values: pd.Series):
+        """
+        int32 codes of values. Categoricals (what the query dataset reads
+        back as) are encoded through their categories, so only the distinct
+        values are hashed.
+        """
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            local, uniques = values.cat.codes.to_numpy(), values.cat.categories
+        else:
+            local, uniques = pd.factorize(values)
+        if len(uniques) == 0:
+            return np.zeros(len(values), dtype=np.int32)
+        mapping = self._encode([str(v) for v in uniques])
+        return mapping[local]
+
+    def values(self, codes):
+        """The strings behind codes, as a Categorical over just those values."""
+        self._refresh()
+        codes = np.asarray(codes)
+        used, local = np.unique(codes, return_inverse=True)
+        names = self._values.take(pa.array(used)).to_pylist()
+        return pd.Categorical.from_codes(local.reshape(-1), categories=names)
+
+    def lengths(self, codes):
+        """Character length of the string behind each code."""
+        self._refresh()
+        return self._lengths[np.asarray(codes)]
+
+    def compact(self, keep, commit):
+        """
+        Writes a new epoch of the table holding only the codes in keep,
+        renumbered from 0 in their old order, and has commit (a
+        state_manager.Commit) switch to it, so it goes live together with
+        the stores rewritten to the new codes. Returns an array mapping
+        each old code to its new one, -1 for the dropped ones.
+        """
+        self._refresh()
+        keep = np.unique(np.asarray(keep, dtype=np.int64))
+        mapping = np.full(len(self._values), -1, dtype=np.int32)
+        mapping[keep] = np.arange(len(keep), dtype=np.int32)
+        kept = self._values.take(pa.array(keep, pa.int64()))
+        if self.path is None:
+            self._reset()
+            self._add(kept)
+            return mapping
+
+        epoch = self._epoch + 1
+        parts_dir = self._parts_dir(epoch)
+        # left over from a compaction that never committed
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        parts_dir.mkdir(parents=True)
+        if len(kept):
+            pq.write_table(pa.table({"value": kept}), parts_dir / f"part-{0:010d}.parquet")
+        tmp = self.path / f".{EPOCH_FILE}.tmp"
+        tmp.write_text(str(epoch))
+        tmp.replace(commit.file(self.path / EPOCH_FILE))
+        return mapping
+
+    def drop_old_epochs(self):
+        """Deletes the parts of epochs before the current one."""
+        if self.path is None or not self.path.exists():
+            return
+        self._refresh()
+        if self._epoch == 0:
+            return
+        for part in self.path.glob("part-*.parquet"):
+            part.unlink()
+        for old in self.path.glob("epoch-*"):
+            if old != self._parts_dir():
+                shutil.rmtree(old, ignore_errors=True)
+
+
+_INTERNERS = {}
+
+
+def interner(name: str):
+    """The Interner for DICT_DIR/name (e.g. "client_ip", "domain"), shared in-process."""
+    path = (DICT_DIR / name).resolve()
+    found = _INTERNERS.get(path)
+    if found is None:
+        found = _INTERNERS.setdefault(path, Interner(path))
+    return found
+
+
+def pair_key(a, b):
+    """Two non-negative int32 code arrays packed into one int64 key."""
+    # ufuncs with dtype/out cast in small buffers, no full-size int64 copies
+    key = np.left_shift(np.asarray(a), CODE_BITS, dtype=np.int64)
+    key |= np.asarray(b)
+    return key
+
+
+def split_key(key):
+    key = np.asarray(key, dtype=np.int64)
+    return key >> CODE_BITS, key & CODE_MASK
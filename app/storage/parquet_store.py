@@ -0,0 +1,395 @@
+import json
+import uuid
+import shutil
+from pathlib import Path
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+DNS = Path("data/dns")
+FEATURES = Path("data/features")
+ANOMALY_HISTORY = Path("data/anomaly_history")
+ALERTS = Path("data/alerts")
+
+# old CSV file -> dataset, for convert_csv
+CSV_SOURCES = {
+    Path("data/sample_dns.csv"): DNS,
+    Path("data/features.csv"): FEATURES,
+    Path("data/anomaly_history.csv"): ANOMALY_HISTORY,
+    Path("data/alerts.csv"): ALERTS,
+}
+
+# also split partitions by device, so client_ip filters skip whole directories
+PARTITION_BY_DEVICE = False
+
+# counter bumped by every write_dataset, so readers can tell a dataset changed
+GENERATION_FILE = ".generation"
+
+STRING_COLUMNS = ("client_ip", "domain", "qtype")
+TIME_COLUMNS = ("time", "minute")
+
+# footer key of a file written by compact_partitions: the names of the files it replaced
+COMPACTED_FROM = b"compacted_from"
+
+# writes made with staged=True wait in this directory of the dataset,
+# which readers skip, until publish_staged moves them in
+STAGED_DIR = ".staged"
+# in STAGED_DIR: the date partitions publish_staged removes first
+REPLACE_FILE = "replace.json"
+
+
+def _time_column(columns):
+    for col in TIME_COLUMNS:
+        if col in columns:
+            return col
+    raise ValueError(f"no time column in {list(columns)}")
+
+
+def _partitioning(path: Path):
+    fields = [("date", pa.string())]
+    if (path / ".by_device").exists():
+        fields.append(("client_ip", pa.string()))
+    return ds.partitioning(pa.schema(fields), flavor="hive")
+
+
+def _iter_files(path: Path):
+    return (f for f in path.rglob("*.parquet") if STAGED_DIR not in f.relative_to(path).parts)
+
+
+def dataset_files(path: Path):
+    """The dataset's Parquet files, leaving out staged ones, sorted."""
+    return sorted(_iter_files(path))
+
+
+def dataset_exists(path: Path):
+    return path.exists() and any(_iter_files(path))
+
+
+def read_generation(path: Path):
+    """
+    How many times the dataset at path has been written, 0 if never.
+    """
+    try:
+        return int((path / GENERATION_FILE).read_text())
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def _bump_generation(path: Path, generation: int):
+    path.mkdir(parents=True, exist_ok=True)
+    tmp = path / (GENERATION_FILE + ".tmp")
+    tmp.write_text(str(generation + 1))
+    tmp.replace(path / GENERATION_FILE)
+
+
+def _to_table(df: pd.DataFrame):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for col in STRING_COLUMNS:
+        if col in table.column_names:
+            i = table.column_names.index(col)
+            arr = table.column(col)
+            if pa.types.is_dictionary(arr.type):
+                arr = arr.cast(pa.dictionary(pa.int32(), pa.string()))
+            else:
+                arr = arr.cast(pa.string()).dictionary_encode()
+            table = table.set_column(i, col, arr)
+    return table
+
+
+def write_dataset(path: Path, df: pd.DataFrame, mode="append", by_device=None, staged=False):
+    """
+    Writes df under path as Parquet partitioned by date (of the time/minute
+    column) and, optionally, by client_ip. mode="append" adds new files next
+    to the existing ones, mode="overwrite" replaces the dataset.
+    staged=True holds the write back (readers don't see it) until
+    publish_staged, see state_manager.Commit.
+    """
+    if by_device is None:
+        by_device = PARTITION_BY_DEVICE
+    generation = read_generation(path)
+    if staged:
+        if mode == "overwrite":
+            _stage_replace(path, None)
+    elif mode == "overwrite" and path.exists():
+        shutil.rmtree(path)
+        if df.empty:
+            _bump_generation(path, generation)
+    if df.empty:
+        return path
+
+    time_col = _time_column(df.columns)
+    # format each distinct day once rather than every row
+    days, distinct = pd.factorize(df[time_col].dt.normalize())
+    df = df.assign(date=distinct.strftime("%Y-%m-%d").to_numpy()[days])
+
+    table = _to_table(df)
+
+    path.mkdir(parents=True, exist_ok=True)
+    partition_cols = ["date"]
+    if by_device or (path / ".by_device").exists():
+        (path / ".by_device").touch()
+        partition_cols.append("client_ip")
+
+    # time-ordered names keep a partition's files in write order
+    stamp = f"{pd.Timestamp.now('UTC').value:020d}-{uuid.uuid4().hex[:8]}"
+    pq.write_to_dataset(
+        table,
+        path / STAGED_DIR if staged else path,
+        partition_cols=partition_cols,
+        basename_template=f"part-{stamp}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+    if not staged:
+        _bump_generation(path, generation)
+    return path
+
+
+def _stage_replace(path: Path, since):
+    """
+    Makes publish_staged remove the date partitions from `since` on (all
+    of them if None) before moving the staged files in. Anything staged
+    for those dates so far is dropped.
+    """
+    staged = path / STAGED_DIR
+    marker = staged / REPLACE_FILE
+    if marker.exists():
+        before = json.loads(marker.read_text())["since"]
+        if before is None or (since is not None and before < since):
+            since = before
+    for part in staged.glob("date=*"):
+        if since is None or part.name[len("date="):] >= since:
+            shutil.rmtree(part)
+    staged.mkdir(parents=True, exist_ok=True)
+    tmp = staged / (REPLACE_FILE + ".tmp")
+    tmp.write_text(json.dumps({"since": since}))
+    tmp.replace(marker)
+
+
+def publish_staged(path: Path):
+    """
+    Moves what was written to the dataset at path with staged=True into
+    it, after removing the partitions a staged overwrite/truncate
+    replaces. Picks up where it left off if run again after an
+    interruption. Returns whether there was anything staged.
+    """
+    staged = path / STAGED_DIR
+    if not staged.exists():
+        return False
+    generation = read_generation(path)
+    marker = staged / REPLACE_FILE
+    if marker.exists():
+        since = json.loads(marker.read_text())["since"]
+        for d in partition_dates(path):
+            if since is None or d >= since:
+                shutil.rmtree(path / f"date={d}", ignore_errors=True)
+        marker.unlink()
+    for f in sorted(staged.rglob("*.parquet")):
+        target = path / f.relative_to(staged)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        f.replace(target)
+    shutil.rmtree(staged, ignore_errors=True)
+    _bump_generation(path, generation)
+    return True
+
+
+def discard_staged(path: Path):
+    """Drops what a run that never committed staged under path."""
+    shutil.rmtree(path / STAGED_DIR, ignore_errors=True)
+
+
+def _scalar(ts, arrow_type):
+    ts = pd.Timestamp(ts)
+    if arrow_type.tz is not None:
+        ts = ts.tz_localize(arrow_type.tz) if ts.tz is None else ts
+    elif ts.tz is not None:
+        ts = ts.tz_localize(None)
+    return pa.scalar(ts, type=arrow_type)
+
+
+def read_dataset(path: Path, columns=None, since=None, until=None, client_ip=None, files=None):
+    """
+    Reads a dataset written by write_dataset. since/until (inclusive) are
+    pushed down on the time/minute column, after pruning date partitions,
+    and client_ip (a value or a list) on the device column. files limits
+    the read to those of dataset_files(path).
+    Rows come back in time order.
+    """
+    if not dataset_exists(path) or files is not None and not files:
+        return pd.DataFrame(columns=columns)
+
+    if files is None:
+        dataset = ds.dataset(path, format="parquet", partitioning=_partitioning(path))
+    else:
+        dataset = ds.dataset(
+            [str(f) for f in files], format="parquet",
+            partitioning=_partitioning(path), partition_base_dir=str(path),
+        )
+    schema = dataset.schema
+    time_col = _time_column(schema.names)
+
+    filt = None
+    def add(expr):
+        nonlocal filt
+        filt = expr if filt is None else filt & expr
+
+    if since is not None:
+        # partitions are local dates; step back a day so offsets never prune valid rows
+        add(ds.field("date") >= (pd.Timestamp(since) - pd.Timedelta(days=1)).strftime("%Y-%m-%d"))
+        add(ds.field(time_col) >= _scalar(since, schema.field(time_col).type))
+    if until is not None:
+        add(ds.field("date") <= (pd.Timestamp(until) + pd.Timedelta(days=1)).strftime("%Y-%m-%d"))
+        add(ds.field(time_col) <= _scalar(until, schema.field(time_col).type))
+    if client_ip is not None:
+        ips = [client_ip] if isinstance(client_ip, str) else list(client_ip)
+        add(ds.field("client_ip").isin(ips))
+
+    read_cols = None
+    if columns is not None:
+        read_cols = list(dict.fromkeys(list(columns) + [time_col]))
+
+    table = dataset.to_table(columns=read_cols, filter=filt)
+    df = table.to_pandas()
+    if "date" in df.columns:
+        df = df.drop(columns="date")
+    df = df.sort_values(time_col, kind="stable", ignore_index=True)
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+
+def partition_dates(path: Path):
+    """The date partitions of the dataset at path, oldest first."""
+    if not path.exists():
+        return []
+    return sorted(p.name[len("date="):] for p in path.glob("date=*") if p.is_dir())
+
+
+def _num_rows(files):
+    return sum(pq.ParquetFile(f).metadata.num_rows for f in files)
+
+
+def drop_partitions(path: Path, before: str, archive_dir: Path | None = None):
+    """
+    Removes the date partitions of the dataset at path older than `before`
+    (YYYY-MM-DD). With archive_dir they are moved there instead, laid out
+    so read_dataset(archive_dir) still reads them. Returns the number of
+    rows taken out.
+    """
+    expired = [path / f"date={d}" for d in partition_dates(path) if d < before]
+    return _remove_partitions(path, expired, archive_dir)
+
+
+def truncate_partitions(path: Path, since: str, staged=False):
+    """
+    Removes the date partitions from `since` (YYYY-MM-DD) on, for rewriting
+    the tail of a dataset while keeping what came before.
+    Returns the number of rows taken out; with staged=True they are only
+    taken out by publish_staged, and 0 is returned.
+    """
+    if staged:
+        _stage_replace(path, since)
+        return 0
+    return _remove_partitions(path, [path / f"date={d}" for d in partition_dates(path) if d >= since])
+
+
+def _remove_partitions(path: Path, parts, archive_dir=None):
+    if not parts:
+        return 0
+    generation = read_generation(path)
+    rows = 0
+    for part in parts:
+        files = list(part.rglob("*.parquet"))
+        rows += _num_rows(files)
+        if archive_dir is not None:
+            if (path / ".by_device").exists():
+                archive_dir.mkdir(parents=True, exist_ok=True)
+                (archive_dir / ".by_device").touch()
+            # file by file, a partition archived before may get a late file
+            for f in files:
+                target = archive_dir / f.relative_to(path)
+                target.parent.mkdir(parents=True, exist_ok=True)
+                shutil.move(f, target)
+        shutil.rmtree(part)
+    _bump_generation(path, generation)
+    return rows
+
+
+def _finish_compaction(files):
+    """
+    Deletes files a compacted file says it replaced but that are still
+    there (a compaction stopped between the two steps). Returns the rest.
+    """
+    names = {f.name for f in files}
+    for f in files:
+        if f.name not in names:
+            continue
+        metadata = pq.read_schema(f).metadata or {}
+        if COMPACTED_FROM in metadata:
+            for name in json.loads(metadata[COMPACTED_FROM]):
+                if name in names:
+                    (f.parent / name).unlink(missing_ok=True)
+                    names.discard(name)
+    return [f for f in files if f.name in names]
+
+
+def compact_partitions(path: Path, min_files=2, combine=None):
+    """
+    Rewrites every partition directory of the dataset at path holding at
+    least min_files files as a single file, rows in time order. combine,
+    if given, maps a partition's rows (a DataFrame) to what the merged file
+    holds instead. The merged file takes the name of the oldest one and
+    only then are the others deleted; its footer lists them so an
+    interrupted compaction is finished by the next one rather than leaving
+    rows twice. Returns the number of files removed.
+    """
+    if not dataset_exists(path):
+        return 0
+    generation = read_generation(path)
+    removed = 0
+    for leaf in sorted({f.parent for f in dataset_files(path)}):
+        found = sorted(leaf.glob("*.parquet"))
+        files = _finish_compaction(found)
+        removed += len(found) - len(files)
+        if len(files) < min_files:
+            continue
+
+        table = pa.concat_tables([pq.ParquetFile(f).read() for f in files], promote_options="permissive")
+        if combine is not None:
+            table = _to_table(combine(table.to_pandas()))
+        table = table.sort_by(_time_column(table.column_names)).unify_dictionaries().combine_chunks()
+        metadata = {**(table.schema.metadata or {}), COMPACTED_FROM: json.dumps([f.name for f in files[1:]])}
+        table = table.replace_schema_metadata(metadata)
+
+        tmp = leaf / f".compact-{uuid.uuid4().hex[:8]}.tmp"
+        pq.write_table(table, tmp)
+        tmp.replace(files[0])
+        for f in files[1:]:
+            f.unlink()
+        removed += len(files) - 1
+    if removed:
+        _bump_generation(path, generation)
+    return removed
+
+
+def convert_csv(sources=None):
+    """
+    One-time conversion of the old CSV files into their datasets, replacing
+    whatever the datasets held. The CSVs are left in place.
+
+        python -m app.storage.parquet_store
+    """
+    if sources is None:
+        sources = CSV_SOURCES
+    for csv_path, path in sources.items():
+        if not csv_path.exists():
+            continue
+        header = pd.read_csv(csv_path, nrows=0).columns
+        time_col = _time_column(header)
+        df = pd.read_csv(csv_path, parse_dates=[time_col])
+        write_dataset(path, df, mode="overwrite")
+        print(f"{csv_path} -> {path} ({len(df)} rows)")
+
+
+if __name__ == "__main__":
+    convert_csv()
@@ -0,0 +1,213 @@
+import threading
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from pathlib import Path
+
+from app.storage.parquet_store import read_dataset, read_generation, dataset_files
+from app.ingest.state_manager import to_epoch_ns
+
+
+def _time_ns(ts, tz=None):
+    ts = pd.Timestamp(ts)
+    if tz is not None and ts.tz is None:
+        ts = ts.tz_localize(tz)
+    return int(to_epoch_ns(pd.Series([ts])).iloc[0])
+
+
+def _concat(a: pd.DataFrame, b: pd.DataFrame):
+    """a's rows then b's, keeping categoricals categorical."""
+    cols = {}
+    for col in a.columns:
+        x, y = a[col], b[col]
+        if isinstance(x.dtype, pd.CategoricalDtype) and isinstance(y.dtype, pd.CategoricalDtype):
+            cols[col] = union_categoricals([x, y], ignore_order=True)
+        else:
+            cols[col] = pd.concat([x, y], ignore_index=True)
+    return pd.DataFrame(cols)
+
+
+class CachedDataset:
+    """
+    In-process copy of a dataset for the API. It is refreshed only when the
+    dataset's generation (bumped by every write_dataset) moves, and keeps
+    each device's row positions in time order, so a lookup by client_ip and
+    time range costs O(rows returned) instead of a scan of the whole frame.
+    A refresh after appends reads just the new files and extends the index
+    (_extend); one after files went away (overwrite, retention,
+    compaction) reads the dataset again.
+    The frames handed out are shared between requests; don't modify them.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.generation = None
+        self.files = set()
+        self._lock = threading.Lock()
+        self._data = self._index(pd.DataFrame())
+
+    def _index(self, df: pd.DataFrame):
+        data = {"df": df, "devices": {}, "order": None, "times": None, "tz": None}
+        if df.empty:
+            return data
+
+        time_col = "minute" if "minute" in df.columns else "time"
+        times = to_epoch_ns(df[time_col]).to_numpy()
+        data["time_col"] = time_col
+        data["tz"] = getattr(df[time_col].dt, "tz", None)
+        data["times"] = times
+        if "client_ip" not in df.columns:
+            return data
+
+        codes, uniques = pd.factorize(df["client_ip"])
+        # df comes back time ordered, a stable sort keeps each device's rows that way
+        order = np.argsort(codes, kind="stable")
+        sorted_codes = codes[order]
+        device_codes = np.arange(len(uniques))
+        starts = np.searchsorted(sorted_codes, device_codes, side="left")
+        stops = np.searchsorted(sorted_codes, device_codes, side="right")
+
+        data["devices"] = {str(ip): (a, b) for ip, a, b in zip(uniques, starts, stops)}
+        data["order"] = order
+        data["device_times"] = times[order]
+        return data
+
+    def _extend(self, data, new: pd.DataFrame):
+        """
+        data with the rows of new appended. While they all come after the
+        cached rows (the pipeline appends newer windows) each device's
+        positions are the old ones followed by its new ones, and only new
+        is indexed; otherwise everything is re-indexed.
+        """
+        old = data["df"]
+        if new.empty:
+            return data
+        if old.empty or list(new.columns) != list(old.columns):
+            return self._index(read_dataset(self.path))
+
+        time_col = data["time_col"]
+        new_times = to_epoch_ns(new[time_col]).to_numpy()
+        df = _concat(old, new)
+        if new_times[0] < data["times"][-1]:
+            return self._index(df.sort_values(time_col, kind="stable", ignore_index=True))
+
+        times = np.concatenate([data["times"], new_times])
+        extended = {**data, "df": df, "times": times}
+        if "client_ip" not in df.columns:
+            return extended
+
+        codes, uniques = pd.factorize(new["client_ip"])
+        new_order = np.argsort(codes, kind="stable") + len(old)
+        sorted_codes = codes[new_order - len(old)]
+        device_codes = np.arange(len(uniques))
+        new_ranges = {
+            str(ip): (a, b) for ip, a, b in zip(
+                uniques,
+                np.searchsorted(sorted_codes, device_codes, side="left"),
+                np.searchsorted(sorted_codes, device_codes, side="right"),
+            )
+        }
+
+        blocks, devices, at = [], {}, 0
+        for ip in [*data["devices"], *(ip for ip in new_ranges if ip not in data["devices"])]:
+            start = at
+            for order, ranges in ((data["order"], data["devices"]), (new_order, new_ranges)):
+                if ip in ranges:
+                    a, b = ranges[ip]
+                    blocks.append(order[a:b])
+                    at += b - a
+            devices[ip] = (start, at)
+        order = np.concatenate(blocks)
+        extended.update(devices=devices, order=order, device_times=times[order])
+        return extended
+
+    def _load(self):
+        files = set(dataset_files(self.path))
+        if self.files and self.files <= files:
+            self._data = self._extend(self._data, read_dataset(self.path, files=sorted(files - self.files)))
+        else:
+            self._data = self._index(read_dataset(self.path))
+        self.files = files
+
+    def _span(self, times, start, stop, since, until, tz):
+        if since is not None:
+            start += np.searchsorted(times[start:stop], _time_ns(since, tz), side="left")
+        if until is not None:
+            stop = start + np.searchsorted(times[start:stop], _time_ns(until, tz), side="right")
+        return start, stop
+
+    def _positions(self, data, ip, since, until):
+        if ip not in data["devices"]:
+            return np.array([], dtype=np.int64)
+        start, stop = data["devices"][ip]
+        start, stop = self._span(data["device_times"], start, stop, since, until, data["tz"])
+        return data["order"][start:stop]
+
+    def refresh(self):
+        generation = read_generation(self.path)
+        if generation != self.generation:
+            with self._lock:
+                if generation != self.generation:
+                    self._load()
+                    self.generation = generation
+        return self
+
+    @property
+    def df(self):
+        return self._data["df"]
+
+    def devices(self):
+        return sorted(self._data["devices"])
+
+    def latest(self, ip: str):
+        """Time of the device's newest row, or None."""
+        data = self._data
+        if ip not in data["devices"]:
+            return None
+        stop = data["devices"][ip][1]
+        return data["df"][data["time_col"]].iloc[data["order"][stop - 1]]
+
+    def device(self, ip: str, since=None, until=None):
+        """
+        The device's rows with since <= time <= until, in time order.
+        """
+        data = self._data
+        return data["df"].take(self._positions(data, ip, since, until))
+
+    def query(self, since=None, until=None, client_ip=None, columns=None, offset=0, limit=None):
+        """
+        Rows with since <= time <= until, of client_ip (a value or a list)
+        if given, in time order. Only rows offset:offset+limit of the match
+        and only `columns` are materialized.
+        Returns (rows, number of matching rows).
+        """
+        data = self._data
+        df = data["df"]
+        if df.empty:
+            return df, 0
+
+        if client_ip is None:
+            start, stop = self._span(data["times"], 0, len(df), since, until, data["tz"])
+            positions = np.arange(start, stop)
+        else:
+            ips = [client_ip] if isinstance(client_ip, str) else list(client_ip)
+            parts = [self._positions(data, ip, since, until) for ip in ips]
+            positions = np.sort(np.concatenate(parts)) if parts else np.array([], dtype=np.int64)
+
+        total = len(positions)
+        positions = positions[offset:] if limit is None else positions[offset:offset + limit]
+        cols = slice(None) if columns is None else [df.columns.get_loc(c) for c in columns]
+        return df.iloc[positions, cols], total
+
+
+_CACHES = {}
+
+
+def cached(path: Path):
+    """
+    The CachedDataset for path, re-read first if the dataset was written since.
+    """
+    cache = _CACHES.get(path)
+    if cache is None:
+        cache = _CACHES.setdefault(path, CachedDataset(path))
+    return cache.refresh()
@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from app.storage.parquet_store import ANOMALY_HISTORY, write_dataset, dataset_exists, truncate_partitions
+from app.storage.query_cache import cached
+
+# downsampled copies of the anomaly history for long history ranges; the
+# 1min resolution is the history itself
+ROLLUP_DIR = Path("data/rollups")
+RESOLUTIONS = ["1min", "5min", "1h", "1d"]
+ROLLUPS = {res: ROLLUP_DIR / res for res in RESOLUTIONS[1:]}
+
+# what the history charts plot, on top of detector.FEAT_COLS
+SCORE_COLS = ["combined_score", "pc1", "pc2"]
+
+
+def partial_rollup(history: pd.DataFrame, res: str, cols: list[str]):
+    """
+    Per (client_ip, bucket) count, sums and maxes of cols over history.
+    Partials of the same bucket merge by adding counts and sums and taking
+    the max of the maxes, so a bucket that is still filling up just gets
+    another partial appended when its next windows land.
+    """
+    cols = [c for c in cols if c in history.columns]
+    df = history[["client_ip", *cols]].assign(
+        client_ip=history["client_ip"].astype(str),
+        minute=history["minute"].dt.floor(res),
+    )
+    g = df.groupby(["client_ip", "minute"], sort=False)
+    sums = g[cols].sum().add_suffix("_sum")
+    maxes = g[cols].max().add_suffix("_max")
+    out = pd.concat([g.size().rename("count"), sums, maxes], axis=1)
+    return out.reset_index()
+
+
+def update_rollups(new_history: pd.DataFrame, cols: list[str], mode="append", commit=None):
+    """
+    Folds newly scored windows into every rollup. mode="overwrite" rebuilds
+    them from new_history (after a full refit rewrote the history) but
+    keeps the days before it starts, which retention may already have
+    dropped from the history while a coarser rollup still holds them.
+    With a commit (state_manager.Commit) the writes go through it.
+    """
+    write = commit.write if commit is not None else write_dataset
+    truncate = commit.truncate if commit is not None else truncate_partitions
+    if new_history.empty:
+        if mode == "overwrite":
+            for path in ROLLUPS.values():
+                write(path, pd.DataFrame(), mode="overwrite")
+        return
+    for res, path in ROLLUPS.items():
+        rows = partial_rollup(new_history, res, cols)
+        if mode == "overwrite":
+            truncate(path, rows["minute"].min().strftime("%Y-%m-%d"))
+        write(path, rows, mode="append")
+
+
+def combine_partials(partials: pd.DataFrame):
+    """
+    Folds the partials of each (client_ip, bucket) into one, still as
+    count, col_sum and col_max; what compaction keeps of a rollup.
+    """
+    sum_cols = [c for c in partials.columns if c.endswith("_sum")]
+    max_cols = [c for c in partials.columns if c.endswith("_max")]
+    g = partials.groupby(["client_ip", "minute"], sort=True, observed=True)
+    return pd.concat([g["count"].sum(), g[sum_cols].sum(), g[max_cols].max()], axis=1)
+
+
+def merge_partials(partials: pd.DataFrame):
+    """
+    One row per (client_ip, bucket): count, col (the mean) and col_max.
+    """
+    if partials.empty:
+        return partials
+    out = combine_partials(partials)
+    sum_cols = [c for c in out.columns if c.endswith("_sum")]
+    max_cols = [c for c in out.columns if c.endswith("_max")]
+    means = {col[:-len("_sum")]: out[col] / out["count"] for col in sum_cols}
+    out = pd.concat([out[["count"]], pd.DataFrame(means), out[max_cols]], axis=1)
+    return out.reset_index()
+
+
+def pick_resolution(span: pd.Timedelta, max_points: int):
+    """
+    Finest resolution that covers span in at most max_points buckets.
+    """
+    for res in RESOLUTIONS:
+        if span / pd.Timedelta(res) <= max_points:
+            return res
+    return RESOLUTIONS[-1]
+
+
+def device_rollup(ip: str, res: str, since=None):
+    """
+    The device's history at resolution res from since on, in time order.
+    """
+    if res == RESOLUTIONS[0]:
+        return cached(ANOMALY_HISTORY).device(ip, since=since)
+    if since is not None:
+        since = pd.Timestamp(since).floor(res)
+    if dataset_exists(ROLLUPS[res]):
+        partials = cached(ROLLUPS[res]).device(ip, since=since)
+    else:
+        # history from before the rollups existed: roll it up on the fly
+        # until the next full detect writes them
+        rows = cached(ANOMALY_HISTORY).device(ip, since=since)
+        cols = [c for c in rows.select_dtypes("number").columns if c != "client_ip"]
+        partials = partial_rollup(rows, res, cols) if not rows.empty else rows
+    out = merge_partials(partials)
+    if not out.empty:
+        out["count"] = out["count"].astype(np.int64)
+    return out
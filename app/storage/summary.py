@@ -0,0 +1,132 @@
+import json
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from app.storage.parquet_store import FEATURES, ALERTS, read_dataset, dataset_exists
+from app.storage.events import emit
+
+# small record the pipeline stages keep up to date so /status never scans a dataset
+SUMMARY_PATH = Path("data/summary.json")
+
+
+def _default(value):
+    if isinstance(value, pd.Timestamp):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def load_summary():
+    """
+    {
+        "num_dns_rows", "num_feature_rows", "num_history_rows", "num_alert_rows": int
+        "num_late_rows": int, queries ingested older than last_ingested_time
+        "num_devices": int, "devices": [client_ip, ...]
+        "last_ingested_time", "last_feature_time", "last_alert_time": ISO str
+        "highest_anomaly_score": float
+        "stages": {stage: {"finished_at", "duration_s", "rows_in", "rows_out", "rows_per_s",
+                           + the app.metrics measurements of its last run}}
+        "stage_totals": {stage: {"runs", "failures", "wall_s", "cpu_s"}}
+    }
+    Keys appear once the stage that owns them has run.
+    """
+    if not SUMMARY_PATH.exists():
+        return {}
+    try:
+        with open(SUMMARY_PATH, "r") as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        return {}
+
+
+def _save(summary: dict):
+    SUMMARY_PATH.parent.mkdir(parents=True, exist_ok=True)
+    tmp = SUMMARY_PATH.with_suffix(".tmp")
+    with open(tmp, "w") as f:
+        json.dump(summary, f, indent=2, default=_default)
+    tmp.replace(SUMMARY_PATH)
+
+
+def publish(stage: str, started: float, rows_in=0, rows_out=0, **fields):
+    """
+    Merges fields into the summary and records how long `stage` took since
+    `started` (a time.perf_counter() value) and its row throughput. The
+    stage's entry also goes out as a "progress" event.
+    """
+    duration = time.perf_counter() - started
+    summary = load_summary()
+    summary.update(fields)
+    summary.setdefault("stages", {})[stage] = {
+        "finished_at": pd.Timestamp.now("UTC"),
+        "duration_s": round(duration, 4),
+        "rows_in": int(rows_in),
+        "rows_out": int(rows_out),
+        "rows_per_s": round(rows_in / duration, 1) if duration > 0 else None,
+    }
+
+    _save(summary)
+
+    emit("progress", {"stage": stage, "status": "done", **summary["stages"][stage]})
+    return summary
+
+
+def record_metrics(stage: str, metrics: dict, ok=True):
+    """
+    Adds a stage run's measurements (see app.metrics.stage) to its entry,
+    which publish() has written by then if the stage publishes at all, and
+    to the stage's running totals.
+    """
+    summary = load_summary()
+    stages = summary.setdefault("stages", {})
+    entry = stages.get(stage, {})
+    if not entry or "wall_s" in entry:
+        # this run didn't publish: don't leave the previous run's rows next to these numbers
+        entry = {"finished_at": pd.Timestamp.now("UTC")}
+    stages[stage] = {**entry, **metrics}
+
+    totals = summary.setdefault("stage_totals", {}).setdefault(
+        stage, {"runs": 0, "failures": 0, "wall_s": 0.0, "cpu_s": 0.0}
+    )
+    totals["runs"] += 1
+    totals["failures"] += 0 if ok else 1
+    totals["wall_s"] = round(totals["wall_s"] + metrics["wall_s"], 4)
+    totals["cpu_s"] = round(totals["cpu_s"] + metrics["cpu_s"], 4)
+    _save(summary)
+
+
+def running_count(key: str, path: Path, added: int, overwrite: bool):
+    """
+    The row count of the dataset at path after `added` rows were written,
+    carried forward from the summary. Counted once from the dataset when
+    the summary predates the key.
+    """
+    if overwrite:
+        return added
+    previous = load_summary().get(key)
+    if previous is None:
+        if not dataset_exists(path):
+            return added
+        return len(read_dataset(path, columns=["client_ip"]))
+    return previous + added
+
+
+def summarize_datasets():
+    """
+    The /status fields worked out from the datasets themselves, for when
+    nothing has been published yet.
+    """
+    summary = {}
+    feats = read_dataset(FEATURES, columns=["client_ip", "minute"])
+    if not feats.empty:
+        summary["num_feature_rows"] = len(feats)
+        summary["num_devices"] = feats["client_ip"].nunique()
+        summary["last_feature_time"] = feats["minute"].max().isoformat()
+    alerts = read_dataset(ALERTS, columns=["minute", "combined_score"])
+    if not alerts.empty:
+        summary["num_alert_rows"] = len(alerts)
+        summary["last_alert_time"] = alerts["minute"].max().isoformat()
+        summary["highest_anomaly_score"] = float(alerts["combined_score"].max())
+    return summary
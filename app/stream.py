@@ -0,0 +1,191 @@
+import time
+import uuid
+import argparse
+import pandas as pd
+from pathlib import Path
+
+from .celery_app import celery_app
+from .lock import refresh_lock, LockLost
+from .ingest.retrieve_logs import pull_logs, CommandLogSource, LocalLogSource, LOCAL, REMOTE
+from .ingest.parse_querylog import ingest_spool
+from .ingest.state_manager import load_state
+from .features.build_features import update_windows, read_queries, build_windows, needs_rebuild
+from .models.detector import detect_windows, detect_jobs
+from .storage.events import ALERT_THRESHOLD
+
+# seconds between pulls from the router
+POLL_SECONDS = 5
+# how long after a minute ends its window stays open for late queries;
+# anything arriving after the window was emitted is dropped
+LATENESS = pd.Timedelta("30s")
+# expiry of the refresh lock while a step holds it, renewed before each of
+# its stages; well past the longest detect of a refresh
+LOCK_TTL = 900
+
+
+class StreamingPipeline:
+    """
+    Long-running ingest -> features -> detection. Each step pulls the new
+    querylog bytes, keeps the queries of still-open (device, minute) windows
+    in memory, and once the event-time watermark (newest query seen minus
+    `lateness`) passes the end of a minute, builds that minute's feature
+    rows and scores them. Detection pushes the alerts to the event log
+    (app.storage.events) like a Refresh does; `sink`, if given, also gets
+    every scored window at or above `threshold`. Model fits run across
+    n_jobs processes (detector.detect_jobs() by default).
+
+    It shares state.json and the datasets with the batch pipeline, so each
+    step holds the refresh lock (the one start_refresh and retention take):
+    a poll that finds it held skips, and a Refresh or retention run gets
+    its turn between steps. If one did run, the open windows are picked up
+    from the datasets again.
+    """
+
+    def __init__(self, source=None, freq="1min", lateness=LATENESS, sink=None,
+                 threshold=ALERT_THRESHOLD, spool: Path = LOCAL, remote: str = REMOTE, n_jobs=None,
+                 lock=None):
+        self.source = source
+        self.remote = remote
+        self.freq = freq
+        self.lateness = pd.Timedelta(lateness)
+        self.sink = sink
+        self.threshold = threshold
+        self.spool = spool
+        self.n_jobs = detect_jobs() if n_jobs is None else n_jobs
+        self.lock = refresh_lock(celery_app.conf.broker_url) if lock is None else lock
+        self.token = f"stream-{uuid.uuid4().hex}"
+        self.holding = False
+        # the watermarks as this pipeline left them, see _moved
+        self.watermarks = None
+
+        # queries of the windows that haven't closed yet; picked up from the
+        # query dataset on the first step in case a previous run left some open
+        self.buffer = None
+        self.max_time = None
+        self.late_dropped = 0
+        # device -> model artifact, so the forests stay loaded between steps
+        self.models = {}
+
+    def _hold(self):
+        """Renews the lock before a stage of a step (process alone runs without it)."""
+        if self.holding and not self.lock.renew(self.token, LOCK_TTL):
+            raise LockLost(f"stream {self.token} no longer holds the refresh lock")
+
+    def _moved(self):
+        """Whether something else wrote the datasets since the last step."""
+        state = load_state()
+        watermarks = tuple(state.get(k) for k in ("last_ingested_time", "last_window_minute", "last_detected_minute"))
+        moved = self.watermarks is not None and watermarks != self.watermarks
+        self.watermarks = watermarks
+        return moved
+
+    def _resume(self):
+        state = load_state()
+        if needs_rebuild(state):
+            # features from an older FEATURES_VERSION: rebuild before streaming on
+            build_windows(freq=self.freq)
+            state = load_state()
+        self.buffer = pd.DataFrame()
+        if state.get("last_window_minute") is not None:
+            self.buffer = read_queries(freq=self.freq, after=state["last_window_minute"])
+            if not self.buffer.empty:
+                self.max_time = self.buffer["time"].max()
+
+    def step(self):
+        """
+        One poll: pull, ingest, close what the watermark allows. Returns the
+        scored windows (empty if no minute closed, or the refresh lock is
+        held elsewhere).
+        """
+        if not self.lock.acquire(self.token, LOCK_TTL):
+            return pd.DataFrame()
+        self.holding = True
+        try:
+            if self.buffer is None or self._moved():
+                self._resume()
+            if self.source is not None:
+                pull_logs(self.source, spool=self.spool, remote=self.remote)
+            if not self.spool.exists():
+                return pd.DataFrame()
+            self._hold()
+            batches = list(ingest_spool(self.spool))
+            if not batches:
+                return pd.DataFrame()
+            return self.process(pd.concat(batches, ignore_index=True))
+        finally:
+            self._moved()
+            self.holding = False
+            self.lock.release(self.token)
+
+    def process(self, df: pd.DataFrame):
+        """
+        Adds parsed queries to the open windows and emits the closed ones.
+        """
+        df = df.assign(minute=df["time"].dt.floor(self.freq))
+        last_window_minute = load_state().get("last_window_minute")
+        if last_window_minute is not None:
+            late = df["minute"] <= last_window_minute
+            self.late_dropped += int(late.sum())
+            df = df[~late]
+        if df.empty:
+            return pd.DataFrame()
+
+        newest = df["time"].max()
+        self.max_time = newest if self.max_time is None else max(self.max_time, newest)
+        tz = df["time"].dt.tz
+        if not self.buffer.empty and self.buffer["time"].dt.tz != tz:
+            # the resumed buffer comes back from Parquet with an equivalent but
+            # different tz object, which concat would turn into object dtype
+            self.buffer = self.buffer.assign(
+                time=self.buffer["time"].dt.tz_convert(tz),
+                minute=self.buffer["minute"].dt.tz_convert(tz),
+            )
+        # a resumed buffer can be empty, which concat warns about
+        self.buffer = pd.concat([self.buffer, df], ignore_index=True) if not self.buffer.empty else df.reset_index(drop=True)
+
+        watermark = self.max_time - self.lateness
+        closed = self.buffer["minute"] + pd.Timedelta(self.freq) <= watermark
+        ready = self.buffer[closed]
+        self.buffer = self.buffer[~closed].reset_index(drop=True)
+        if ready.empty:
+            return pd.DataFrame()
+
+        self._hold()
+        windows = update_windows(ready.sort_values("time"), load_state(), freq=self.freq)
+        self._hold()
+        scored = detect_windows(windows, n_jobs=self.n_jobs, models=self.models)
+        if self.sink is not None and not scored.empty:
+            alerts = scored[scored["combined_score"] >= self.threshold]
+            if not alerts.empty:
+                self.sink(alerts)
+        return scored
+
+    def run(self, poll=POLL_SECONDS, max_steps=None):
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            started = time.monotonic()
+            scored = self.step()
+            if not scored.empty:
+                print(
+                    f"{scored['minute'].max()}: {len(scored)} windows scored, "
+                    f"{len(self.buffer)} queries open, {self.late_dropped} late dropped"
+                )
+            steps += 1
+            time.sleep(max(0.0, poll - (time.monotonic() - started)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the pipeline continuously.")
+    parser.add_argument("--poll", type=float, default=POLL_SECONDS)
+    parser.add_argument("--lateness", default=str(LATENESS), help="e.g. 30s, 2min")
+    parser.add_argument("--local-log", help="tail this file instead of the router's querylog")
+    parser.add_argument("--jobs", type=int, help="worker processes for model fits (default: one per core)")
+    args = parser.parse_args()
+
+    pipeline = StreamingPipeline(
+        source=LocalLogSource() if args.local_log else CommandLogSource(),
+        remote=args.local_log or REMOTE,
+        lateness=args.lateness,
+        n_jobs=args.jobs,
+    )
+    pipeline.run(poll=args.poll)
@@ -1,17 +1,201 @@
+import uuid
+import pandas as pd
+from celery import chain
+
 from .celery_app import celery_app
-from .ingest.retrieve_logs import pull_logs
+from .lock import refresh_lock, LockLost
+from .ingest.retrieve_logs import pull_logs, LOCAL
 from .ingest.parse_querylog import write_csv
-from .features.build_features import build_windows
-from .models.detector import detect
+from .ingest.state_manager import load_state
+from .features.build_features import build_windows, needs_rebuild
+from .models.detector import detect, detect_jobs
+from .retention import apply_retention
+from .storage.parquet_store import DNS, dataset_exists
+from .storage.events import emit
+from .metrics import stage_metrics
 from pathlib import Path
 
-@celery_app.task(bind=True)
-def run_refresh(self):
+# seconds each stage may run (its Celery time_limit)
+STAGE_LIMITS = {"pull": 120, "ingest": 300, "features": 300, "detect": 600}
+# detect's retries, the n-th waiting up to DETECT_BACKOFF * 2 ** n seconds
+DETECT_RETRIES = 2
+DETECT_BACKOFF = 30
+# longest a refresh may hold the lock: every stage at its limit and detect
+# retried to the end, plus slack for the queue; a crashed run frees it
+# after this. Each stage also renews it when it starts, see _hold_lock.
+REFRESH_LOCK_TTL = (
+    sum(STAGE_LIMITS.values())
+    + DETECT_RETRIES * STAGE_LIMITS["detect"]
+    + DETECT_BACKOFF * (2 ** DETECT_RETRIES - 1)
+    + 300
+)
+FREQ = "1min"
+# refresh tokens (finish_refresh's task id) start with this; the stream and
+# retention take the same lock under tokens that aren't task ids to poll
+REFRESH_TOKEN_PREFIX = "refresh-"
+REFRESH_STAGES = ["pull", "ingest", "features", "detect"]
+
+
+def _skipped(stage, reason):
+    emit("progress", {"stage": stage, "status": "skipped", "reason": reason})
+    return {"stage": stage, "skipped": reason}
+
+
+def _hold_lock(token):
+    """
+    Renews the refresh lock for a stage of the refresh holding `token`
+    (None when a stage is run on its own), and stops the stage if the lock
+    expired, since another refresh may be writing by now.
+    """
+    if token is None:
+        return
+    if not refresh_lock(celery_app.conf.broker_url).renew(token, REFRESH_LOCK_TTL):
+        raise LockLost(f"refresh {token} no longer holds the lock")
+
+
+@celery_app.task(time_limit=STAGE_LIMITS["pull"])
+def pull_stage(token=None):
+    _hold_lock(token)
+    emit("progress", {"stage": "pull", "status": "started"})
     pull_logs()
-    csv_path = write_csv(
-        in_path=Path("data/querylog.json"),
-        out_path=Path("data/sample_dns.csv")
-    )
-    build_windows(src_path=csv_path)
-    detect()
-    return "done"
+    emit("progress", {"stage": "pull", "status": "done"})
+    return {"stage": "pull", "metrics": stage_metrics(["pull"])["pull"]}
+
+
+@celery_app.task(time_limit=STAGE_LIMITS["ingest"])
+def ingest_stage(token=None):
+    _hold_lock(token)
+    state = load_state()
+    spool = LOCAL
+    if not spool.exists():
+        return _skipped("ingest", "no spool")
+    if (
+        state.get("last_ingested_time") is not None
+        and dataset_exists(DNS)
+        and spool.stat().st_size == (state.get("spool_offset") or 0)
+    ):
+        return _skipped("ingest", "no new bytes in the spool")
+    emit("progress", {"stage": "ingest", "status": "started"})
+    write_csv(in_path=Path("data/querylog.json"), out_path=DNS)
+    return {"stage": "ingest", "metrics": stage_metrics(["ingest"])["ingest"]}
+
+
+@celery_app.task(time_limit=STAGE_LIMITS["features"])
+def features_stage(token=None):
+    _hold_lock(token)
+    state = load_state()
+    last_ingested = state.get("last_ingested_time")
+    last_window = state.get("last_window_minute")
+    if last_ingested is None:
+        return _skipped("features", "nothing ingested")
+    if (
+        last_window is not None
+        and not needs_rebuild(state)
+        and pd.Timestamp(last_ingested).floor(FREQ) <= last_window
+    ):
+        return _skipped("features", "no queries past last_window_minute")
+    emit("progress", {"stage": "features", "status": "started"})
+    build_windows(src_path=DNS, freq=FREQ)
+    return {"stage": "features", "metrics": stage_metrics(["features"])["features"]}
+
+
+# the model fits are the slow part and the one worth retrying; a failed
+# run left nothing committed (state_manager.Commit), so a retry starts clean
+@celery_app.task(
+    time_limit=STAGE_LIMITS["detect"],
+    autoretry_for=(Exception,),
+    dont_autoretry_for=(LockLost,),
+    retry_backoff=DETECT_BACKOFF,
+    max_retries=DETECT_RETRIES,
+)
+def detect_stage(token=None):
+    _hold_lock(token)
+    state = load_state()
+    last_window = state.get("last_window_minute")
+    last_detected = state.get("last_detected_minute")
+    if last_window is None:
+        return _skipped("detect", "no features")
+    if last_detected is not None and last_window <= last_detected:
+        return _skipped("detect", "no windows past last_detected_minute")
+    emit("progress", {"stage": "detect", "status": "started"})
+    detect(n_jobs=detect_jobs())
+    return {"stage": "detect", "metrics": stage_metrics(["detect"])["detect"]}
+
+
+@celery_app.task
+def finish_refresh(token):
+    """
+    Last link of the chain; its result (what /task-status shows for a
+    refresh) carries each stage's measurements. A stage skipped in this
+    run shows the numbers of the run before, with its older finished_at.
+    """
+    refresh_lock(celery_app.conf.broker_url).release(token)
+    emit("progress", {"stage": "refresh", "status": "done", "task_id": token})
+    return {"status": "done", "stages": stage_metrics(REFRESH_STAGES)}
+
+
+@celery_app.task
+def refresh_failed(token):
+    refresh_lock(celery_app.conf.broker_url).release(token)
+    # finish_refresh never runs, mark its id failed so /task-status stops waiting
+    celery_app.backend.mark_as_failure(token, RuntimeError("refresh failed, see the stage task"))
+    emit("progress", {"stage": "refresh", "status": "failed", "task_id": token})
+
+
+def start_refresh():
+    """
+    Starts the pull -> ingest -> features -> detect chain unless one is
+    already running. Returns the id to poll: finish_refresh's, which
+    succeeds when the whole chain has run (or fails with it). If a refresh
+    holds the lock, that refresh's id is returned instead, and None if
+    something else (the stream, retention) holds it.
+    """
+    lock = refresh_lock(celery_app.conf.broker_url)
+    token = REFRESH_TOKEN_PREFIX + uuid.uuid4().hex
+    if not lock.acquire(token, REFRESH_LOCK_TTL):
+        holder = lock.holder()
+        if holder is not None and holder.startswith(REFRESH_TOKEN_PREFIX):
+            return holder
+        return None
+
+    try:
+        chain(
+            pull_stage.si(token),
+            ingest_stage.si(token),
+            features_stage.si(token),
+            detect_stage.si(token),
+            finish_refresh.si(token).set(task_id=token),
+        ).on_error(refresh_failed.si(token)).apply_async()
+    except Exception:
+        lock.release(token)
+        raise
+    emit("progress", {"stage": "refresh", "status": "started", "task_id": token})
+    return token
+
+
+@celery_app.task(bind=True, time_limit=1800)
+def retention_task(self):
+    """
+    Drops expired partitions and compacts the datasets (app.retention)
+    while holding the refresh lock, so no refresh writes in between. If a
+    refresh is running it is skipped and the next beat tick tries again.
+    Meanwhile start_refresh returns None.
+    """
+    lock = refresh_lock(celery_app.conf.broker_url)
+    token = f"retention-{self.request.id or uuid.uuid4().hex}"
+    if not lock.acquire(token, REFRESH_LOCK_TTL):
+        return _skipped("retention", "refresh running")
+    try:
+        emit("progress", {"stage": "retention", "status": "started"})
+        datasets = apply_retention()
+    finally:
+        lock.release(token)
+    return {"stage": "retention", "metrics": stage_metrics(["retention"])["retention"], "datasets": datasets}
+
+
+@celery_app.task
+def run_refresh():
+    """
+    Entry point for celery beat (see celery_app.beat_schedule).
+    """
+    return start_refresh()
@@ -1,43 +1,131 @@
 import streamlit as st, pandas as pd
+import pyarrow as pa
 import requests
+import json
+import time
 from pathlib import Path
 
 URL = "http://127.0.0.1:8000"
-
-def get_json(path: str):
-    r = requests.get(f"{URL}{path}", timeout=50)
+# how far back "Recent feature windows" goes from the newest window
+RECENT_FEATURES = pd.Timedelta("1h")
+# live alerts kept on screen; older ones are in the tables above after a rerun
+LIVE_ALERTS = 200
+LIVE_COLUMNS = ["client_ip", "minute", "qpm", "uniq", "avg_len", "score", "Mahalanobis", "combined_score"]
+
+def get_json(path: str, **params):
+    r = requests.get(f"{URL}{path}", params=params, timeout=50)
     r.raise_for_status()
     return r.json()
 
+def get_frame(path: str, **params):
+    """
+    Frame endpoints (/alerts, /features, /devices/{ip}/history) as a
+    DataFrame, fetched as an Arrow IPC stream instead of JSON records.
+    """
+    r = requests.get(
+        f"{URL}{path}",
+        params=params,
+        headers={"Accept": "application/vnd.apache.arrow.stream"},
+        timeout=50,
+    )
+    r.raise_for_status()
+    return pa.ipc.open_stream(r.content).read_pandas()
+
+def sse_events(resp):
+    """
+    (id, type, data) for each event of a text/event-stream response, and
+    (None, None, None) for each keepalive comment.
+    """
+    event_id, event_type, data = None, None, []
+    for line in resp.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if line == "":
+            if data:
+                yield event_id, event_type, json.loads("\n".join(data))
+            event_type, data = None, []
+        elif line.startswith(":"):
+            yield None, None, None
+        elif line.startswith("id:"):
+            event_id = line[3:].strip()
+        elif line.startswith("event:"):
+            event_type = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[5:].strip())
+
+def follow_events(progress_box, alerts_box, score_box):
+    """
+    Tails /events until the script is rerun: alerts are prepended to the
+    live table as they are scored, stage progress goes to progress_box, and
+    the page reloads its data once when a refresh finishes. The last event
+    id is kept in the session so a rerun picks up where this left off.
+    """
+    live = st.session_state.setdefault("live_alerts", [])
+    progress = "Waiting for pipeline events..."
+    progress_box.caption(progress)
+    if live:
+        alerts_box.dataframe(pd.DataFrame(live).reindex(columns=LIVE_COLUMNS))
+
+    while True:
+        params = {}
+        if st.session_state.get("event_id"):
+            params["since"] = st.session_state["event_id"]
+        try:
+            # a keepalive every second: streamlit only notices a widget change
+            # (and reruns the script) when this loop touches an element
+            params["heartbeat"] = 1
+            with requests.get(f"{URL}/events", params=params, stream=True, timeout=(5, 30)) as resp:
+                resp.raise_for_status()
+                for event_id, event_type, event in sse_events(resp):
+                    if event_id is None:
+                        progress_box.caption(progress)
+                        continue
+                    st.session_state["event_id"] = event_id
+                    data = event["data"]
+                    if event_type == "alert":
+                        live.insert(0, data)
+                        del live[LIVE_ALERTS:]
+                        alerts_box.dataframe(pd.DataFrame(live).reindex(columns=LIVE_COLUMNS))
+                        highest = max(st.session_state.get("highest_score", 0.0), data.get("combined_score", 0.0))
+                        st.session_state["highest_score"] = highest
+                        score_box.metric(label="Highest Combined Anomaly Score", value=highest, border=True)
+                    elif event_type == "progress":
+                        stage, status = data.get("stage"), data.get("status")
+                        detail = f" ({data['reason']})" if status == "skipped" else ""
+                        if status == "done" and "rows_out" in data:
+                            detail = f" ({data['rows_out']} rows in {data['duration_s']:.1f}s)"
+                        progress = f"{event['time']}: {stage} {status}{detail}"
+                        progress_box.caption(progress)
+                        if stage == "refresh" and status in ("done", "failed"):
+                            st.session_state.pop("refresh_task", None)
+                            st.rerun()
+        except (requests.ConnectionError, requests.Timeout):
+            progress = "Event stream disconnected, reconnecting..."
+            progress_box.caption(progress)
+            time.sleep(2)
+
 st.set_page_config(page_title="Guardian AIGIS", layout="wide")
 
 if st.button("Refresh (Ingest → Build → Detect)"):
     resp = requests.post(f"{URL}/refresh", timeout=50)
-    task_id = resp.json().get("task_id")
-
-    if task_id:
-        with st.spinner("Refreshing logs, building features, running detector..."):
-            import time
-            while True:
-                status = requests.get(f"{URL}/task-status/{task_id}", timeout=5).json()
-                state = status.get("state")
-
-                if state in ("SUCCESS", "FAILURE", "REVOKED"):
-                    break
+    if resp.status_code == 409:
+        # no refresh to follow, the stream or retention has the datasets
+        st.warning("Busy, try again shortly: " + resp.json()["detail"])
+    else:
+        # progress and completion arrive on the event stream (see follow_events)
+        st.session_state["refresh_task"] = resp.json().get("task_id")
 
-                time.sleep(2)
-
-        st.success("Refresh complete!")
-        st.rerun()
+if st.session_state.get("refresh_task"):
+    st.info("Refreshing logs, building features, running detector...")
 
     
-alerts_resp = get_json("/alerts")
-features_resp = get_json("/features")
-devices_resp = get_json("/devices")
 status_resp = get_json("/status")
-
-alerts = pd.DataFrame(alerts_resp["alerts"])
-feats = pd.DataFrame(features_resp["features"])
+alerts = get_frame("/alerts")
+devices_resp = get_json("/devices")
+recent_since = None
+if status_resp.get("last_feature_time"):
+    recent_since = (pd.Timestamp(status_resp["last_feature_time"]) - RECENT_FEATURES).isoformat()
+feats = get_frame("/features", since=recent_since, limit=10_000)
 
 # num_devices = 0
 highest_anomaly_score = 0.0
@@ -63,7 +151,9 @@ st.title("Guardian AIGIS")
 
 dev, max_time, last_timestamp, last_refresh_timestamp = st.columns(4)
 dev.metric(label="Devices", value=num_devices, border=True)
-max_time.metric(label="Highest Combined Anomaly Score", value=highest_anomaly_score, border=True)
+st.session_state["highest_score"] = highest_anomaly_score
+score_box = max_time.empty()
+score_box.metric(label="Highest Combined Anomaly Score", value=highest_anomaly_score, border=True)
 last_timestamp.metric(label="Last Time", value=last_time, border=True)
 last_refresh_timestamp.metric(label="Last Refresh Time", value=status_resp.get("last_refresh_timestamp"), border=True)
 
@@ -71,8 +161,7 @@ if len(ip_list) > 0 and not alerts.empty:
     dropdown = st.selectbox(label="Pick Device", options=ip_list, index=None, placeholder="Select Device")
     time_slider = st.select_slider(label="History Slider", options=["0", "1m", "5m", "10m", "30m", "1h", "2h", "3h", "4h", "5h", "6h", "1d", "2d"], value="0")
     if dropdown is not None:
-        history_resp = get_json(f"/devices/{dropdown}/history?since={time_slider}")
-        history = pd.DataFrame(history_resp["history"])
+        history = get_frame(f"/devices/{dropdown}/history", since=time_slider)
 
         if not history.empty:
             history["minute"] = pd.to_datetime(history["minute"])
@@ -111,4 +200,9 @@ st.dataframe(filtered_alerts[["client_ip","minute","qpm","uniq","avg_len","score
 st.subheader("Recent feature windows")
 st.dataframe(feats)
 
+st.subheader("Live alerts")
+progress_box = st.empty()
+alerts_box = st.empty()
+follow_events(progress_box, alerts_box, score_box)
+
 
@@ -0,0 +1,67 @@
+"""
+Payload size and request-to-DataFrame latency of /features in the three
+response formats: JSON records (the default), orjson columnar JSON and
+Arrow IPC. Runs the app in-process with TestClient against a synthetic
+features dataset in a temporary directory.
+
+    python -m benchmarks.bench_api_formats --devices 200 --minutes 600 --limit 10000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import orjson
+import pandas as pd
+import pyarrow as pa
+
+from benchmarks.synthetic import make_feature_frame
+
+
+def decode(fmt, resp):
+    if fmt == "arrow":
+        return pa.ipc.open_stream(resp.content).read_pandas()
+    if fmt == "columns":
+        return pd.DataFrame(orjson.loads(resp.content)["features"])
+    return pd.DataFrame(resp.json()["features"])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--minutes", type=int, default=600)
+    parser.add_argument("--limit", type=int, default=10_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        # imported here so the relative data/ paths resolve inside tmp
+        from fastapi.testclient import TestClient
+        from app.api.main import app
+        from app.storage.parquet_store import FEATURES, write_dataset
+
+        df = make_feature_frame(args.devices, args.minutes)
+        df["minute"] = df["minute"].dt.tz_localize("-05:00")
+        write_dataset(FEATURES, df, mode="overwrite")
+        client = TestClient(app)
+        print(f"{len(df):,} feature rows, pages of {args.limit:,}")
+
+        base = None
+        for fmt in ("records", "columns", "arrow"):
+            times = []
+            for _ in range(args.repeat):
+                t0 = time.perf_counter()
+                resp = client.get("/features", params={"limit": args.limit, "format": fmt})
+                frame = decode(fmt, resp)
+                times.append(time.perf_counter() - t0)
+            best = min(times)
+            base = base or best
+            print(
+                f"{fmt:>8}: {len(resp.content) / 1e6:7.2f} MB, {best * 1000:8.1f} ms "
+                f"({base / best:.1f}x), {len(frame):,} rows"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""
+Scaling of the per-device IsolationForest fits in detect() across worker
+counts, checking that the scores do not depend on the worker count.
+
+    python -m benchmarks.bench_detect_workers --devices 200 --workers 1 2 4 8
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from app.models.detector import fit_devices
+from benchmarks.synthetic import make_feature_frame
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--minutes", type=int, default=600)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    df = make_feature_frame(args.devices, args.minutes)
+    jobs = [
+        (device, grp, grp, 0)
+        for device, grp in df.groupby("client_ip")
+    ]
+    print(f"{len(df):,} windows, {len(jobs)} devices, {os.cpu_count()} cpus")
+
+    reference = None
+    base = None
+    for n_jobs in args.workers:
+        t0 = time.perf_counter()
+        results = fit_devices(jobs, n_jobs=n_jobs)
+        elapsed = time.perf_counter() - t0
+
+        scores = np.concatenate([scored["score"].to_numpy() for _, _, scored in results])
+        if reference is None:
+            reference, base = scores, elapsed
+        assert np.array_equal(scores, reference), f"scores differ at n_jobs={n_jobs}"
+
+        print(f"n_jobs={n_jobs:<3} {elapsed:8.2f}s  speedup {base / elapsed:5.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Feature kernel timings on synthetic DNS logs, old groupby/agg lambdas on
+the client_ip/domain strings vs compute_window_features on interned codes
+(interning itself is timed on its own).
+
+    python -m benchmarks.bench_features --sizes 100000 1000000 10000000
+
+The old path is slow enough that it is skipped above --legacy-max rows.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from app.features.build_features import (
+    compute_baseline_probs,
+    compute_window_features,
+    decode_windows,
+    intern_queries,
+    shannon_entropy_calc,
+    top_domain_ratio_calc,
+)
+from app.storage.interning import Interner
+from benchmarks.synthetic import make_dns_frame
+
+
+def legacy_window_features(df, epsilon=1e-7):
+    baseline = df.groupby(["client_ip", "domain"]).size()
+    baseline = baseline / baseline.groupby(level=0).transform("sum")
+    counts = df.groupby(["client_ip", "minute", "domain"]).size()
+    window_probs = counts.groupby(level=[0, 1]).apply(lambda s: s / s.sum()).droplevel([0, 1])
+    baseline_probs = baseline.reindex(window_probs.index.droplevel(1), fill_value=0).to_numpy()
+    p_t, p_b = window_probs + epsilon, baseline_probs + epsilon
+    KL_series = (p_t * np.log(p_t / p_b)).groupby(level=[0, 1]).sum()
+
+    g = (
+        df.groupby(["client_ip", "minute"])
+          .agg(
+              qpm=("domain", "count"),
+              uniq=("domain", "nunique"),
+              avg_len=("domain", lambda s: s.str.len().mean()),
+              len_std=("domain", lambda s: s.str.len().std()),
+              top_domain_ratio=("domain", top_domain_ratio_calc),
+              shannon_entropy=("domain", shannon_entropy_calc),
+              new_domain_ratio=("is_new_domain", "mean"),
+          )
+          .reset_index()
+          .fillna(0)
+    )
+    return g.merge(
+        KL_series.rename("KL_divergence"),
+        on=["client_ip", "minute"],
+        how="left"
+    ).fillna({"KL_divergence": 0})
+
+
+def timed(fn, *args):
+    t0 = time.perf_counter()
+    out = fn(*args)
+    return out, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=float, nargs="+", default=[1e5, 1e6, 1e7])
+    parser.add_argument("--legacy-max", type=float, default=1e6)
+    args = parser.parse_args()
+
+    print(f"{'rows':>12} {'windows':>9} {'legacy s':>10} {'intern s':>9} {'kernel s':>10} {'speedup':>8} {'max diff':>10}")
+    for n in map(int, args.sizes):
+        df = make_dns_frame(n)
+        df["minute"] = df["time"].dt.floor("1min")
+        df["is_new_domain"] = df.groupby(["client_ip", "domain"]).cumcount() == 0
+
+        devices = Interner(None)
+        coded, t_intern = timed(intern_queries, df, devices, Interner(None))
+        coded["is_new_domain"] = df["is_new_domain"]
+        baseline_probs = compute_baseline_probs(coded)
+        new, t_new = timed(compute_window_features, coded, baseline_probs)
+
+        t_old, diff = float("nan"), float("nan")
+        if n <= args.legacy_max:
+            old, t_old = timed(legacy_window_features, df)
+            new = decode_windows(new, df["minute"].dt.tz, devices)
+            new = new.astype({"client_ip": str}).sort_values(["client_ip", "minute"], ignore_index=True)
+            cols = [c for c in old.columns if c not in ("client_ip", "minute")]
+            assert old[["client_ip", "minute"]].equals(new[["client_ip", "minute"]])
+            diff = float(np.abs(old[cols].to_numpy(float) - new[cols].to_numpy(float)).max())
+
+        print(
+            f"{n:>12,} {len(new):>9,} {t_old:>10.2f} {t_intern:>9.2f} {t_new:>10.2f}"
+            f" {t_old / (t_intern + t_new):>8.1f} {diff:>10.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
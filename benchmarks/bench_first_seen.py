@@ -0,0 +1,80 @@
+"""
+Rows/sec for the domain_first_seen bookkeeping in build_windows, comparing
+the old per-row loops with the groupby-min index.
+
+    python -m benchmarks.bench_first_seen --rows 200000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from app.features.build_features import build_first_seen, merge_first_seen, flag_new_domains, intern_queries
+from app.storage.interning import Interner
+from benchmarks.synthetic import make_dns_frame
+
+
+def legacy_first_seen(df_old, df_new):
+    # the iterrows / apply version build_windows used to run
+    domain_first_seen = {}
+    for _, row in df_old.iterrows():
+        domain_first_seen.setdefault(row["client_ip"], {})
+        domain_first_seen[row["client_ip"]].setdefault(row["domain"], row["time"])
+
+    for _, row in df_new.iterrows():
+        device, domain, t = row["client_ip"], row["domain"], row["time"]
+        if device not in domain_first_seen:
+            domain_first_seen[device] = {}
+        if domain not in domain_first_seen[device]:
+            domain_first_seen[device][domain] = t
+
+    return df_new.apply(
+        lambda r: r["time"] == domain_first_seen[r["client_ip"]][r["domain"]],
+        axis=1,
+    ).to_numpy()
+
+
+def vectorized_first_seen(df_old, df_new):
+    devices, domains = Interner(None), Interner(None)
+    df_old = intern_queries(df_old, devices, domains)
+    df_new = intern_queries(df_new, devices, domains)
+    first_seen = build_first_seen(df_old)
+    first_seen = merge_first_seen(first_seen, df_new)
+    return flag_new_domains(df_new, first_seen)
+
+
+def new_domain_ratio(df, is_new):
+    df = df.assign(is_new_domain=is_new)
+    return df.groupby(["client_ip", "minute"])["is_new_domain"].mean()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200_000)
+    args = parser.parse_args()
+
+    df = make_dns_frame(args.rows)
+    df["minute"] = df["time"].dt.floor("1min")
+    split = len(df) // 2
+    df_old, df_new = df.iloc[:split], df.iloc[split:].copy()
+
+    t0 = time.perf_counter()
+    old = legacy_first_seen(df_old, df_new)
+    t_old = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    new = vectorized_first_seen(df_old, df_new)
+    t_new = time.perf_counter() - t0
+
+    assert np.array_equal(old, new)
+    pd.testing.assert_series_equal(new_domain_ratio(df_new, old), new_domain_ratio(df_new, new))
+
+    print(f"rows:       {len(df):,}")
+    print(f"loops:      {t_old:8.3f}s  {len(df) / t_old:>14,.0f} rows/s")
+    print(f"vectorized: {t_new:8.3f}s  {len(df) / t_new:>14,.0f} rows/s")
+    print(f"speedup:    {t_old / t_new:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
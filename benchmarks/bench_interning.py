@@ -0,0 +1,139 @@
+"""
+Peak memory and groupby time of the features kernel on a large synthetic
+log: the previous compute_window_features, grouping by the client_ip and
+domain categoricals read_dataset returns and datetime minutes, vs the
+current one on interned int32 device/domain codes and int64 epoch
+minutes. Each variant runs in its own process on the same Parquet file so
+their peak RSS doesn't mix.
+
+    python -m benchmarks.bench_interning --rows 10000000
+"""
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from app.metrics import _peak_rss, _reset_peak
+from benchmarks.synthetic import make_dns_frame
+
+VARIANTS = ["categorical", "codes"]
+
+
+def categorical_window_features(df, epsilon=1e-7):
+    # the kernel before interning, with the baseline lookup keyed by strings
+    keys = ["client_ip", "minute"]
+    baseline = df.groupby(["client_ip", "domain"], observed=True).size()
+    baseline = baseline / baseline.groupby(level=0, observed=True).transform("sum")
+
+    counts = df.groupby(keys + ["domain"], observed=True).size().rename("count")
+    by_window = counts.groupby(level=[0, 1], observed=True)
+    total = by_window.transform("sum")
+    probs = counts / total
+
+    p_b = baseline.reindex(probs.index.droplevel(1), fill_value=0).to_numpy() + epsilon
+    p_t = probs + epsilon
+    kl = (p_t * np.log(p_t / p_b)).groupby(level=[0, 1], observed=True).sum()
+
+    domain_stats = pd.DataFrame({
+        "uniq": by_window.size(),
+        "top_domain_ratio": by_window.max() / by_window.sum(),
+        "shannon_entropy": -(probs * np.log2(probs)).groupby(level=[0, 1], observed=True).sum(),
+        "KL_divergence": kl,
+    })
+    query_stats = (
+        df[keys]
+          .assign(dlen=df["domain"].str.len(), is_new_domain=df["is_new_domain"])
+          .groupby(keys, observed=True)
+          .agg(
+              qpm=("dlen", "size"),
+              avg_len=("dlen", "mean"),
+              len_std=("dlen", "std"),
+              new_domain_ratio=("is_new_domain", "mean"),
+          )
+    )
+    return query_stats.join(domain_stats).fillna(0).reset_index()
+
+
+def coded_window_features(df):
+    from app.features.build_features import compute_baseline_probs, compute_window_features, intern_queries
+    from app.storage.interning import Interner
+
+    coded = intern_queries(df, Interner(None), Interner(None))
+    coded["is_new_domain"] = df["is_new_domain"]
+    return compute_window_features(coded, compute_baseline_probs(coded))
+
+
+def child(variant, path):
+    df = pd.read_parquet(path)
+    df["minute"] = df["time"].dt.floor("1min")
+    frame_bytes = int(df.memory_usage(deep=True).sum())
+    start_rss = _peak_rss()
+    _reset_peak()
+
+    t0 = time.perf_counter()
+    if variant == "categorical":
+        out = categorical_window_features(df)
+    else:
+        out = coded_window_features(df)
+    elapsed = time.perf_counter() - t0
+
+    print(json.dumps({
+        "variant": variant,
+        "windows": len(out),
+        "seconds": round(elapsed, 3),
+        "frame_bytes": frame_bytes,
+        "peak_rss_bytes": _peak_rss(),
+        "peak_over_frame_bytes": _peak_rss() - start_rss,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=float, default=1e7)
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--domains", type=int, default=50_000)
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(*args.child)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "queries.parquet"
+        df = make_dns_frame(int(args.rows), n_devices=args.devices, n_domains=args.domains)
+        df["is_new_domain"] = df.groupby(["client_ip", "domain"]).cumcount() == 0
+        # strings go to Parquet dictionary-encoded and come back categorical,
+        # like the query dataset does
+        df.astype({"client_ip": "category", "domain": "category"}).to_parquet(path)
+        del df
+
+        results = {}
+        for variant in VARIANTS:
+            out = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_interning", "--child", variant, str(path)],
+                capture_output=True, text=True, check=True,
+            )
+            results[variant] = json.loads(out.stdout.strip().splitlines()[-1])
+
+    mib = 1024 ** 2
+    print(f"rows: {int(args.rows):,}  windows: {results['codes']['windows']:,}")
+    print(f"{'variant':>12} {'seconds':>8} {'frame MiB':>10} {'peak MiB':>9} {'peak-frame MiB':>15}")
+    for variant, r in results.items():
+        print(
+            f"{variant:>12} {r['seconds']:>8.2f} {r['frame_bytes'] / mib:>10.0f}"
+            f" {r['peak_rss_bytes'] / mib:>9.0f} {r['peak_over_frame_bytes'] / mib:>15.0f}"
+        )
+    old, new = results["categorical"], results["codes"]
+    print(f"time: {old['seconds'] / new['seconds']:.1f}x faster, "
+          f"peak RSS: {1 - new['peak_rss_bytes'] / old['peak_rss_bytes']:.0%} lower")
+
+
+if __name__ == "__main__":
+    main()
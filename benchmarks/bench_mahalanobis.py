@@ -0,0 +1,72 @@
+"""
+Mahalanobis scoring: the old per-row loop against mahalanobis_score, and
+per-device calls against one mahalanobis_batch over stacked devices.
+
+    python -m benchmarks.bench_mahalanobis --rows 100000 --devices 300
+"""
+import argparse
+import time
+
+import numpy as np
+
+from app.models.detector import (
+    FEAT_COLS, mahalanobis_fit, mahalanobis_score, mahalanobis_batch,
+    mahalanobis_moments, update_moments,
+)
+
+
+def legacy_score(X, mu, inv_cov):
+    dists = []
+    for x in X:
+        diff = x - mu
+        d2 = diff.T @ inv_cov @ diff
+        dists.append(float(np.sqrt(max(d2, 0.0))))
+    return np.array(dists)
+
+
+def timed(fn, *args):
+    t0 = time.perf_counter()
+    out = fn(*args)
+    return out, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--devices", type=int, default=300)
+    parser.add_argument("--new-rows", type=int, default=5, help="new windows per device per detect")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    n_feat = len(FEAT_COLS)
+
+    X = rng.normal(size=(args.rows, n_feat))
+    mu, inv_cov = mahalanobis_fit(X)
+    old, t_old = timed(legacy_score, X, mu, inv_cov)
+    new, t_new = timed(mahalanobis_score, X, mu, inv_cov)
+    print(f"one device, {args.rows:,} rows: loop {t_old:.3f}s, einsum {t_new:.4f}s "
+          f"({t_old / t_new:.0f}x), max diff {np.abs(old - new).max():.1e}")
+
+    # one detect run: a few new windows for each of many devices
+    n_dev = args.devices
+    codes = np.repeat(np.arange(n_dev), args.new_rows)
+    X = rng.normal(size=(len(codes), n_feat))
+    moments = [mahalanobis_moments(rng.normal(size=(200, n_feat))) for _ in range(n_dev)]
+
+    t0 = time.perf_counter()
+    moments = [update_moments(m, X[codes == d]) for d, m in enumerate(moments)]
+    t_update = time.perf_counter() - t0
+
+    mus = np.stack([m["mean"] for m in moments])
+    inv_covs = np.stack([m["inv_cov"] for m in moments])
+    per_device, t_loop = timed(
+        lambda: np.concatenate([mahalanobis_score(X[codes == d], mus[d], inv_covs[d]) for d in range(n_dev)])
+    )
+    batched, t_batch = timed(mahalanobis_batch, X, codes, mus, inv_covs)
+    print(f"{n_dev} devices x {args.new_rows} rows: moment updates {t_update:.4f}s, "
+          f"per-device {t_loop:.4f}s, batched {t_batch:.4f}s "
+          f"({t_loop / t_batch:.1f}x), max diff {np.abs(per_device - batched).max():.1e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Load test for the API: starts uvicorn on a synthetic dataset in a temporary
+directory, hits the dashboard's endpoints from N concurrent clients and
+reports p50/p99 latency per concurrency level, for the data endpoints and
+for /ping measured alongside them.
+
+    python -m benchmarks.load_test_api --concurrency 1 4 16 64 --requests 400
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+from benchmarks.synthetic import make_feature_frame
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def write_data(n_devices, minutes):
+    from app.storage.parquet_store import FEATURES, ALERTS, ANOMALY_HISTORY, write_dataset
+
+    df = make_feature_frame(n_devices, minutes)
+    df["minute"] = df["minute"].dt.tz_localize("-05:00")
+    rng = np.random.default_rng(0)
+    history = df.assign(
+        score=rng.random(len(df)),
+        Mahalanobis=rng.random(len(df)),
+        combined_score=rng.random(len(df)),
+        pc1=rng.normal(size=len(df)),
+        pc2=rng.normal(size=len(df)),
+    )
+    alerts = history.groupby("client_ip").tail(1)
+    write_dataset(FEATURES, df, mode="overwrite")
+    write_dataset(ANOMALY_HISTORY, history, mode="overwrite")
+    write_dataset(ALERTS, alerts, mode="overwrite")
+    return sorted(df["client_ip"].unique())
+
+
+def wait_ready(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(f"{url}/ping", timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError("uvicorn did not come up")
+
+
+def percentiles(latencies):
+    ms = np.array(latencies) * 1000
+    return np.percentile(ms, 50), np.percentile(ms, 99)
+
+
+def run_level(url, paths, concurrency, n_requests):
+    local = threading.local()
+
+    def hit(i):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        t0 = time.perf_counter()
+        r = session.get(url + paths[i % len(paths)], timeout=120)
+        r.raise_for_status()
+        return time.perf_counter() - t0
+
+    ping, stop = [], threading.Event()
+
+    def probe():
+        with requests.Session() as session:
+            while not stop.is_set():
+                t0 = time.perf_counter()
+                session.get(f"{url}/ping", timeout=120)
+                ping.append(time.perf_counter() - t0)
+                time.sleep(0.02)
+
+    prober = threading.Thread(target=probe)
+    prober.start()
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(hit, range(n_requests)))
+    elapsed = time.perf_counter() - t0
+    stop.set()
+    prober.join()
+    return latencies, ping, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--minutes", type=int, default=1440)
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        devices = write_data(args.devices, args.minutes)
+
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        env = dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get("PYTHONPATH", ""))
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.api.main:app", "--port", str(port), "--log-level", "warning"],
+            env=env,
+        )
+        try:
+            wait_ready(url)
+            # what one dashboard rerun asks for
+            paths = ["/status", "/alerts", "/devices", "/features?limit=1000"]
+            paths += [f"/devices/{ip}/history?since=1h" for ip in devices[:8]]
+            print(f"{len(paths)} distinct requests, {args.requests} per level")
+            print(f"{'clients':>7} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'ping p50':>9} {'ping p99':>9}")
+            for concurrency in args.concurrency:
+                latencies, ping, elapsed = run_level(url, paths, concurrency, args.requests)
+                p50, p99 = percentiles(latencies)
+                ping50, ping99 = percentiles(ping) if ping else (float("nan"),) * 2
+                print(f"{concurrency:>7} {len(latencies) / elapsed:>8.1f} {p50:>8.1f} {p99:>8.1f} {ping50:>9.1f} {ping99:>9.1f}")
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
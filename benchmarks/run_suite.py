@@ -0,0 +1,264 @@
+"""
+End-to-end benchmark: generates a synthetic AdGuard querylog with injected
+DGA/exfiltration bursts (benchmarks.synthetic.make_querylog_frame) at a few
+scales and, in a temporary directory for each, times
+
+  - parse_querylog on the whole log
+  - ingest (write_csv), build_windows and detect on the first 90% of it
+    (the full fit), then again after the last 10% lands (incremental)
+  - the dashboard's API endpoints (in-process, median/p90 over --repeats)
+
+and scores detection against the injected windows: precision/recall of
+combined_score >= ALERT_THRESHOLD, and precision at k = number of injected
+windows. Results are written as JSON; --compare checks them against an
+earlier run and exits 1 if a timing regressed by more than --tolerance.
+
+    python -m benchmarks.run_suite --scales small medium --out bench.json
+    python -m benchmarks.run_suite --scales small --compare bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import make_querylog_frame, write_querylog
+
+SCALES = {
+    "small": dict(n_devices=10, minutes=240, rate=10.0),
+    "medium": dict(n_devices=50, minutes=720, rate=10.0),
+    "large": dict(n_devices=200, minutes=1440, rate=10.0),
+}
+# share of the log the first (full fit) pass sees
+FIRST_PASS = 0.9
+
+
+def timed(fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, round(time.perf_counter() - t0, 4)
+
+
+def run_pipeline(timings, prefix):
+    from app.ingest.parse_querylog import write_csv, QUERYLOG
+    from app.features.build_features import build_windows
+    from app.models.detector import detect
+    from app.storage.parquet_store import DNS
+
+    _, timings[f"{prefix}.ingest"] = timed(write_csv, QUERYLOG, DNS)
+    _, timings[f"{prefix}.build_windows"] = timed(build_windows, DNS)
+    _, timings[f"{prefix}.detect"] = timed(detect)
+
+
+def bench_api(repeats):
+    from fastapi.testclient import TestClient
+    from app.api.main import app
+    from app.storage.query_cache import cached
+    from app.storage.parquet_store import FEATURES
+
+    client = TestClient(app)
+    ip = cached(FEATURES).devices()[0]
+    paths = {
+        "status": "/status",
+        "alerts": "/alerts",
+        "alerts_arrow": "/alerts?format=arrow",
+        "devices": "/devices",
+        "features_page": "/features?limit=1000",
+        "history_1h": f"/devices/{ip}/history?since=1h",
+        "history_2d": f"/devices/{ip}/history?since=2d",
+        "metrics": "/metrics",
+    }
+    results = {}
+    for name, path in paths.items():
+        # first call pays for the cache load, report it on its own
+        t0 = time.perf_counter()
+        client.get(path).raise_for_status()
+        cold = time.perf_counter() - t0
+        latencies = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            client.get(path).raise_for_status()
+            latencies.append(time.perf_counter() - t0)
+        ms = np.array(latencies) * 1000
+        results[name] = {
+            "cold_ms": round(cold * 1000, 2),
+            "p50_ms": round(float(np.percentile(ms, 50)), 2),
+            "p90_ms": round(float(np.percentile(ms, 90)), 2),
+        }
+    return results
+
+
+def detection_quality(anomalies):
+    from app.storage.parquet_store import read_dataset, ANOMALY_HISTORY
+    from app.storage.events import ALERT_THRESHOLD
+
+    history = read_dataset(ANOMALY_HISTORY, columns=["client_ip", "minute", "combined_score"])
+    history = history.assign(
+        client_ip=history["client_ip"].astype(str),
+        minute_ns=history["minute"].dt.tz_convert("UTC").astype("int64"),
+    )
+    labels = anomalies.assign(minute_ns=anomalies["minute"].dt.tz_convert("UTC").astype("int64"))
+    scored = history.merge(labels[["client_ip", "minute_ns", "kind"]], on=["client_ip", "minute_ns"], how="left")
+    truth = scored["kind"].notna()
+
+    flagged = scored["combined_score"] >= ALERT_THRESHOLD
+    tp = int((flagged & truth).sum())
+    k = int(truth.sum())
+    top_k = scored.nlargest(k, "combined_score") if k else scored.iloc[:0]
+
+    recall_by_kind = {}
+    for kind, grp in scored[truth].groupby("kind"):
+        recall_by_kind[kind] = round(float((grp["combined_score"] >= ALERT_THRESHOLD).mean()), 4)
+
+    return {
+        "threshold": ALERT_THRESHOLD,
+        "windows": len(scored),
+        "injected_windows": len(labels),
+        "scored_injected_windows": k,
+        "flagged": int(flagged.sum()),
+        "precision": round(tp / flagged.sum(), 4) if flagged.any() else None,
+        "recall": round(tp / k, 4) if k else None,
+        "precision_at_k": round(float(top_k["kind"].notna().mean()), 4) if k else None,
+        "recall_by_kind": recall_by_kind,
+    }
+
+
+def run_scale(name, params, repeats, seed):
+    from app.ingest.parse_querylog import parse_querylog, QUERYLOG
+    from app.storage.summary import load_summary
+    from app.storage import query_cache
+
+    # generations restart in each directory, don't let the API cache carry over
+    query_cache._CACHES.clear()
+
+    queries, anomalies = make_querylog_frame(**params, seed=seed)
+    QUERYLOG.parent.mkdir(parents=True, exist_ok=True)
+    cut = queries["time"].min() + (queries["time"].max() - queries["time"].min()) * FIRST_PASS
+    # split on a whole minute so no window straddles the two passes
+    cut = cut.floor("1min")
+    first, rest = queries[queries["time"] < cut], queries[queries["time"] >= cut]
+
+    timings = {}
+    write_querylog(queries, "full.json")
+    _, timings["parse_querylog"] = timed(parse_querylog, Path("full.json"))
+    log_bytes = os.path.getsize("full.json")
+
+    write_querylog(first, QUERYLOG)
+    run_pipeline(timings, "full")
+    write_querylog(rest, "rest.json")
+    with open(QUERYLOG, "ab") as out, open("rest.json", "rb") as f:
+        out.write(f.read())
+    run_pipeline(timings, "incremental")
+
+    return {
+        "scale": name,
+        "params": params,
+        "queries": len(queries),
+        "log_bytes": log_bytes,
+        "timings_s": timings,
+        "queries_per_s": round(len(queries) / timings["parse_querylog"], 1),
+        # wall/CPU/peak RSS/IO of the incremental pass, from app.metrics
+        "stages": load_summary().get("stages", {}),
+        "api": bench_api(repeats),
+        "detection": detection_quality(anomalies),
+    }
+
+
+def git_commit():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).resolve().parent, capture_output=True, text=True, check=True,
+        )
+        return out.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance, min_delta):
+    """
+    Timings (pipeline seconds and API p50) that got more than tolerance
+    times and more than min_delta seconds slower than in baseline, as
+    printable lines. The delta keeps millisecond jitter out.
+    """
+    def flat(run):
+        out = {}
+        for scale in run["scales"]:
+            for key, value in scale["timings_s"].items():
+                out[f"{scale['scale']} {key}"] = value
+            for key, value in scale["api"].items():
+                out[f"{scale['scale']} api.{key}.p50"] = value["p50_ms"] / 1000
+        return out
+
+    now, before = flat(results), flat(baseline)
+    regressions = []
+    for key in sorted(now.keys() & before.keys()):
+        if before[key] > 0 and now[key] / before[key] > tolerance and now[key] - before[key] > min_delta:
+            regressions.append(f"{key}: {before[key]:.4f}s -> {now[key]:.4f}s ({now[key] / before[key]:.2f}x)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", nargs="+", default=["small", "medium"], choices=list(SCALES))
+    parser.add_argument("--repeats", type=int, default=20, help="calls per API endpoint")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="bench_results.json")
+    parser.add_argument("--compare", help="earlier --out file to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="slowdown ratio counted as a regression")
+    parser.add_argument("--min-delta", type=float, default=0.05, help="... if also this many seconds slower")
+    args = parser.parse_args()
+
+    out = Path(args.out).resolve()
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = {
+        "created": pd.Timestamp.now("UTC").isoformat(),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "scales": [],
+    }
+    cwd = os.getcwd()
+    for name in args.scales:
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                scale = run_scale(name, SCALES[name], args.repeats, args.seed)
+            finally:
+                os.chdir(cwd)
+        results["scales"].append(scale)
+
+        t, d = scale["timings_s"], scale["detection"]
+        print(f"{name}: {scale['queries']} queries")
+        print(f"  parse {t['parse_querylog']}s  full: ingest {t['full.ingest']}s features {t['full.build_windows']}s detect {t['full.detect']}s")
+        print(f"  incremental: ingest {t['incremental.ingest']}s features {t['incremental.build_windows']}s detect {t['incremental.detect']}s")
+        print("  api p50 ms: " + ", ".join(f"{k} {v['p50_ms']}" for k, v in scale["api"].items()))
+        print(f"  detection: precision {d['precision']} recall {d['recall']} precision@k {d['precision_at_k']} {d['recall_by_kind']}")
+
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2, default=str)
+    print(f"results -> {out}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance, args.min_delta)
+        for line in regressions:
+            print("REGRESSION", line)
+        if regressions:
+            sys.exit(1)
+        print(f"no timing above {args.tolerance}x of {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
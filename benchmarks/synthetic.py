@@ -0,0 +1,201 @@
+import numpy as np
+import pandas as pd
+
+
+def make_dns_frame(n_rows, n_devices=50, n_domains=5000, minutes=60 * 24, seed=0):
+    """
+    Synthetic parsed DNS log with the same columns as data/sample_dns.csv,
+    sorted by time. Domain popularity is Zipf-like so each device has a
+    handful of hot domains and a long tail.
+    """
+    rng = np.random.default_rng(seed)
+
+    devices = np.array([f"192.168.8.{i + 2}" for i in range(n_devices)])
+    domains = np.array([f"host{i}.example{i % 97}.com" for i in range(n_domains)])
+
+    ranks = np.arange(1, n_domains + 1)
+    weights = 1.0 / ranks
+    weights /= weights.sum()
+
+    start = pd.Timestamp("2025-11-20T00:00:00")
+    offsets = np.sort(rng.integers(0, minutes * 60_000_000_000, size=n_rows))
+
+    df = pd.DataFrame({
+        "time": start + pd.to_timedelta(offsets, unit="ns"),
+        "client_ip": devices[rng.integers(0, n_devices, size=n_rows)],
+        "domain": domains[rng.choice(n_domains, size=n_rows, p=weights)],
+        "qtype": "A",
+    })
+    return df
+
+
+def make_feature_frame(n_devices=200, minutes=600, seed=0):
+    """
+    Synthetic per-(client_ip, minute) feature windows with the FEAT_COLS
+    columns the detector consumes. Devices get different window counts so
+    the detector sees a mix of large and small devices.
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2025-11-20T00:00:00")
+    parts = []
+    for i in range(n_devices):
+        n = int(rng.integers(minutes // 10, minutes + 1))
+        minute = start + pd.to_timedelta(np.sort(rng.choice(minutes, size=n, replace=False)), unit="min")
+        qpm = rng.poisson(20 + i % 30, size=n) + 1
+        uniq = np.minimum(qpm, rng.poisson(8, size=n) + 1)
+        parts.append(pd.DataFrame({
+            "client_ip": f"10.0.{i // 250}.{i % 250 + 2}",
+            "minute": minute,
+            "qpm": qpm,
+            "uniq": uniq,
+            "avg_len": rng.normal(18, 2, size=n),
+            "len_std": np.abs(rng.normal(4, 1, size=n)),
+            "top_domain_ratio": rng.uniform(0.1, 0.9, size=n),
+            "shannon_entropy": rng.uniform(0, 5, size=n),
+            "new_domain_ratio": rng.beta(1, 20, size=n),
+            "KL_divergence": rng.gamma(2, 3, size=n),
+        }))
+    return pd.concat(parts, ignore_index=True)
+
+
+# AdGuard Home writes T with the router's offset; the parser keeps it
+QUERYLOG_TZ = "-05:00"
+# host part of the injected queries, see make_querylog
+DGA_ALPHABET = np.array(list("abcdefghijklmnopqrstuvwxyz0123456789"))
+EXFIL_ALPHABET = np.array(list("abcdefghijklmnopqrstuvwxyz234567"))
+
+
+def _labels(rng, n, low, high, alphabet):
+    """n random labels of low..high characters drawn from alphabet."""
+    lengths = rng.integers(low, high + 1, size=n)
+    chars = alphabet[rng.integers(0, len(alphabet), size=(n, high))]
+    return np.array(["".join(row[:k]) for row, k in zip(chars, lengths)])
+
+
+def make_querylog_frame(
+    n_devices=20,
+    n_domains=5000,
+    minutes=240,
+    rate=10.0,
+    zipf=1.1,
+    dga_bursts=3,
+    exfil_bursts=3,
+    burst_minutes=(3, 8),
+    burst_rate=60,
+    start="2025-11-20T00:00:00",
+    seed=0,
+):
+    """
+    Synthetic AdGuard querylog as (queries, anomalies).
+
+    Each device sends Poisson(rate * its own multiplier) queries a minute
+    to domains drawn from a Zipf(zipf) popularity, rotated per device so
+    devices favour different hosts. On top of that, for burst_minutes
+    (low, high) minutes at a time:
+      - dga_bursts: a device resolves burst_rate random 8-20 character
+        hosts a minute under a few throwaway TLDs
+      - exfil_bursts: a device sends burst_rate queries a minute with a
+        40-60 character base32 label under one domain
+
+    queries has time (tz-aware), client_ip, domain, qtype, sorted by time.
+    anomalies has client_ip, minute and kind for each window with an
+    injected burst, the labels for precision/recall.
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start).tz_localize(QUERYLOG_TZ)
+    devices = np.array([f"192.168.{8 + i // 250}.{i % 250 + 2}" for i in range(n_devices)])
+    domains = np.array([f"host{i}.example{i % 97}.com" for i in range(n_domains)])
+
+    ranks = np.arange(1, n_domains + 1)
+    weights = ranks ** -float(zipf)
+    weights /= weights.sum()
+
+    # normal traffic: per (device, minute) counts, then one row per query
+    multiplier = rng.lognormal(0, 0.5, size=n_devices)
+    counts = rng.poisson(np.outer(multiplier * rate, np.ones(minutes)))
+    device_idx = np.repeat(np.repeat(np.arange(n_devices), minutes), counts.ravel())
+    minute_idx = np.repeat(np.tile(np.arange(minutes), n_devices), counts.ravel())
+    rank = rng.choice(n_domains, size=len(device_idx), p=weights)
+    shift = rng.integers(0, n_domains, size=n_devices)
+    parts = [pd.DataFrame({
+        "device": device_idx,
+        "minute": minute_idx,
+        "domain": domains[(rank + shift[device_idx]) % n_domains],
+    })]
+
+    anomalies = []
+    kinds = ["dga"] * dga_bursts + ["exfil"] * exfil_bursts
+    for kind in kinds:
+        device = int(rng.integers(0, n_devices))
+        length = int(rng.integers(burst_minutes[0], burst_minutes[1] + 1))
+        first = int(rng.integers(minutes // 4, max(minutes // 4 + 1, minutes - length)))
+        n = burst_rate * length
+        if kind == "dga":
+            tlds = np.array([".xyz", ".top", ".info", ".biz"])
+            hosts = _labels(rng, n, 8, 20, DGA_ALPHABET)
+            domain = np.char.add(hosts, tlds[rng.integers(0, len(tlds), size=n)])
+        else:
+            hosts = _labels(rng, n, 40, 60, EXFIL_ALPHABET)
+            domain = np.char.add(hosts, ".t.cdn-sync.net")
+        parts.append(pd.DataFrame({
+            "device": device,
+            "minute": np.repeat(np.arange(first, first + length), burst_rate),
+            "domain": domain,
+        }))
+        anomalies += [(devices[device], start + pd.Timedelta(minutes=m), kind) for m in range(first, first + length)]
+
+    df = pd.concat(parts, ignore_index=True)
+    offsets = df["minute"].to_numpy() * 60_000_000_000 + rng.integers(0, 60_000_000_000, size=len(df))
+    queries = pd.DataFrame({
+        "time": start + pd.to_timedelta(offsets, unit="ns"),
+        "client_ip": devices[df["device"].to_numpy()],
+        "domain": df["domain"].to_numpy(),
+        "qtype": np.where(rng.random(len(df)) < 0.8, "A", "AAAA"),
+    }).sort_values("time", ignore_index=True)
+    anomalies = pd.DataFrame(anomalies, columns=["client_ip", "minute", "kind"]).drop_duplicates(["client_ip", "minute"])
+    return queries, anomalies
+
+
+def write_querylog(queries: pd.DataFrame, path):
+    """
+    queries as AdGuard querylog JSON lines (T/IP/QH/QT plus the fields the
+    parser ignores), formatted column-wise rather than with json.dumps.
+    """
+    times = queries["time"].dt.strftime("%Y-%m-%dT%H:%M:%S.%f")
+    offset = queries["time"].dt.strftime("%z").str.replace(r"(\d\d)$", r":\1", regex=True)
+    lines = (
+        '{"T":"' + times + offset
+        + '","QH":"' + queries["domain"].astype(str)
+        + '","QT":"' + queries["qtype"].astype(str)
+        + '","QC":"IN","CP":"","Upstream":"https://dns.example:443/dns-query","Answer":"","IP":"'
+        + queries["client_ip"].astype(str)
+        + '","Result":{},"Elapsed":125000}\n'
+    )
+    with open(path, "w") as f:
+        f.writelines(lines)
+    return path
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Write a synthetic AdGuard querylog and its anomaly labels.")
+    parser.add_argument("out", help="querylog path, e.g. data/querylog.json")
+    parser.add_argument("--labels", help="CSV of injected anomaly windows (default: <out>.labels.csv)")
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--domains", type=int, default=5000)
+    parser.add_argument("--minutes", type=int, default=240)
+    parser.add_argument("--rate", type=float, default=10.0, help="mean queries per device per minute")
+    parser.add_argument("--zipf", type=float, default=1.1)
+    parser.add_argument("--dga", type=int, default=3, help="DGA bursts")
+    parser.add_argument("--exfil", type=int, default=3, help="exfiltration bursts")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    queries, anomalies = make_querylog_frame(
+        n_devices=args.devices, n_domains=args.domains, minutes=args.minutes, rate=args.rate,
+        zipf=args.zipf, dga_bursts=args.dga, exfil_bursts=args.exfil, seed=args.seed,
+    )
+    write_querylog(queries, args.out)
+    anomalies.to_csv(args.labels or f"{args.out}.labels.csv", index=False)
+    print(f"{len(queries)} queries, {len(anomalies)} anomalous windows -> {args.out}")
@@ -0,0 +1,18 @@
+import pytest
+
+import app.storage.interning as interning
+import app.storage.query_cache as query_cache
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """
+    Each test runs in its own directory: the app keeps everything under a
+    relative data/. The in-process dictionary and dataset caches start
+    empty too.
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(interning, "_INTERNERS", {})
+    monkeypatch.setattr(query_cache, "_CACHES", {})
+    (tmp_path / "data").mkdir()
+    return tmp_path
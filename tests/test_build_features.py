@@ -0,0 +1,102 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.features.build_features import build_windows, spec_minutes, FEAT_COLS, WINDOW_SPECS, WINDOWS
+from app.ingest.parse_querylog import write_csv
+from app.storage.parquet_store import read_dataset, DNS
+from benchmarks.synthetic import make_querylog_frame, write_querylog
+
+SPOOL = Path("data/querylog.json")
+
+
+@pytest.fixture(scope="module")
+def queries():
+    queries, _ = make_querylog_frame(n_devices=4, n_domains=300, minutes=150, rate=3, dga_bursts=1, exfil_bursts=1)
+    return queries
+
+
+def ingest(queries):
+    """Appends queries to the spool, then ingests and builds windows."""
+    tmp = SPOOL.with_name("chunk.json")
+    write_querylog(queries, tmp)
+    with open(SPOOL, "ab") as f:
+        f.write(tmp.read_bytes())
+    write_csv(in_path=SPOOL, out_path=DNS)
+    build_windows(src_path=DNS)
+
+
+def windows():
+    return {
+        name: read_dataset(path).astype({"client_ip": str}).sort_values(["client_ip", "minute"], ignore_index=True)
+        for name, path in WINDOWS.items()
+    }
+
+
+def reference(dns, spec, epsilon=1e-7):
+    """
+    Each spec window recomputed row by row: windows start on multiples of
+    the hop (epoch minutes, UTC), only complete ones are kept and KL is
+    taken against the whole batch's per-device domain frequencies.
+    """
+    size, hop = spec_minutes(spec)
+    dns = dns.astype({"client_ip": str, "domain": str}).sort_values("time", kind="stable")
+    dns["new"] = dns["time"] == dns.groupby(["client_ip", "domain"])["time"].transform("min")
+    base = dns.groupby(["client_ip", "domain"]).size()
+    base = base / base.groupby(level=0).transform("sum")
+    minute = dns["time"].dt.floor("1min").dt.tz_convert("UTC").astype("int64") // 60_000_000_000
+    last = int(minute.max())
+
+    rows = []
+    for start in range(-(-int(minute.min()) // hop) * hop, last - size + 2, hop):
+        for ip, g in dns[(minute >= start) & (minute < start + size)].groupby("client_ip"):
+            counts = g["domain"].value_counts()
+            p = counts / counts.sum()
+            pb = base.reindex(pd.MultiIndex.from_arrays([[ip] * len(p), p.index])).fillna(0).to_numpy() + epsilon
+            pt = p.to_numpy() + epsilon
+            lengths = g["domain"].str.len()
+            rows.append({
+                "client_ip": ip,
+                "start": start,
+                "qpm": len(g) / size,
+                "uniq": len(counts),
+                "avg_len": lengths.mean(),
+                "len_std": lengths.std() if len(g) > 1 else 0.0,
+                "top_domain_ratio": counts.max() / counts.sum(),
+                "shannon_entropy": -(p * np.log2(p)).sum(),
+                "new_domain_ratio": g["new"].mean(),
+                "KL_divergence": (pt * np.log(pt / pb)).sum(),
+            })
+    return pd.DataFrame(rows).sort_values(["client_ip", "start"], ignore_index=True)
+
+
+def check(got, ref, cols=FEAT_COLS):
+    starts = got["minute"].dt.tz_convert("UTC").astype("int64") // 60_000_000_000
+    assert len(ref) and len(got) == len(ref)
+    assert (got["client_ip"].to_numpy() == ref["client_ip"].to_numpy()).all()
+    assert (starts.to_numpy() == ref["start"].to_numpy()).all()
+    np.testing.assert_allclose(got[cols].astype(float), ref[cols].astype(float), atol=1e-9)
+
+
+@pytest.mark.parametrize("name", list(WINDOW_SPECS))
+def test_spec_windows_match_a_reference(queries, name):
+    ingest(queries)
+    check(windows()[name], reference(read_dataset(DNS), WINDOW_SPECS[name]))
+
+
+def test_incremental_spec_windows_match_a_reference(queries):
+    minute = queries["time"].dt.floor("1min")
+    first = minute.min()
+    for lo, hi in ((0, 37), (37, 91), (91, None)):
+        chunk = minute >= first + pd.Timedelta(minutes=lo)
+        if hi is not None:
+            chunk &= minute < first + pd.Timedelta(minutes=hi)
+        ingest(queries[chunk])
+
+    # KL is taken against the baseline as of each run, the rest must match
+    cols = [c for c in FEAT_COLS if c != "KL_divergence"]
+    dns = read_dataset(DNS)
+    for name, spec in WINDOW_SPECS.items():
+        check(windows()[name], reference(dns, spec), cols)
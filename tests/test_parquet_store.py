@@ -0,0 +1,105 @@
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from app.storage.parquet_store import (
+    compact_partitions,
+    dataset_files,
+    publish_staged,
+    read_dataset,
+    read_generation,
+    truncate_partitions,
+    write_dataset,
+)
+
+DS = Path("data/ds")
+
+
+def frame(start, n, ip="192.168.8.2"):
+    return pd.DataFrame({
+        "time": pd.date_range(start, periods=n, freq="7min", tz="UTC"),
+        "client_ip": ip,
+        "domain": [f"host{i}.example.com" for i in range(n)],
+        "qtype": "A",
+    })
+
+
+def write_parts(n=3):
+    for i in range(n):
+        write_dataset(DS, frame(f"2025-11-20T0{i}:00:00", 5, ip=f"192.168.8.{i + 2}"))
+    return read_dataset(DS)
+
+
+def crash_on_unlink(monkeypatch, after):
+    """Path.unlink raises once it has been called `after` times."""
+    calls = []
+    unlink = Path.unlink
+
+    def crashing(self, missing_ok=False):
+        if len(calls) == after:
+            raise OSError("crashed mid compaction")
+        calls.append(self)
+        unlink(self, missing_ok=missing_ok)
+
+    monkeypatch.setattr(Path, "unlink", crashing)
+
+
+def test_compaction_merges_each_partition():
+    before = write_parts()
+    assert len(dataset_files(DS)) == 3
+    generation = read_generation(DS)
+
+    assert compact_partitions(DS) == 2
+    assert len(dataset_files(DS)) == 1
+    pd.testing.assert_frame_equal(read_dataset(DS), before)
+    assert read_generation(DS) == generation + 1
+    assert compact_partitions(DS) == 0
+
+
+@pytest.mark.parametrize("after", [0, 1])
+def test_interrupted_compaction_is_finished_by_the_next(monkeypatch, after):
+    before = write_parts()
+    oldest = dataset_files(DS)[0]
+    with monkeypatch.context() as m:
+        crash_on_unlink(m, after)
+        with pytest.raises(OSError):
+            compact_partitions(DS)
+    # the merged file took the oldest one's name, the others are still there
+    assert dataset_files(DS)[0] == oldest
+    assert len(dataset_files(DS)) == 3 - after
+
+    assert compact_partitions(DS) == 2 - after
+    assert dataset_files(DS) == [oldest]
+    pd.testing.assert_frame_equal(read_dataset(DS), before)
+
+
+def test_finished_compaction_keeps_newer_files():
+    write_parts()
+    compact_partitions(DS)
+    write_dataset(DS, frame("2025-11-20T05:00:00", 5))
+    before = read_dataset(DS)
+
+    assert compact_partitions(DS) == 1
+    pd.testing.assert_frame_equal(read_dataset(DS), before)
+
+
+def test_staged_writes_show_once_published():
+    before = write_parts()
+    write_dataset(DS, frame("2025-11-21T00:00:00", 5), staged=True)
+    pd.testing.assert_frame_equal(read_dataset(DS), before)
+
+    assert publish_staged(DS)
+    assert len(read_dataset(DS)) == len(before) + 5
+    assert not publish_staged(DS)
+
+
+def test_staged_truncate_replaces_the_tail():
+    write_parts()
+    write_dataset(DS, frame("2025-11-21T00:00:00", 5))
+    truncate_partitions(DS, "2025-11-21", staged=True)
+    write_dataset(DS, frame("2025-11-21T00:00:00", 3), staged=True)
+    assert len(read_dataset(DS)) == 20
+
+    publish_staged(DS)
+    assert len(read_dataset(DS)) == 18
@@ -0,0 +1,122 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from app.ingest import retrieve_logs
+from app.ingest.retrieve_logs import pull_logs, LocalLogSource
+from app.ingest.state_manager import load_state, save_state
+
+SPOOL = Path("data/querylog.json")
+REMOTE = "router.json"
+
+
+def pull():
+    return pull_logs(LocalLogSource(), spool=SPOOL, remote=REMOTE)
+
+
+def append(path, data: bytes):
+    with open(path, "ab") as f:
+        f.write(data)
+
+
+def rotate(new: bytes):
+    os.rename(REMOTE, REMOTE + ".1")
+    Path(REMOTE).write_bytes(new)
+
+
+def test_partial_line_waits_for_its_newline():
+    Path(REMOTE).write_bytes(b'{"a":1}\n{"b":')
+    pull()
+    assert SPOOL.read_bytes() == b'{"a":1}\n'
+    assert load_state()["remote_offset"] == 8
+
+    append(REMOTE, b'2}\n')
+    pull()
+    assert SPOOL.read_bytes() == b'{"a":1}\n{"b":2}\n'
+
+
+def test_nothing_new_appends_nothing():
+    Path(REMOTE).write_bytes(b"1\n2")
+    pull()
+    pull()
+    assert SPOOL.read_bytes() == b"1\n"
+
+
+def test_rotation_reads_the_rest_of_the_old_file_first():
+    Path(REMOTE).write_bytes(b"1\n2\n")
+    pull()
+    append(REMOTE, b"3\n")
+    rotate(b"4\n")
+    pull()
+    assert SPOOL.read_bytes() == b"1\n2\n3\n4\n"
+    state = load_state()
+    assert state["remote_inode"] == os.stat(REMOTE).st_ino
+    assert state["remote_offset"] == 2
+
+
+def test_rotation_drops_the_old_partial_line():
+    # a line the old file never finished can't be completed in the new one
+    Path(REMOTE).write_bytes(b"1\n")
+    pull()
+    append(REMOTE, b"2\n3")
+    rotate(b"4\n")
+    pull()
+    assert SPOOL.read_bytes() == b"1\n2\n4\n"
+
+
+def test_rotation_catch_up_spans_pulls(monkeypatch):
+    monkeypatch.setattr(retrieve_logs, "MAX_PULL_BYTES", 2)
+    Path(REMOTE).write_bytes(b"1\n")
+    pull()
+    append(REMOTE, b"2\n3\n")
+    rotate(b"4\n")
+
+    pull()
+    assert SPOOL.read_bytes() == b"1\n2\n"
+    pull()
+    assert SPOOL.read_bytes() == b"1\n2\n3\n"
+    pull()
+    assert SPOOL.read_bytes() == b"1\n2\n3\n4\n"
+
+
+def test_truncated_in_place_starts_over():
+    Path(REMOTE).write_bytes(b"1\n2\n")
+    pull()
+    with open(REMOTE, "r+b") as f:
+        f.truncate(0)
+        f.write(b"3\n")
+    pull()
+    assert SPOOL.read_bytes() == b"1\n2\n3\n"
+
+
+def test_failed_pull_is_not_appended_twice(monkeypatch):
+    Path(REMOTE).write_bytes(b"1\n")
+    pull()
+    append(REMOTE, b"2\n")
+
+    def fail(state):
+        raise RuntimeError("stopped before saving")
+
+    with monkeypatch.context() as m:
+        m.setattr(retrieve_logs, "save_state", fail)
+        with pytest.raises(RuntimeError):
+            pull()
+    pull()
+    assert SPOOL.read_bytes() == b"1\n2\n"
+
+
+def test_consumed_spool_is_emptied():
+    Path(REMOTE).write_bytes(b"1\n2\n")
+    pull()
+    pull()
+    # not ingested yet: kept
+    assert SPOOL.read_bytes() == b"1\n2\n"
+
+    save_state({**load_state(), "spool_offset": SPOOL.stat().st_size})
+    append(REMOTE, b"3\n")
+    pull()
+    assert SPOOL.read_bytes() == b"3\n"
+    state = load_state()
+    assert state["spool_offset"] == 0
+    assert state["spool_size"] == 2
@@ -0,0 +1,34 @@
+from pathlib import Path
+
+from app.features.build_features import build_windows, WINDOW_SPECS
+from app.ingest.parse_querylog import write_csv
+from app.ingest.state_manager import compact_codes, forget_devices, load_window_carry, WINDOW_CARRY_DIR
+from app.storage.interning import interner
+from app.storage.parquet_store import DNS
+from benchmarks.synthetic import make_querylog_frame, write_querylog
+
+SPOOL = Path("data/querylog.json")
+
+
+def build():
+    queries, _ = make_querylog_frame(n_devices=4, n_domains=300, minutes=30, rate=3, dga_bursts=0, exfil_bursts=0)
+    write_querylog(queries, SPOOL)
+    write_csv(in_path=SPOOL, out_path=DNS)
+    build_windows(src_path=DNS)
+    return queries
+
+
+def test_compact_codes_skips_a_half_written_window_carry():
+    queries = build()
+    name, *rest = WINDOW_SPECS
+    # save_window_carry stopped between its two files
+    (WINDOW_CARRY_DIR / f"{name}.cells.parquet").unlink()
+    forget_devices([queries["client_ip"].iloc[0]])
+
+    dropped = compact_codes()
+    assert set(dropped) == {"client_ip", "domain"}
+    assert load_window_carry(name) == (None, None)
+    devices = len(interner("client_ip"))
+    for other in rest:
+        minutes, _ = load_window_carry(other)
+        assert (minutes["device_id"] < devices).all()
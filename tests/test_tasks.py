@@ -0,0 +1,187 @@
+from pathlib import Path
+
+import pytest
+
+import app.tasks as tasks
+from app.celery_app import celery_app
+from app.ingest import state_manager
+from app.ingest.retrieve_logs import pull_logs, LocalLogSource
+from app.ingest.state_manager import load_state, load_baseline_counts
+from app.lock import FileLock, LockLost
+from app.storage.parquet_store import read_dataset, DNS, FEATURES, ANOMALY_HISTORY
+from app.stream import StreamingPipeline
+from benchmarks.synthetic import make_querylog_frame, write_querylog
+
+REMOTE = "router.json"
+
+
+@pytest.fixture
+def eager(monkeypatch):
+    """
+    Runs the tasks in process, pulling from REMOTE instead of the router.
+    """
+    old = {k: celery_app.conf[k] for k in (
+        "task_always_eager", "broker_url", "result_backend",
+        "task_eager_propagates", "task_store_eager_result",
+    )}
+    celery_app.conf.update(
+        task_always_eager=True,
+        broker_url="memory://",
+        result_backend="cache+memory://",
+        task_eager_propagates=False,
+        task_store_eager_result=True,
+    )
+    monkeypatch.setattr(tasks, "pull_logs", lambda: pull_logs(LocalLogSource(), remote=REMOTE))
+    yield
+    celery_app.conf.update(old)
+
+
+@pytest.fixture(scope="module")
+def lines(tmp_path_factory):
+    queries, _ = make_querylog_frame(n_devices=5, minutes=90, rate=4, dga_bursts=1, exfil_bursts=1)
+    path = tmp_path_factory.mktemp("querylog") / "querylog.json"
+    write_querylog(queries, path)
+    return path.read_bytes().splitlines(keepends=True)
+
+
+def serve(lines):
+    Path(REMOTE).write_bytes(b"".join(lines))
+
+
+def watermarks():
+    state = load_state()
+    return {k: state.get(k) for k in ("last_ingested_time", "last_window_minute", "last_detected_minute")}
+
+
+def test_file_lock():
+    lock = FileLock()
+    assert lock.acquire("a", 60)
+    assert not lock.acquire("b", 60)
+    assert lock.holder() == "a"
+    assert lock.renew("a", 60)
+    assert not lock.renew("b", 60)
+
+    lock.release("b")
+    assert lock.holder() == "a"
+    lock.release("a")
+    assert lock.holder() is None
+    assert lock.acquire("b", 60)
+
+
+def test_expired_file_lock_is_taken_over():
+    lock = FileLock()
+    assert lock.acquire("a", 0)
+    assert lock.holder() is None
+    assert not lock.renew("a", 60)
+    assert lock.acquire("b", 60)
+    assert lock.holder() == "b"
+
+
+def test_stage_stops_when_the_lock_is_lost(eager):
+    FileLock().acquire("other", 60)
+    with pytest.raises(LockLost):
+        tasks.ingest_stage.apply(args=("mine",)).get()
+
+
+def test_refresh_runs_then_stages_skip(eager, lines):
+    serve(lines)
+    token = tasks.start_refresh()
+    result = celery_app.AsyncResult(token)
+    assert result.state == "SUCCESS"
+    assert set(result.result["stages"]) == set(tasks.REFRESH_STAGES)
+    assert FileLock().holder() is None
+    marks = watermarks()
+    assert all(v is not None for v in marks.values())
+
+    assert tasks.ingest_stage.apply().get()["skipped"] == "no new bytes in the spool"
+    assert tasks.features_stage.apply().get()["skipped"] == "no queries past last_window_minute"
+    assert tasks.detect_stage.apply().get()["skipped"] == "no windows past last_detected_minute"
+    assert watermarks() == marks
+
+
+def test_stages_skip_on_an_empty_tree(eager):
+    assert tasks.ingest_stage.apply().get()["skipped"] == "no spool"
+    assert tasks.features_stage.apply().get()["skipped"] == "nothing ingested"
+    assert tasks.detect_stage.apply().get()["skipped"] == "no features"
+
+
+def test_refresh_while_locked_returns_the_holder(eager, lines):
+    serve(lines)
+    other = tasks.REFRESH_TOKEN_PREFIX + "other"
+    FileLock().acquire(other, 60)
+    assert tasks.start_refresh() == other
+    assert not Path("data/querylog.json").exists()
+
+
+def test_refresh_while_the_stream_holds_the_lock(eager, lines):
+    serve(lines)
+    stream = StreamingPipeline(lock=FileLock(), n_jobs=1)
+    FileLock().acquire(stream.token, 60)
+    # the stream's token is no task id to poll
+    assert tasks.start_refresh() is None
+    assert FileLock().holder() == stream.token
+    assert not Path("data/querylog.json").exists()
+
+
+def test_detect_is_retried_then_the_refresh_fails(eager, lines, monkeypatch):
+    serve(lines)
+    calls = []
+
+    def fail(**kwargs):
+        calls.append(kwargs)
+        raise RuntimeError("fit failed")
+
+    with monkeypatch.context() as m:
+        m.setattr(tasks, "detect", fail)
+        with pytest.raises(RuntimeError):
+            tasks.start_refresh()
+    assert len(calls) == tasks.DETECT_RETRIES + 1
+    assert FileLock().holder() is None
+    assert watermarks()["last_window_minute"] is not None
+    assert watermarks()["last_detected_minute"] is None
+
+    token = tasks.start_refresh()
+    assert celery_app.AsyncResult(token).state == "SUCCESS"
+    assert watermarks()["last_detected_minute"] == watermarks()["last_window_minute"]
+
+
+def fail_commit(self, state):
+    raise RuntimeError("crashed before the commit")
+
+
+def test_failed_commits_are_retried_without_duplicates(eager, lines, monkeypatch):
+    half = len(lines) // 2
+    serve(lines[:half])
+    tasks.start_refresh()
+    baseline = load_baseline_counts()
+    marks = watermarks()
+
+    serve(lines)
+    tasks.pull_stage.apply().get()
+    with monkeypatch.context() as m:
+        m.setattr(state_manager.Commit, "apply", fail_commit)
+        with pytest.raises(RuntimeError):
+            tasks.ingest_stage.apply().get()
+    assert watermarks() == marks
+    tasks.ingest_stage.apply().get()
+
+    with monkeypatch.context() as m:
+        m.setattr(state_manager.Commit, "apply", fail_commit)
+        with pytest.raises(RuntimeError):
+            tasks.features_stage.apply().get()
+    # nothing of the failed run is visible, the baseline included
+    assert load_baseline_counts().equals(baseline)
+    assert watermarks()["last_window_minute"] == marks["last_window_minute"]
+    tasks.features_stage.apply().get()
+
+    with monkeypatch.context() as m:
+        m.setattr(state_manager.Commit, "apply", fail_commit)
+        with pytest.raises(RuntimeError):
+            tasks.detect_stage.apply().get()
+    assert watermarks()["last_detected_minute"] == marks["last_detected_minute"]
+    tasks.detect_stage.apply().get()
+
+    assert len(read_dataset(DNS)) == len(lines)
+    for path in (FEATURES, ANOMALY_HISTORY):
+        assert not read_dataset(path).duplicated(["client_ip", "minute"]).any(), path
+    assert watermarks()["last_detected_minute"] == watermarks()["last_window_minute"]